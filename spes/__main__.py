@@ -0,0 +1,3 @@
+from spes.cli import main
+
+main()
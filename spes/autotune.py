@@ -0,0 +1,432 @@
+"""Choose worker counts, BLAS threads and batch sizes for the fragility fit.
+
+The fit of :func:`spes.fragility.lds.lds_fragility` runs ``n_jobs`` threads
+that each call multi-threaded BLAS, so ``n_jobs * blas_threads`` should not
+exceed the cores of the node, and ``n_jobs`` batches of windows have to fit
+in memory next to the loaded recordings. Which split of the cores is
+fastest depends on the BLAS library and the number of channels, so it is
+measured: short microbenchmarks of the fit run on random data of the shape
+of the recording, and their results are cached per host and shape in a
+JSON file. Channel counts are rounded up to a multiple of
+``CHANNEL_BUCKET``, so recordings of a similar size share benchmarks. The
+cache key includes the BLAS libraries and the numpy version, so switching
+either benchmarks again.
+
+Only the numpy engine is benchmarked. eztrack's ``lds_raw_fragility`` runs
+its workers in separate processes, which the BLAS limit of this process
+does not reach, so its parallelism is not tuned. The first benchmark of a
+host and shape takes up to a minute on large montages, so callers opt in
+to it, e.g. with ``n_jobs="auto"`` in
+:func:`spes.fragility.run_fragility_analysis.run_analysis`.
+
+BLAS threads can only be limited at runtime if ``threadpoolctl`` is
+installed. Without it, the current BLAS threading is kept and only the
+number of workers is tuned. Memory is read with ``psutil`` if it is
+installed, and from ``/proc/meminfo`` otherwise.
+
+Without benchmarks, :func:`plan_workers` splits the cores between the fit
+and the loading, writing and rendering stages that run next to it.
+"""
+
+import json
+import os
+import socket
+import time
+import tracemalloc
+import uuid
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+from mne.utils import logger
+
+from spes.fragility.lds import lds_fragility
+
+# channel counts are rounded up to a multiple of this for the cache key
+CHANNEL_BUCKET = 16
+
+# the batch sizes (windows fit together) that are benchmarked
+BATCH_SIZES = (4, 8, 16, 32)
+
+DEFAULT_CACHE_FPATH = Path.home() / ".cache" / "spes" / "autotune.json"
+
+# environment variables that set the BLAS threads when threadpoolctl is
+# not available, in the order they take precedence
+_BLAS_ENV_VARS = (
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "OMP_NUM_THREADS",
+)
+
+
+def _count_cpus():
+    """The cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _available_memory():
+    """The memory available without swapping, in bytes."""
+    try:
+        import psutil
+
+        available = psutil.virtual_memory().available
+    except ImportError:
+        available = None
+        try:
+            with open("/proc/meminfo", "r") as fin:
+                for line in fin:
+                    if line.startswith("MemAvailable:"):
+                        available = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        if available is None:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    # a memory limit of the cgroup (e.g. a cluster job) caps the node's memory
+    cgroup_fpaths = (
+        Path("/sys/fs/cgroup/memory.max"),
+        Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    )
+    for fpath in cgroup_fpaths:
+        try:
+            limit = fpath.read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            available = min(available, int(limit))
+    return int(available)
+
+
+def _blas_info():
+    """The BLAS libraries and their number of threads."""
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        for env_var in _BLAS_ENV_VARS:
+            if os.environ.get(env_var, "").isdigit():
+                return None, int(os.environ[env_var])
+        # OpenBLAS and MKL default to one thread per core
+        return None, _count_cpus()
+
+    blas_libs = [info for info in threadpool_info() if info.get("user_api") == "blas"]
+    libraries = sorted({info["internal_api"] for info in blas_libs})
+    n_threads = max([info["num_threads"] for info in blas_libs], default=1)
+    return libraries, n_threads
+
+
+def get_resources():
+    """Inspect the cores, memory and BLAS threading of this node.
+
+    Returns
+    -------
+    resources : dict
+        ``host``, ``n_cpus`` (the cores this process may use),
+        ``available_memory`` (in bytes), ``blas_libraries`` (None if
+        ``threadpoolctl`` is not installed) and ``blas_threads``.
+    """
+    blas_libraries, blas_threads = _blas_info()
+    return {
+        "host": socket.gethostname(),
+        "n_cpus": _count_cpus(),
+        "available_memory": _available_memory(),
+        "blas_libraries": blas_libraries,
+        "blas_threads": blas_threads,
+    }
+
+
+def limit_blas_threads(n_threads):
+    """Limit the BLAS threads of this process in a ``with`` block.
+
+    Parameters
+    ----------
+    n_threads : int | None
+        The number of threads. If None, or if ``threadpoolctl`` is not
+        installed, BLAS threading is left as it is.
+
+    Returns
+    -------
+    context : context manager
+    """
+    if n_threads is None:
+        return nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return nullcontext()
+    return threadpool_limits(limits=n_threads, user_api="blas")
+
+
+def _read_cache(cache_fpath):
+    try:
+        with open(cache_fpath, "r") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _write_cache(cache_fpath, key, entry):
+    """Merge one entry into the cache, which other processes may also write."""
+    cache_fpath = Path(cache_fpath)
+    cache_fpath.parent.mkdir(exist_ok=True, parents=True)
+    cache = _read_cache(cache_fpath)
+    cache[key] = entry
+    tmp_fpath = cache_fpath.with_name(f".{cache_fpath.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_fpath, "w") as fout:
+        json.dump(cache, fout, indent=4, sort_keys=True)
+    os.replace(tmp_fpath, cache_fpath)
+
+
+def _windows_per_second(data, winsize, batch_size, n_jobs, blas_threads):
+    """Time the fit of one batch of windows per worker.
+
+    The windows start one sample apart, so ``data`` only has to be
+    ``winsize`` samples longer than the number of windows.
+    """
+    n_windows = n_jobs * batch_size
+    fit_kws = dict(winsize=winsize, stepsize=1, dtype=data.dtype)
+    with limit_blas_threads(blas_threads):
+        # a first window warms up BLAS
+        lds_fragility(data[:, : winsize + 1], n_jobs=1, **fit_kws)
+        start = time.perf_counter()
+        lds_fragility(
+            data[:, : winsize + n_windows - 1],
+            batch_size=batch_size,
+            n_jobs=n_jobs,
+            **fit_kws,
+        )
+    return n_windows / (time.perf_counter() - start)
+
+
+def _peak_bytes_per_window(n_chs, winsize, dtype):
+    """Measure the memory of fitting one batch of windows."""
+    batch_size = max(BATCH_SIZES)
+    data = np.zeros((n_chs, batch_size * winsize), dtype=dtype)
+    tracemalloc.start()
+    try:
+        lds_fragility(
+            data, winsize, winsize, dtype=dtype, batch_size=batch_size, n_jobs=1
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / batch_size
+
+
+def _thread_splits(n_cpus, blas_threads, can_limit):
+    """The (n_jobs, blas_threads) pairs to benchmark."""
+    if not can_limit:
+        # BLAS keeps its threads, so only fewer workers avoid oversubscribing
+        max_jobs = max(n_cpus // max(blas_threads, 1), 1)
+        return [(n_jobs, blas_threads) for n_jobs in _powers_of_two(max_jobs)]
+    return [(n_cpus // threads, threads) for threads in _powers_of_two(n_cpus)]
+
+
+def _powers_of_two(n):
+    values = [2**exp for exp in range(int(np.log2(n)) + 1)]
+    if values[-1] != n:
+        values.append(n)
+    return values
+
+
+def _run_benchmarks(n_chs, winsize, dtype, splits, seed=0):
+    """Benchmark every split of the cores, then the batch sizes of the best."""
+    rng = np.random.default_rng(seed)
+    max_windows = max(n_jobs for n_jobs, _ in splits) * max(BATCH_SIZES)
+    data = 50e-6 * rng.standard_normal((n_chs, winsize + max_windows))
+    data = data.astype(dtype)
+
+    splits_timings = dict()
+    for n_jobs, blas_threads in splits:
+        splits_timings[f"{n_jobs}x{blas_threads}"] = _windows_per_second(
+            data, winsize, 8, n_jobs, blas_threads
+        )
+    best_split = max(splits_timings, key=splits_timings.get)
+    n_jobs, blas_threads = (int(val) for val in best_split.split("x"))
+
+    batch_timings = {
+        str(batch_size): _windows_per_second(
+            data, winsize, batch_size, n_jobs, blas_threads
+        )
+        for batch_size in BATCH_SIZES
+    }
+    return {
+        "splits": splits_timings,
+        "batch_sizes": batch_timings,
+        "peak_bytes_per_window": _peak_bytes_per_window(n_chs, winsize, dtype),
+    }
+
+
+def _cache_key(resources, n_cpus, n_chs, winsize, dtype):
+    """The cache key of the benchmarks of a host, BLAS setup and shape."""
+    blas_libraries = "+".join(resources["blas_libraries"] or ["unknown"])
+    return (
+        f"{resources['host']}/{n_cpus}cpus/"
+        f"{blas_libraries}-{resources['blas_threads']}threads/numpy{np.__version__}/"
+        f"{n_chs}x{winsize}/{np.dtype(dtype).name}"
+    )
+
+
+def autotune(
+    n_chs,
+    winsize=250,
+    n_windows=None,
+    dtype=np.float64,
+    n_concurrent=1,
+    memory_fraction=0.5,
+    cache_fpath=None,
+    resources=None,
+):
+    """Choose the parallelism of the fragility fit of a recording.
+
+    Benchmarks are only run for a host and shape that is not in the cache
+    yet. The choice is then made from the cached throughputs: the fastest
+    split of the cores into workers and BLAS threads, and the fastest batch
+    size whose ``n_jobs`` batches fit in ``memory_fraction`` of the
+    available memory. The choices are logged.
+
+    Parameters
+    ----------
+    n_chs : int
+        The number of channels of the recording.
+    winsize : int
+        The number of samples per window.
+    n_windows : int | None
+        The number of windows of the recording. If set, no more workers
+        than batches are used.
+    dtype : np.dtype
+        The floating point dtype of the fit.
+    n_concurrent : int
+        The number of fits that will run at the same time (e.g. one per
+        reference), which share the cores and memory.
+    memory_fraction : float
+        The fraction of the available memory the batches may use.
+    cache_fpath : str | Path | None
+        The JSON file of cached benchmarks. Defaults to
+        ``~/.cache/spes/autotune.json``.
+    resources : dict | None
+        The output of :func:`get_resources`. Read from the node if None.
+
+    Returns
+    -------
+    tuning : dict
+        ``n_jobs``, ``blas_threads`` (None if BLAS threads cannot be
+        limited) and ``batch_size``, with the ``resources`` they were
+        chosen for.
+    """
+    if resources is None:
+        resources = get_resources()
+    can_limit = resources["blas_libraries"] is not None
+    n_cpus = max(resources["n_cpus"] // n_concurrent, 1)
+    dtype = np.dtype(dtype)
+    n_chs_bench = int(np.ceil(n_chs / CHANNEL_BUCKET) * CHANNEL_BUCKET)
+    splits = _thread_splits(n_cpus, resources["blas_threads"], can_limit)
+
+    cache_fpath = DEFAULT_CACHE_FPATH if cache_fpath is None else Path(cache_fpath)
+    key = _cache_key(resources, n_cpus, n_chs_bench, winsize, dtype)
+    entry = _read_cache(cache_fpath).get(key)
+    if entry is None:
+        start = time.perf_counter()
+        entry = _run_benchmarks(n_chs_bench, winsize, dtype, splits)
+        _write_cache(cache_fpath, key, entry)
+        logger.info(
+            f"Benchmarked {key} in {time.perf_counter() - start:.1f}s, "
+            f"cached in {cache_fpath}"
+        )
+
+    best_split = max(entry["splits"], key=entry["splits"].get)
+    n_jobs, blas_threads = (int(val) for val in best_split.split("x"))
+
+    # the fastest batch size whose batches fit in memory, shrinking the
+    # number of workers if not even the smallest does
+    memory_budget = memory_fraction * resources["available_memory"] / n_concurrent
+    batch_sizes = sorted(
+        (int(batch_size) for batch_size in entry["batch_sizes"]),
+        key=lambda batch_size: -entry["batch_sizes"][str(batch_size)],
+    )
+    batch_nbytes = entry["peak_bytes_per_window"]
+    fitting = [
+        size for size in batch_sizes if n_jobs * size * batch_nbytes <= memory_budget
+    ]
+    if fitting:
+        batch_size = fitting[0]
+    else:
+        batch_size = min(batch_sizes)
+        n_jobs = max(int(memory_budget // (batch_size * batch_nbytes)), 1)
+    if n_windows is not None:
+        n_jobs = max(min(n_jobs, int(np.ceil(n_windows / batch_size))), 1)
+
+    tuning = {
+        "n_jobs": n_jobs,
+        "blas_threads": blas_threads if can_limit else None,
+        "batch_size": batch_size,
+        "resources": resources,
+    }
+    logger.info(
+        f"Autotuned {n_chs} channels x {winsize} samples ({dtype.name}) on "
+        f"{resources['host']}: n_jobs={n_jobs}, blas_threads={tuning['blas_threads']}, "
+        f"batch_size={batch_size} ({n_cpus} cpus, "
+        f"{resources['available_memory'] / 1e9:.1f} GB available)"
+    )
+    return tuning
+
+
+def plan_workers(prefetch_depth=2, background=True, n_concurrent=1, resources=None):
+    """Split the cores of the node between the stages of a cohort run.
+
+    A cohort run overlaps the fit of one recording with loading the next
+    ones (``prefetch_depth`` loader threads), writing derivatives (one
+    writer thread, mostly waiting on I/O) and rendering heatmaps (worker
+    processes). The loaders and renderers each get an eighth of the cores,
+    at least one, and the fit gets the rest, split between ``n_concurrent``
+    fits. The summary runs after the other stages, so it gets every core.
+    The plan is logged.
+
+    eztrack's ``lds_raw_fragility`` runs its workers in joblib's process
+    pool, which limits the BLAS threads of each worker to its share of the
+    cores, so ``fit_n_jobs`` workers do not oversubscribe the node.
+
+    Parameters
+    ----------
+    prefetch_depth : int
+        The number of recordings loaded ahead, see
+        :func:`spes.read.prefetch_data`.
+    background : bool
+        Whether loaders, the writer and renderers run next to the fit. If
+        False, the fit gets every core.
+    n_concurrent : int
+        The number of fits that run at the same time (e.g. one per
+        reference).
+    resources : dict | None
+        The output of :func:`get_resources`. Read from the node if None.
+
+    Returns
+    -------
+    plan : dict
+        ``fit_n_jobs``, ``prefetch_workers``, ``writer_threads``,
+        ``heatmap_workers`` and ``summary_n_jobs``.
+    """
+    if resources is None:
+        resources = get_resources()
+    n_cpus = resources["n_cpus"]
+    if background:
+        prefetch_workers = min(prefetch_depth, max(n_cpus // 8, 1))
+        heatmap_workers = max(n_cpus // 8, 1)
+        writer_threads = 1
+    else:
+        prefetch_workers, heatmap_workers, writer_threads = 0, 0, 0
+    fit_cpus = max(n_cpus - prefetch_workers - heatmap_workers, 1)
+    plan = {
+        "fit_n_jobs": max(fit_cpus // n_concurrent, 1),
+        "prefetch_workers": prefetch_workers,
+        "writer_threads": writer_threads,
+        "heatmap_workers": heatmap_workers,
+        "summary_n_jobs": n_cpus,
+    }
+    logger.info(
+        f"Planned workers on {resources['host']} ({n_cpus} cpus): "
+        + ", ".join(f"{key}={val}" for key, val in plan.items())
+    )
+    return plan
@@ -0,0 +1,244 @@
+"""Benchmarks guarding the performance of the pipeline."""
+
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# modules that must not be imported when the command line interface starts
+HEAVY_MODULES = (
+    "mne",
+    "mne_bids",
+    "eztrack",
+    "matplotlib",
+    "pandas",
+    "scipy",
+    "hdf5storage",
+    "BCI2kReader",
+)
+
+# the maximum import time of ``spes.cli`` in seconds
+MAX_STARTUP_SECONDS = 0.1
+
+# the module each command of ``spes.cli`` imports when it runs
+COMMAND_MODULES = {
+    "cli": "spes.cli",
+    "convert-jhu": "spes.bids.scripts.run_bids_conversion",
+    "convert-spes": "spes.scripts.bids.run_bids_conversion",
+    "fragility": "spes.fragility.run_fragility_analysis",
+    "significance": "spes.fragility.significance",
+    "summarize": "spes.fragility.summary",
+    "verify": "spes.bids.verify",
+    "worker": "spes.jobqueue",
+}
+
+
+def _import_time(module):
+    """Import ``module`` in a fresh interpreter with ``-X importtime``.
+
+    Returns the cumulative import time of ``module`` in seconds and the
+    top-level packages that were imported with it.
+    """
+    code = (
+        f"import sys; import {module}; "
+        "print(','.join(sorted({m.split('.')[0] for m in sys.modules})))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+
+    cumulative_us = None
+    for line in proc.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            cumulative_us = int(fields[1])
+    imported = set(proc.stdout.strip().split(","))
+    return cumulative_us / 1e6, imported
+
+
+def benchmark_startup(commands=None, n_repeats=3, max_seconds=MAX_STARTUP_SECONDS):
+    """Benchmark the import time of the command line interface.
+
+    Each module is imported in a fresh interpreter, ``n_repeats`` times, and
+    the fastest run is kept.
+
+    Parameters
+    ----------
+    commands : list of str | None
+        The commands of :data:`COMMAND_MODULES` to benchmark. Defaults to
+        all. Commands whose dependencies are not installed are skipped.
+    n_repeats : int
+        The number of fresh imports per module.
+    max_seconds : float
+        The maximum import time of ``spes.cli``.
+
+    Returns
+    -------
+    result_df : pd.DataFrame
+        The import time of each command's module, and which heavy modules
+        it imports.
+
+    Raises
+    ------
+    RuntimeError
+        If importing ``spes.cli`` takes longer than ``max_seconds``, or
+        imports any of :data:`HEAVY_MODULES`.
+    """
+    if commands is None:
+        commands = list(COMMAND_MODULES)
+
+    records = []
+    for command in commands:
+        module = COMMAND_MODULES[command]
+        runtimes = []
+        try:
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                import_time, imported = _import_time(module)
+                runtimes.append((import_time, time.perf_counter() - start))
+        except RuntimeError as err:
+            print(f"Skipping {command}: {str(err).splitlines()[-1]}")
+            continue
+        records.append(
+            {
+                "command": command,
+                "module": module,
+                "import_time": min(runtime[0] for runtime in runtimes),
+                "process_time": min(runtime[1] for runtime in runtimes),
+                "heavy_modules": ",".join(sorted(imported.intersection(HEAVY_MODULES))),
+            }
+        )
+
+    result_df = pd.DataFrame.from_records(records)
+    print(result_df)
+
+    cli = result_df[result_df["module"] == "spes.cli"]
+    if len(cli):
+        cli = cli.iloc[0]
+        if cli["heavy_modules"]:
+            raise RuntimeError(
+                f"spes.cli imports heavy modules at startup: {cli['heavy_modules']}"
+            )
+        if cli["import_time"] > max_seconds:
+            raise RuntimeError(
+                f"spes.cli takes {cli['import_time']:.3f} s to import, "
+                f"more than {max_seconds} s."
+            )
+    return result_df
+
+
+def _resample_in_memory(fpath, new_sfreq, bads):
+    """The former path of ``load_data``: resample, then pick and load."""
+    import mne
+
+    raw = mne.io.read_raw_brainvision(fpath, verbose=False)
+    raw.info["bads"] = list(bads)
+    raw = raw.resample(new_sfreq, n_jobs=-1, verbose=False)
+    raw = raw.pick_types(seeg=True, ecog=True, eeg=True, misc=False, exclude=[])
+    raw.drop_channels(raw.info["bads"])
+    raw.load_data()
+    return raw
+
+
+def _resample_blockwise(fpath, new_sfreq, bads):
+    """The path of ``load_data``: pick, then resample in blocks."""
+    import mne
+
+    from spes.preprocess import resample_blockwise
+
+    raw = mne.io.read_raw_brainvision(fpath, verbose=False)
+    raw.info["bads"] = list(bads)
+    raw = raw.pick_types(seeg=True, ecog=True, eeg=True, misc=False, exclude="bads")
+    return resample_blockwise(raw, new_sfreq)
+
+
+def benchmark_resampling(
+    n_channels=100, n_misc=28, n_bads=8, duration=300.0, sfreq=2000.0, new_sfreq=500.0
+):
+    """Benchmark blockwise polyphase resampling against full-length FFT.
+
+    A BrainVision recording with ``n_channels`` SEEG channels and
+    ``n_misc`` misc channels is written to a temporary folder and resampled
+    from disk by both paths. BrainVision files do not store bad channels,
+    so ``n_bads`` SEEG channels are marked bad after reading, as the
+    ``channels.tsv`` sidecar does in ``load_data``.
+
+    Parameters
+    ----------
+    n_channels : int
+        The number of SEEG channels.
+    n_misc : int
+        The number of misc channels (EKG, DC, triggers, ...).
+    n_bads : int
+        The number of bad SEEG channels.
+    duration : float
+        The duration of the recording in seconds.
+    sfreq, new_sfreq : float
+        The original and resampled sampling frequency.
+
+    Returns
+    -------
+    result_df : pd.DataFrame
+        The runtime and peak traced memory of each path, and the max
+        deviation of the blockwise output from the FFT output, relative to
+        its max, away from the edges.
+    """
+    import mne
+
+    rng = np.random.default_rng(0)
+    n_times = int(duration * sfreq)
+    ch_types = ["seeg"] * n_channels + ["misc"] * n_misc
+    info = mne.create_info(
+        [f"A{idx}" for idx in range(1, n_channels + 1)]
+        + [f"DC{idx}" for idx in range(1, n_misc + 1)],
+        sfreq,
+        ch_types,
+    )
+    bads = info["ch_names"][:n_bads]
+    data = np.cumsum(rng.standard_normal((len(ch_types), n_times)), axis=1) * 1e-6
+    raw = mne.io.RawArray(data, info, verbose=False)
+    del data
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = Path(tmp_dir) / "bench.vhdr"
+        mne.export.export_raw(fpath, raw, verbose=False)
+        del raw
+
+        outputs = dict()
+        for name, resample_fn in (
+            ("fft_in_memory", _resample_in_memory),
+            ("polyphase_blockwise", _resample_blockwise),
+        ):
+            tracemalloc.start()
+            start = time.perf_counter()
+            outputs[name] = resample_fn(fpath, new_sfreq, bads).get_data()
+            runtime = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            records.append(
+                {"path": name, "runtime": runtime, "peak_memory_mb": peak / 1e6}
+            )
+
+    # both are exact up to their anti-aliasing filters, compare the interior
+    edge = int(new_sfreq)
+    reference = outputs["fft_in_memory"][:, edge:-edge]
+    deviation = np.abs(outputs["polyphase_blockwise"][:, edge:-edge] - reference)
+    result_df = pd.DataFrame.from_records(records)
+    result_df["max_rel_deviation"] = float(deviation.max() / np.abs(reference).max())
+    print(result_df)
+    return result_df
+
+
+if __name__ == "__main__":
+    benchmark_startup()
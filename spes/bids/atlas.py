@@ -0,0 +1,217 @@
+"""Anatomical labelling of electrode contacts from atlases.
+
+The coordinates of all contacts in a dataset are read from their
+``electrodes.tsv`` files, looked up in each atlas at once, and each file is
+written once with a column per atlas. The contact coordinates must be in
+the space of the atlases (e.g. MNI), which is not checked.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+from mne_bids.tsv_handler import _from_tsv, _to_tsv
+
+# scaling of the coordsystem.json units to millimeters
+_UNITS_TO_MM = {"m": 1e3, "cm": 10.0, "mm": 1.0}
+
+
+def read_lut(fpath):
+    """Read a FreeSurfer-style color lookup table.
+
+    Parameters
+    ----------
+    fpath : str | Path
+        The text file with ``<id> <name> <r> <g> <b> <a>`` rows, e.g.
+        ``FreeSurferColorLUT.txt``.
+
+    Returns
+    -------
+    labels : dict
+        Mapping of the integer label id to its name.
+    """
+    labels = dict()
+    with open(fpath, "r") as fin:
+        for line in fin:
+            fields = line.split()
+            if len(fields) >= 2 and not line.startswith("#"):
+                labels[int(fields[0])] = fields[1]
+    return labels
+
+
+class VolumeAtlas:
+    """An atlas of integer labels in a NIfTI volume.
+
+    The volume is memory-mapped, so a lookup only reads the voxels of
+    the contacts.
+
+    Parameters
+    ----------
+    fpath : str | Path
+        The uncompressed NIfTI file (``.nii``) of the atlas. Compressed
+        files cannot be memory-mapped and are read whole.
+    labels : dict
+        Mapping of label id to name, e.g. from :func:`read_lut`.
+    """
+
+    def __init__(self, fpath, labels):
+        try:
+            import nibabel as nib
+        except ImportError:
+            raise ImportError("VolumeAtlas requires nibabel, install it first.")
+
+        img = nib.load(str(fpath), mmap=True)
+        self.data = np.asanyarray(img.dataobj)
+        self.affine = img.affine
+        self.labels = labels
+
+    def lookup(self, coords):
+        """Label the voxels of coordinates.
+
+        Parameters
+        ----------
+        coords : np.ndarray, shape (n_contacts, 3)
+            The coordinates in millimeters. Rows with NaN are not labeled.
+
+        Returns
+        -------
+        names : np.ndarray of str, shape (n_contacts,)
+            The label names, ``"n/a"`` outside the volume or for unknown
+            labels.
+        """
+        names = np.full(len(coords), "n/a", dtype=object)
+        inv_affine = np.linalg.inv(self.affine)
+        ijk = coords @ inv_affine[:3, :3].T + inv_affine[:3, 3]
+        valid = np.isfinite(ijk).all(axis=1)
+        ijk = np.round(np.where(valid[:, np.newaxis], ijk, 0)).astype(int)
+        valid &= ((ijk >= 0) & (ijk < self.data.shape[:3])).all(axis=1)
+
+        label_ids = self.data[ijk[valid, 0], ijk[valid, 1], ijk[valid, 2]]
+        names[valid] = [self.labels.get(int(idx), "n/a") for idx in label_ids]
+        return names
+
+
+class CentroidAtlas:
+    """An atlas of parcel centroids, labelled by the nearest centroid.
+
+    Parameters
+    ----------
+    names : list of str
+        The parcel names.
+    centroids : np.ndarray, shape (n_parcels, 3)
+        The parcel centroids in millimeters.
+    max_distance : float | None
+        Contacts further than this (in mm) from every centroid are not
+        labeled.
+    """
+
+    def __init__(self, names, centroids, max_distance=None):
+        from scipy.spatial import cKDTree
+
+        self.names = np.asarray(names, dtype=object)
+        self.tree = cKDTree(np.asarray(centroids, dtype=np.float64))
+        self.max_distance = max_distance
+
+    def lookup(self, coords):
+        """Label coordinates by their nearest centroid, see
+        :meth:`VolumeAtlas.lookup`."""
+        names = np.full(len(coords), "n/a", dtype=object)
+        valid = np.isfinite(coords).all(axis=1)
+        upper_bound = np.inf if self.max_distance is None else self.max_distance
+        _, idx = self.tree.query(coords[valid], distance_upper_bound=upper_bound)
+        # unmatched contacts get the index n_parcels
+        found = idx < len(self.names)
+        valid_idx = np.flatnonzero(valid)
+        names[valid_idx[found]] = self.names[idx[found]]
+        return names
+
+
+def _read_coordinates(electrodes_fpath):
+    """Read the contact coordinates of an ``electrodes.tsv`` in mm."""
+    electrodes_tsv = _from_tsv(electrodes_fpath)
+    coords = np.array(
+        [
+            [
+                np.nan if val in ("n/a", "") else float(val)
+                for val in electrodes_tsv[axis]
+            ]
+            for axis in ("x", "y", "z")
+        ],
+        dtype=np.float64,
+    ).T.reshape(-1, 3)
+
+    # the units are in the coordsystem.json next to it
+    scale = 1.0
+    coordsystem_fpaths = list(Path(electrodes_fpath).parent.glob("*coordsystem.json"))
+    if coordsystem_fpaths:
+        with open(coordsystem_fpaths[0], "r") as fin:
+            units = json.load(fin).get("iEEGCoordinateUnits", "mm")
+        scale = _UNITS_TO_MM.get(units, 1.0)
+    return electrodes_tsv, coords * scale
+
+
+def label_electrodes(bids_root, atlases, subjects=None, overwrite=False):
+    """Label the contacts of every ``electrodes.tsv`` in a dataset.
+
+    Coordinates of all files missing a column are concatenated and looked
+    up in its atlas in one call, and each file is written once with one
+    column per atlas.
+
+    Parameters
+    ----------
+    bids_root : str | Path
+        The root of the BIDS dataset.
+    atlases : dict
+        Mapping of the column name (e.g. the atlas depth ``"destrieux"``)
+        to a :class:`VolumeAtlas` or :class:`CentroidAtlas`.
+    subjects : list of str | None
+        Only label these subjects. Defaults to all.
+    overwrite : bool
+        Whether to overwrite existing atlas columns. If False, only the
+        missing columns of each file are added, and files that already
+        have all columns are skipped.
+
+    Returns
+    -------
+    electrodes_fpaths : list of Path
+        The files that were written.
+    """
+    bids_root = Path(bids_root)
+    subject_dirs = (
+        [bids_root / f"sub-{subject}" for subject in subjects]
+        if subjects is not None
+        else sorted(bids_root.glob("sub-*"))
+    )
+    electrodes_fpaths = [
+        fpath
+        for subject_dir in subject_dirs
+        for fpath in sorted(subject_dir.rglob("*_electrodes.tsv"))
+    ]
+
+    tables = []
+    for fpath in electrodes_fpaths:
+        electrodes_tsv, file_coords = _read_coordinates(fpath)
+        columns = [
+            column for column in atlases if overwrite or column not in electrodes_tsv
+        ]
+        if columns:
+            tables.append((fpath, electrodes_tsv, file_coords, columns))
+    if not tables:
+        return []
+
+    # one lookup per atlas over all contacts of the files missing its column
+    for column, atlas in atlases.items():
+        to_label = [table for table in tables if column in table[3]]
+        if not to_label:
+            continue
+        coords = np.concatenate([file_coords for _, _, file_coords, _ in to_label])
+        splits = np.cumsum([len(file_coords) for _, _, file_coords, _ in to_label])
+        labels = np.split(atlas.lookup(coords), splits[:-1])
+        for (_, electrodes_tsv, _, _), file_labels in zip(to_label, labels):
+            electrodes_tsv[column] = list(file_labels)
+
+    for fpath, electrodes_tsv, _, _ in tables:
+        _to_tsv(electrodes_tsv, fpath)
+    n_contacts = sum(len(file_coords) for _, _, file_coords, _ in tables)
+    print(f"Labeled {n_contacts} contacts in {len(tables)} electrodes.tsv files.")
+    return [fpath for fpath, _, _, _ in tables]
@@ -0,0 +1,380 @@
+"""Signal-based detection of bad channels.
+
+Each recording is read once, block by block, and per-channel statistics
+are accumulated across all channels at once:
+
+- the variance of the signal;
+- the power at the power line frequency and its harmonics, relative to
+  the neighboring frequencies;
+- the fraction of power above ``hf_freq``;
+- the correlation of the first differences of neighboring contacts on the
+  same electrode, so slow drifts do not dominate it.
+
+Channels are then compared against the other channels of the recording
+with robust z-scores and labeled with a
+:class:`spes.bids.utils.BadChannelDescription`.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from mne import pick_types
+
+from spes.bids.sidecars import SidecarTransaction
+from spes.bids.utils import BadChannelDescription, _group_channels_by_shaft
+from spes.preprocess import _contact_number
+
+
+def _neighbor_pairs(ch_names):
+    """Index pairs of adjacent contacts on the same electrode."""
+    pairs = []
+    for indices in _group_channels_by_shaft(ch_names).values():
+        # files do not always list the contacts of an electrode in order
+        indices = sorted(indices, key=lambda idx: _contact_number(ch_names[idx]))
+        pairs.extend(zip(indices[:-1], indices[1:]))
+    return np.array(pairs, dtype=int).reshape(-1, 2)
+
+
+def _robust_zscore(values):
+    if not np.isfinite(values).any():
+        return np.zeros_like(values)
+    median = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median))
+    if not mad > 0:
+        return np.zeros_like(values)
+    return (values - median) / mad
+
+
+class ChannelStatistics:
+    """Accumulate per-channel statistics over blocks of a recording.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The channel names, used to find neighboring contacts.
+    sfreq : float
+        The sampling frequency.
+    line_freq : float | None
+        The power line frequency. Its harmonics up to Nyquist are used. If
+        None, the ``line_ratio`` of all channels is NaN.
+    hf_freq : float
+        The frequency above which power counts as high-frequency. Clipped
+        to 80% of Nyquist.
+    n_fft : int | None
+        The length of the segments spectra are averaged over. Defaults to
+        one second of samples.
+    """
+
+    def __init__(self, ch_names, sfreq, line_freq=60.0, hf_freq=200.0, n_fft=None):
+        self.ch_names = list(ch_names)
+        self.sfreq = sfreq
+        self.n_fft = int(sfreq) if n_fft is None else n_fft
+        self._window = np.hanning(self.n_fft)
+
+        freqs = np.fft.rfftfreq(self.n_fft, 1.0 / sfreq)
+        # line noise is compared to the neighboring frequencies, so
+        # broadband noise does not count as line noise
+        self._line_mask = np.zeros(freqs.size, dtype=bool)
+        self._flank_mask = np.zeros(freqs.size, dtype=bool)
+        if line_freq is not None:
+            for harmonic in np.arange(line_freq, sfreq / 2, line_freq):
+                distance = np.abs(freqs - harmonic)
+                self._line_mask |= distance <= 1.0
+                self._flank_mask |= (distance >= 2.0) & (distance <= 5.0)
+        self._hf_mask = freqs > min(hf_freq, 0.8 * sfreq / 2)
+        # ignore the DC bin, so offsets do not dilute the power ratios
+        self._power_mask = freqs > 0
+
+        n_chs = len(self.ch_names)
+        self.pairs = _neighbor_pairs(self.ch_names)
+        self.n_samples = 0
+        self._mean = np.zeros(n_chs)
+        self._m2 = np.zeros(n_chs)
+        self._psd = np.zeros((n_chs, freqs.size))
+        self._n_segments = 0
+        self._n_diffs = 0
+        self._diff_sum = np.zeros(n_chs)
+        self._diff_sumsq = np.zeros(n_chs)
+        self._diff_cross = np.zeros(len(self.pairs))
+        self._last = None
+
+    def update(self, block):
+        """Add a block of samples.
+
+        Parameters
+        ----------
+        block : np.ndarray, shape (n_channels, n_samples)
+            The next samples of the recording.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        n = block.shape[1]
+        if n == 0:
+            return
+
+        # merge the block's mean and variance (Chan et al.)
+        block_mean = block.mean(axis=1)
+        block_m2 = ((block - block_mean[:, np.newaxis]) ** 2).sum(axis=1)
+        total = self.n_samples + n
+        delta = block_mean - self._mean
+        self._mean += delta * n / total
+        self._m2 += block_m2 + delta**2 * self.n_samples * n / total
+        self.n_samples = total
+
+        # averaged spectra of the full segments in the block
+        n_segments = n // self.n_fft
+        if n_segments:
+            segments = block[:, : n_segments * self.n_fft].reshape(
+                block.shape[0], n_segments, self.n_fft
+            )
+            segments = segments - segments.mean(axis=2, keepdims=True)
+            spectra = np.abs(np.fft.rfft(segments * self._window, axis=2)) ** 2
+            self._psd += spectra.sum(axis=1)
+            self._n_segments += n_segments
+
+        # first differences, continued across blocks
+        if self._last is not None:
+            block = np.concatenate([self._last, block], axis=1)
+        self._last = block[:, -1:]
+        diffs = np.diff(block, axis=1)
+        self._n_diffs += diffs.shape[1]
+        self._diff_sum += diffs.sum(axis=1)
+        self._diff_sumsq += (diffs**2).sum(axis=1)
+        if len(self.pairs):
+            self._diff_cross += np.einsum(
+                "pt,pt->p", diffs[self.pairs[:, 0]], diffs[self.pairs[:, 1]]
+            )
+
+    def compute(self):
+        """Compute the statistics of all blocks added so far.
+
+        Returns
+        -------
+        stats : pd.DataFrame
+            One row per channel, with its ``variance``, ``line_ratio`` (the
+            mean power at line frequencies over the mean power 2 to 5 Hz
+            next to them), ``hf_ratio`` (the fraction of power above
+            ``hf_freq``) and ``neighbor_corr``, the largest correlation to
+            a neighboring contact (NaN for channels without neighbors).
+        """
+        variance = self._m2 / max(self.n_samples - 1, 1)
+
+        total_power = self._psd[:, self._power_mask].sum(axis=1)
+        line_ratio = np.full(len(self.ch_names), np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self._line_mask.any():
+                line_ratio = self._psd[:, self._line_mask].mean(
+                    axis=1
+                ) / self._psd[:, self._flank_mask].mean(axis=1)
+            hf_ratio = self._psd[:, self._hf_mask].sum(axis=1) / total_power
+
+            n = max(self._n_diffs, 1)
+            diff_mean = self._diff_sum / n
+            diff_std = np.sqrt(np.maximum(self._diff_sumsq / n - diff_mean**2, 0))
+            neighbor_corr = np.full(len(self.ch_names), np.nan)
+            if len(self.pairs):
+                left, right = self.pairs[:, 0], self.pairs[:, 1]
+                corr = (self._diff_cross / n - diff_mean[left] * diff_mean[right]) / (
+                    diff_std[left] * diff_std[right]
+                )
+                # the best neighbor of each channel
+                np.fmax.at(neighbor_corr, left, corr)
+                np.fmax.at(neighbor_corr, right, corr)
+
+        return pd.DataFrame(
+            {
+                "name": self.ch_names,
+                "variance": variance,
+                "line_ratio": line_ratio,
+                "hf_ratio": hf_ratio,
+                "neighbor_corr": neighbor_corr,
+            }
+        )
+
+
+def label_bad_channels(
+    stats,
+    flat_variance=1e-18,
+    z_threshold=5.0,
+    min_neighbor_corr=0.1,
+):
+    """Label bad channels from their statistics.
+
+    Thresholds are robust z-scores against the other channels of the
+    recording, except for the absolute limits.
+
+    - ``flat-signal``: variance below ``flat_variance`` (V^2), or a log
+      variance ``z_threshold`` below the others.
+    - ``disconnected-from-brain``: a line noise ratio ``z_threshold``
+      above the others, or a correlation to all neighbors below
+      ``min_neighbor_corr`` and ``z_threshold`` below the others. High
+      impedance contacts pick up line noise and lose the signal they share
+      with their neighbors.
+    - ``high-freq-noise``: a high-frequency power ratio ``z_threshold``
+      above the others.
+
+    Parameters
+    ----------
+    stats : pd.DataFrame
+        The statistics of :meth:`ChannelStatistics.compute`.
+    flat_variance : float
+        The variance below which a channel is flat.
+    z_threshold : float
+        The robust z-score above which a channel is an outlier.
+    min_neighbor_corr : float
+        The neighbor correlation below which a channel is disconnected.
+
+    Returns
+    -------
+    stats : pd.DataFrame
+        A copy of ``stats`` with a ``description`` column, the label of
+        bad channels and None for good ones.
+    """
+    stats = stats.copy()
+    with np.errstate(divide="ignore"):
+        log_variance = np.log(stats["variance"].to_numpy())
+    flat = (stats["variance"].to_numpy() < flat_variance) | (
+        _robust_zscore(np.where(np.isfinite(log_variance), log_variance, np.nan))
+        < -z_threshold
+    )
+    line_noise = _robust_zscore(stats["line_ratio"].to_numpy()) > z_threshold
+    neighbor_corr = stats["neighbor_corr"].to_numpy()
+    uncorrelated = (neighbor_corr < min_neighbor_corr) & (
+        _robust_zscore(neighbor_corr) < -z_threshold
+    )
+    high_freq = _robust_zscore(stats["hf_ratio"].to_numpy()) > z_threshold
+
+    # later labels take precedence; high-frequency noise alone also
+    # decorrelates a channel from its neighbors
+    description = np.full(len(stats), None, dtype=object)
+    description[uncorrelated] = BadChannelDescription.DISCONNECTED.value
+    description[high_freq] = BadChannelDescription.HIGHFREQ.value
+    description[line_noise] = BadChannelDescription.DISCONNECTED.value
+    description[flat] = BadChannelDescription.FLAT.value
+    stats["description"] = description
+    return stats
+
+
+def compute_channel_statistics(raw, block_duration=10.0, hf_freq=200.0):
+    """Stream a recording once and compute its per-channel statistics.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The recording, preferably not preloaded, so each block is read
+        from disk once.
+    block_duration : float
+        The duration of each block in seconds.
+    hf_freq : float
+        See :class:`ChannelStatistics`.
+
+    Returns
+    -------
+    stats : pd.DataFrame
+        See :meth:`ChannelStatistics.compute`.
+    """
+    picks = pick_types(raw.info, seeg=True, ecog=True, eeg=True, exclude=[])
+    ch_names = [raw.ch_names[idx] for idx in picks]
+    sfreq = raw.info["sfreq"]
+    accumulator = ChannelStatistics(
+        ch_names, sfreq, line_freq=raw.info["line_freq"], hf_freq=hf_freq
+    )
+    # a whole number of spectral segments per block
+    block_size = max(1, int(block_duration * sfreq) // accumulator.n_fft)
+    block_size *= accumulator.n_fft
+    for start in range(0, raw.n_times, block_size):
+        stop = min(start + block_size, raw.n_times)
+        accumulator.update(raw.get_data(picks=picks, start=start, stop=stop))
+    return accumulator.compute()
+
+
+def write_bad_channels(bids_path, stats):
+    """Mark bad channels in the ``channels.tsv`` of a recording.
+
+    The file is written once, through a
+    :class:`spes.bids.sidecars.SidecarTransaction`, so it is never left
+    partially written. Channels that are already bad keep their status and
+    description.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording whose ``channels.tsv`` to update.
+    stats : pd.DataFrame
+        The labels of :func:`label_bad_channels`.
+
+    Returns
+    -------
+    bads : list of str
+        The channels newly marked bad.
+    """
+    with SidecarTransaction(bids_path) as sidecars:
+        channels_tsv = sidecars.read_tsv("channels")
+        n_rows = len(channels_tsv["name"])
+        status = list(channels_tsv.get("status", ["good"] * n_rows))
+        status_description = list(
+            channels_tsv.get("status_description", ["n/a"] * n_rows)
+        )
+
+        labels = dict(zip(stats["name"], stats["description"]))
+        bads = []
+        for idx, ch_name in enumerate(channels_tsv["name"]):
+            description = labels.get(ch_name)
+            if pd.isna(description) or status[idx] == "bad":
+                continue
+            status[idx] = "bad"
+            status_description[idx] = description
+            bads.append(ch_name)
+
+        if bads:
+            sidecars.set_tsv_column("channels", "status", status)
+            sidecars.set_tsv_column(
+                "channels", "status_description", status_description
+            )
+        else:
+            sidecars.rollback()
+    return bads
+
+
+def _screen_recording(bids_path, write, block_duration, label_kws):
+    from mne_bids import read_raw_bids
+
+    raw = read_raw_bids(bids_path, verbose=False)
+    stats = label_bad_channels(
+        compute_channel_statistics(raw, block_duration=block_duration), **label_kws
+    )
+    if write:
+        bads = write_bad_channels(bids_path, stats)
+        print(f"Marked {len(bads)} bad channels of {bids_path.basename}: {bads}")
+    stats.insert(0, "recording", bids_path.basename)
+    return stats
+
+
+def screen_bad_channels(
+    bids_paths, write=True, block_duration=10.0, n_jobs=1, **label_kws
+):
+    """Detect bad channels across recordings from their signals.
+
+    Parameters
+    ----------
+    bids_paths : list of mne_bids.BIDSPath
+        The recordings to screen.
+    write : bool
+        Whether to mark the bad channels in each recording's
+        ``channels.tsv``.
+    block_duration : float
+        The duration in seconds of the blocks each recording is read in.
+    n_jobs : int
+        The number of recordings screened in parallel.
+    **label_kws
+        Keyword arguments passed to :func:`label_bad_channels`.
+
+    Returns
+    -------
+    stats : pd.DataFrame
+        The statistics and label of every channel of every recording.
+    """
+    stats = Parallel(n_jobs=n_jobs)(
+        delayed(_screen_recording)(bids_path, write, block_duration, label_kws)
+        for bids_path in bids_paths
+    )
+    return pd.concat(stats, ignore_index=True)
@@ -0,0 +1,285 @@
+import json
+import os
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+import numpy as np
+from mne_bids.path import _find_matching_sidecar
+from mne_bids.tsv_handler import _from_tsv
+
+# event descriptions that mark the onset of a seizure
+SEIZURE_ONSET_EVENTS = ("eeg sz onset", "sz onset", "sz event")
+
+# event descriptions that mark the offset of a seizure
+SEIZURE_OFFSET_EVENTS = ("eeg sz offset", "sz offset")
+
+
+def _to_float_array(values):
+    return np.array(
+        [np.nan if val in ("n/a", "", None) else float(val) for val in values],
+        dtype=np.float64,
+    )
+
+
+def _lower_array(values):
+    return np.char.lower(np.array(values, dtype=str))
+
+
+class RecordingMetadata:
+    """Typed arrays parsed from the sidecar files of one recording.
+
+    The ``events.tsv``, ``channels.tsv`` and ``electrodes.tsv`` sidecars
+    are parsed once into numpy arrays, so lookups (e.g. "which channels
+    were resected", "when did the seizure start") are vectorized mask and
+    index operations.
+
+    Use :func:`read_recording_metadata` to construct it, which caches the
+    parsed result per set of sidecar files.
+
+    Attributes
+    ----------
+    ch_names : np.ndarray of str, shape (n_channels,)
+    ch_types : np.ndarray of str, shape (n_channels,)
+    bad_mask : np.ndarray of bool, shape (n_channels,)
+        Channels with ``status`` "bad".
+    resected_mask : np.ndarray of bool, shape (n_channels,)
+        Channels with ``description`` "resected".
+    soz_mask : np.ndarray of bool, shape (n_channels,)
+        Channels with a "soz" description, or ``clinical_grouping`` of 1.
+    event_onsets : np.ndarray of float, shape (n_events,)
+        Event onsets in seconds from the start of the recording.
+    event_durations : np.ndarray of float, shape (n_events,)
+    event_labels : np.ndarray of str, shape (n_labels,)
+        The unique lower-cased ``trial_type`` values.
+    event_codes : np.ndarray of int, shape (n_events,)
+        Index of each event's ``trial_type`` into ``event_labels``.
+    elec_names : np.ndarray of str, shape (n_electrodes,)
+    elec_coords : np.ndarray of float, shape (n_electrodes, 3)
+        Electrode coordinates, with NaN where they are "n/a".
+    sfreq : float | None
+        The sampling frequency in the recording's JSON sidecar.
+    """
+
+    def __init__(
+        self,
+        channels_tsv=None,
+        events_tsv=None,
+        electrodes_tsv=None,
+        sidecar_json=None,
+    ):
+        channels_tsv = channels_tsv or dict()
+        events_tsv = events_tsv or dict()
+        electrodes_tsv = electrodes_tsv or dict()
+        sidecar_json = sidecar_json or dict()
+
+        # channels
+        self.ch_names = np.array(channels_tsv.get("name", []), dtype=str)
+        n_chs = len(self.ch_names)
+        self.ch_types = _lower_array(channels_tsv.get("type", ["n/a"] * n_chs))
+        status = _lower_array(channels_tsv.get("status", ["good"] * n_chs))
+        description = _lower_array(channels_tsv.get("description", ["n/a"] * n_chs))
+        self.bad_mask = status == "bad"
+        self.resected_mask = description == "resected"
+        self.soz_mask = np.char.find(description, "soz") >= 0
+        if "clinical_grouping" in channels_tsv:
+            grouping = _to_float_array(channels_tsv["clinical_grouping"])
+            self.soz_mask |= grouping == 1
+
+        # events
+        self.event_onsets = _to_float_array(events_tsv.get("onset", []))
+        n_events = len(self.event_onsets)
+        self.event_durations = _to_float_array(
+            events_tsv.get("duration", ["n/a"] * n_events)
+        )
+        trial_types = _lower_array(events_tsv.get("trial_type", ["n/a"] * n_events))
+        self.event_labels, self.event_codes = np.unique(
+            trial_types, return_inverse=True
+        )
+        self.event_codes = self.event_codes.reshape(-1)
+
+        # electrodes
+        self.elec_names = np.array(electrodes_tsv.get("name", []), dtype=str)
+        n_elecs = len(self.elec_names)
+        self.elec_coords = np.column_stack(
+            [
+                _to_float_array(electrodes_tsv.get(axis, ["n/a"] * n_elecs))
+                for axis in ("x", "y", "z")
+            ]
+        ).reshape(n_elecs, 3)
+
+        self.sfreq = sidecar_json.get("SamplingFrequency")
+
+    def __repr__(self):
+        return (
+            f"<RecordingMetadata | {len(self.ch_names)} channels, "
+            f"{len(self.event_onsets)} events, {len(self.elec_names)} electrodes>"
+        )
+
+    @property
+    def resected_chs(self) -> List[str]:
+        return self.ch_names[self.resected_mask].tolist()
+
+    @property
+    def soz_chs(self) -> List[str]:
+        return self.ch_names[self.soz_mask].tolist()
+
+    @property
+    def bad_chs(self) -> List[str]:
+        return self.ch_names[self.bad_mask].tolist()
+
+    def align_mask(self, mask: np.ndarray, ch_names: Sequence[str]) -> np.ndarray:
+        """Reorder a channel mask to match another list of channel names.
+
+        Channels in ``ch_names`` that are not in ``channels.tsv`` are False.
+
+        Parameters
+        ----------
+        mask : np.ndarray of bool, shape (n_channels,)
+            A mask over ``self.ch_names``, e.g. ``self.resected_mask``.
+        ch_names : list of str
+            The channel order to align to, e.g. the rows of a derivative.
+
+        Returns
+        -------
+        aligned : np.ndarray of bool, shape (len(ch_names),)
+        """
+        ch_index = {ch: idx for idx, ch in enumerate(self.ch_names)}
+        idx = np.array([ch_index.get(ch, -1) for ch in ch_names], dtype=np.int64)
+        aligned = np.zeros(len(idx), dtype=bool)
+        aligned[idx >= 0] = mask[idx[idx >= 0]]
+        return aligned
+
+    def get_event_onsets(self, descriptions: Sequence[str]) -> np.ndarray:
+        """Get the onsets (in seconds) of events with any of ``descriptions``.
+
+        Matching is case-insensitive on the ``trial_type`` column.
+        """
+        descriptions = [desc.lower() for desc in descriptions]
+        codes = np.flatnonzero(np.isin(self.event_labels, descriptions))
+        return self.event_onsets[np.isin(self.event_codes, codes)]
+
+    def get_event_samples(
+        self, descriptions: Sequence[str], sfreq: Optional[float] = None
+    ) -> np.ndarray:
+        """Get the onsets (in samples) of events with any of ``descriptions``.
+
+        Parameters
+        ----------
+        descriptions : list of str
+            The ``trial_type`` values to look for.
+        sfreq : float | None
+            The sampling frequency to convert onsets with, e.g. after
+            resampling. Defaults to the sampling frequency of the recording.
+
+        Returns
+        -------
+        samples : np.ndarray of int
+        """
+        if sfreq is None:
+            sfreq = self.sfreq
+        if sfreq is None:
+            raise RuntimeError(
+                "Sampling frequency is not in the sidecar JSON, "
+                "please pass in sfreq."
+            )
+        onsets = self.get_event_onsets(descriptions)
+        return np.round(onsets * sfreq).astype(np.int64)
+
+    def get_event_spans(
+        self,
+        descriptions: Sequence[str],
+        pre_seconds: float,
+        post_seconds: float,
+        duration: Optional[float] = None,
+    ) -> List[tuple]:
+        """Get the time spans around events with any of ``descriptions``.
+
+        Parameters
+        ----------
+        descriptions : list of str
+            The ``trial_type`` values to look for.
+        pre_seconds : float
+            The duration before each event to include.
+        post_seconds : float
+            The duration after each event to include.
+        duration : float | None
+            The duration of the recording, to clip the spans to.
+
+        Returns
+        -------
+        spans : list of tuple of float
+            The sorted ``(tmin, tmax)`` spans in seconds, with overlapping
+            spans merged.
+        """
+        onsets = np.sort(self.get_event_onsets(descriptions))
+        tmins = np.maximum(onsets - pre_seconds, 0)
+        tmaxs = onsets + post_seconds
+        if duration is not None:
+            tmaxs = np.minimum(tmaxs, duration)
+
+        spans = []
+        for tmin, tmax in zip(tmins, tmaxs):
+            if spans and tmin <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], float(tmax)))
+            else:
+                spans.append((float(tmin), float(tmax)))
+        return spans
+
+
+def _mtime(fpath):
+    if fpath is None:
+        return None
+    return os.path.getmtime(fpath)
+
+
+@lru_cache(maxsize=256)
+def _read_recording_metadata(
+    channels_fpath, events_fpath, electrodes_fpath, json_fpath, mtimes
+):
+    # ``mtimes`` is only part of the cache key, so edited sidecars are re-read
+    channels_tsv = _from_tsv(channels_fpath) if channels_fpath else None
+    events_tsv = _from_tsv(events_fpath) if events_fpath else None
+    electrodes_tsv = _from_tsv(electrodes_fpath) if electrodes_fpath else None
+    sidecar_json = None
+    if json_fpath:
+        with open(json_fpath, "r") as fin:
+            sidecar_json = json.load(fin)
+    return RecordingMetadata(
+        channels_tsv=channels_tsv,
+        events_tsv=events_tsv,
+        electrodes_tsv=electrodes_tsv,
+        sidecar_json=sidecar_json,
+    )
+
+
+def read_recording_metadata(bids_path) -> RecordingMetadata:
+    """Read the sidecar metadata of a recording.
+
+    The result is cached per set of sidecar files and their modification
+    times, so the fragility, plotting and summary code can all call this
+    without re-parsing the same files.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The path of the recording, or of any of its sidecars.
+
+    Returns
+    -------
+    metadata : RecordingMetadata
+    """
+    datatype = bids_path.datatype or "ieeg"
+    fpaths = []
+    for suffix, extension in [
+        ("channels", ".tsv"),
+        ("events", ".tsv"),
+        ("electrodes", ".tsv"),
+        (datatype, ".json"),
+    ]:
+        fpath = _find_matching_sidecar(
+            bids_path, suffix=suffix, extension=extension, on_error="ignore"
+        )
+        fpaths.append(str(fpath) if fpath is not None else None)
+
+    mtimes = tuple(_mtime(fpath) for fpath in fpaths)
+    return _read_recording_metadata(*fpaths, mtimes)
@@ -8,7 +8,7 @@ from eztrack.preprocess.bids_conversion import (
     append_original_fname_to_scans,
 )
 from mne.io import read_raw_edf
-from mne_bids import write_raw_bids, read_raw_bids, get_anonymization_daysback
+from mne_bids import write_raw_bids, get_anonymization_daysback
 from mne_bids.path import BIDSPath, _find_matching_sidecar
 from natsort import natsorted
 
@@ -20,6 +20,8 @@ from spes.bids.utils import (
     _look_for_bad_channels,
     _channel_text_scrub,
 )
+from spes.bids.verify import verify_bids_dataset
+from spes.jobqueue import submit_conversion_jobs
 
 
 def write_edf_to_bids(
@@ -121,17 +123,26 @@ def write_edf_to_bids(
     return status_dict
 
 
-def convert_jhu_dataset():
-    WORKSTATION = "home"
+def convert_jhu_dataset(bids_root=None, source_dir=None, overwrite=True, queue=None):
+    """Convert the JHU EDF files in ``<source_dir>/PY*/Sz_*.edf`` to BIDS.
 
-    if WORKSTATION == "home":
-        # bids root to write BIDS data to
-        bids_root = Path("/Users/adam2392/Johns Hopkins/Rachel Smith - Ictal Clips/")
-        source_dir = bids_root / "sourcedata"
+    ``bids_root`` defaults to the dataset on the ``WORKSTATION`` and
+    ``source_dir`` to ``<bids_root>/sourcedata``. If ``queue`` is set,
+    conversion jobs are submitted to it instead of run here.
+    """
+    if bids_root is None:
+        WORKSTATION = "home"
 
-    elif WORKSTATION == "lab":
-        bids_root = Path("/home/adam2392/hdd2/epilepsy_bids/")
-        source_dir = Path("/home/adam2392/hdd2/epilepsy_bids/sourcedata")
+        if WORKSTATION == "home":
+            # bids root to write BIDS data to
+            bids_root = Path("/Users/adam2392/Johns Hopkins/Rachel Smith - Ictal Clips/")
+
+        elif WORKSTATION == "lab":
+            bids_root = Path("/home/adam2392/hdd2/epilepsy_bids/")
+    bids_root = Path(bids_root)
+    if source_dir is None:
+        source_dir = bids_root / "sourcedata"
+    source_dir = Path(source_dir)
 
     # define BIDS identifiers
     modality = "seeg"
@@ -139,7 +150,6 @@ def convert_jhu_dataset():
     session = 'extraoperative'
     datatype = "ieeg"
     line_freq = 60
-    overwrite = True
     verbose = True
 
     ignore_subjects = [
@@ -154,6 +164,7 @@ def convert_jhu_dataset():
     participants_json_fname = os.path.join(bids_root, "participants.json")
     participants_tsv_fname = os.path.join(bids_root, "participants.tsv")
 
+    queue_runs = []
     # for subject in subject_ids:
     #     add_data_to_participants(subject, bids_root)
     #
@@ -183,6 +194,12 @@ def convert_jhu_dataset():
             }
             print(bids_kwargs)
 
+            # with a job queue, the files are converted by ``run_worker``
+            # processes on any node that mounts the dataset
+            if queue is not None:
+                queue_runs.append({"edf_fpath": fpath, "bids_kwargs": bids_kwargs})
+                continue
+
             # run main bids conversion
             output_dict = write_edf_to_bids(
                 edf_fpath=fpath,
@@ -198,9 +215,22 @@ def convert_jhu_dataset():
             # append scans original filenames
             append_original_fname_to_scans(fpath.name, bids_root, bids_fname)
 
-            bids_path = BIDSPath(**bids_kwargs, root=bids_root)
-            print(bids_path.fpath)
-            raw = read_raw_bids(bids_path)
+    # check the converted headers and sidecars, without reading any data
+    if queue is None:
+        problems_df = verify_bids_dataset(bids_root, subjects=subject_ids)
+        if len(problems_df):
+            print(problems_df.to_string())
+    else:
+        job_ids = submit_conversion_jobs(
+            queue,
+            queue_runs,
+            bids_root,
+            line_freq=line_freq,
+            dataset_name="jhu",
+            source_dir=str(source_dir),
+            overwrite=overwrite,
+        )
+        print(f"Submitted {len(job_ids)} conversion jobs to {queue}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+"""Transactional edits of the sidecar files of one BIDS recording."""
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from mne_bids.tsv_handler import _from_tsv, _to_tsv
+
+
+def _tsv_value(val):
+    """The text of a value in a ``.tsv`` sidecar, ``n/a`` if missing."""
+    if val is None or (isinstance(val, (float, np.floating)) and np.isnan(val)):
+        return "n/a"
+    return str(val)
+
+
+class SidecarTransaction:
+    """Collect the sidecar edits of a recording and write each file once.
+
+    Each sidecar (e.g. ``events.tsv``, ``channels.json``) is read at most
+    once, edited in memory, and written at :meth:`commit` to a temporary
+    file that is atomically moved over the original. If the transaction
+    is used as a context manager, it commits when the block succeeds and
+    discards the edits when it raises, so a failed conversion does not
+    leave some sidecars updated and others not. The files are moved one
+    by one, so a failure during the moves themselves (e.g. a full or
+    unavailable filesystem) can still leave some of them updated.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording. Sidecars are found by updating its ``suffix`` and
+        ``extension``.
+
+    Examples
+    --------
+    >>> with SidecarTransaction(bids_path) as sidecars:
+    ...     sidecars.set_tsv_column("channels", "clinical_grouping", labels)
+    ...     sidecars.update_json("channels", {"clinical_grouping": {...}})
+    """
+
+    def __init__(self, bids_path):
+        self.bids_path = bids_path
+        self._tsvs = dict()
+        self._jsons = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def fpath(self, suffix, extension):
+        """The path of a sidecar of the recording."""
+        return Path(
+            self.bids_path.copy().update(suffix=suffix, extension=extension).fpath
+        )
+
+    def exists(self, suffix, extension=".tsv"):
+        """Whether a sidecar exists on disk or in the transaction."""
+        tables = self._tsvs if extension == ".tsv" else self._jsons
+        return suffix in tables or self.fpath(suffix, extension).exists()
+
+    def read_tsv(self, suffix):
+        """The table of a ``.tsv`` sidecar, as edited in this transaction."""
+        if suffix not in self._tsvs:
+            self._tsvs[suffix] = _from_tsv(self.fpath(suffix, ".tsv"))
+        return self._tsvs[suffix]
+
+    def read_json(self, suffix):
+        """The content of a ``.json`` sidecar, as edited in this transaction.
+
+        A sidecar that does not exist yet starts empty.
+        """
+        if suffix not in self._jsons:
+            fpath = self.fpath(suffix, ".json")
+            content = dict()
+            if fpath.exists():
+                with open(fpath, "r") as fin:
+                    content = json.load(fin)
+            self._jsons[suffix] = content
+        return self._jsons[suffix]
+
+    def set_tsv_column(self, suffix, column, values):
+        """Set a column of a ``.tsv`` sidecar.
+
+        Parameters
+        ----------
+        suffix : str
+            The sidecar, e.g. ``"events"`` or ``"channels"``.
+        column : str
+            The column to set, added if it does not exist.
+        values : object | list
+            One value per row, or a single value for all rows. Missing
+            values (None or NaN) are written as ``n/a``.
+        """
+        table = self.read_tsv(suffix)
+        n_rows = len(next(iter(table.values()), []))
+        if isinstance(values, str) or not hasattr(values, "__len__"):
+            values = [values] * n_rows
+        if len(values) != n_rows:
+            raise ValueError(
+                f"{column} has {len(values)} values, but {suffix}.tsv of "
+                f"{self.bids_path.basename} has {n_rows} rows."
+            )
+        table[column] = [_tsv_value(val) for val in values]
+
+    def update_json(self, suffix, entries):
+        """Add or replace top-level entries of a ``.json`` sidecar."""
+        self.read_json(suffix).update(entries)
+
+    def commit(self):
+        """Write every edited sidecar once, each with an atomic rename.
+
+        All files are written to temporary files before any is moved, so
+        a failure while writing leaves every sidecar unchanged. The moves
+        are atomic per file only.
+
+        Returns
+        -------
+        fpaths : list of Path
+            The written files.
+        """
+        fpaths = []
+        staged = []
+        try:
+            for suffix, table in self._tsvs.items():
+                fpath = self.fpath(suffix, ".tsv")
+                tmp_fpath = fpath.with_name(f".{fpath.name}.tmp")
+                staged.append((tmp_fpath, fpath))
+                _to_tsv(table, tmp_fpath)
+            for suffix, content in self._jsons.items():
+                fpath = self.fpath(suffix, ".json")
+                tmp_fpath = fpath.with_name(f".{fpath.name}.tmp")
+                staged.append((tmp_fpath, fpath))
+                with open(tmp_fpath, "w", encoding="utf-8") as fout:
+                    json.dump(content, fout, indent=4, ensure_ascii=False)
+                    fout.write("\n")
+        except Exception:
+            for tmp_fpath, _ in staged:
+                tmp_fpath.unlink(missing_ok=True)
+            raise
+
+        # all files are staged, so only the renames remain
+        for tmp_fpath, fpath in staged:
+            os.replace(tmp_fpath, fpath)
+            fpaths.append(fpath)
+        self.rollback()
+        return fpaths
+
+    def rollback(self):
+        """Discard the edits of the transaction."""
+        self._tsvs.clear()
+        self._jsons.clear()
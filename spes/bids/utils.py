@@ -2,28 +2,26 @@ import re
 from enum import Enum
 
 import mne
-import numpy as np
-import pandas as pd
 from mne.utils import warn
 from mne_bids.path import _parse_ext, BIDSPath
 from mne_bids.tsv_handler import _from_tsv, _to_tsv
 from typing import Union, List, Dict
 
+from spes.bids.metadata import read_recording_metadata
+
 MINIMAL_BIDS_ENTITIES = ("subject", "session", "task", "acquisition", "run", "datatype")
 
 
 def _update_electrodes_tsv(electrodes_tsv_fpath, elec_labels_anat, atlas_depth):
     electrodes_tsv = _from_tsv(electrodes_tsv_fpath)
 
-    ch_names = np.array(electrodes_tsv["name"])
-    if atlas_depth not in electrodes_tsv.keys():
-        electrodes_tsv[atlas_depth] = ["n/a"] * len(ch_names)
-
-    for ch_name, label in elec_labels_anat.items():
-        idx = int(np.argwhere(ch_names == ch_name))
-        electrodes_tsv[atlas_depth][idx] = elec_labels_anat[ch_name]
+    # keep existing labels of channels that are not relabeled
+    labels = electrodes_tsv.get(atlas_depth, ["n/a"] * len(electrodes_tsv["name"]))
+    electrodes_tsv[atlas_depth] = [
+        elec_labels_anat.get(ch_name, label)
+        for ch_name, label in zip(electrodes_tsv["name"], labels)
+    ]
 
-    print(electrodes_tsv)
     _to_tsv(electrodes_tsv, electrodes_tsv_fpath)
 
     return electrodes_tsv
@@ -36,14 +34,8 @@ def get_resected_chs(subject, root):
     ch_fpaths = bids_path.match()
 
     # read in sidecar channels.tsv
-    channels_pd = pd.read_csv(ch_fpaths[0], sep="\t")
-    description_chs = pd.Series(
-        channels_pd.description.values, index=channels_pd.name
-    ).to_dict()
-    resected_chs = [
-        ch for ch, description in description_chs.items() if description == "resected"
-    ]
-    return resected_chs
+    metadata = read_recording_metadata(ch_fpaths[0])
+    return metadata.resected_chs
 
 
 class ChannelMarkers(Enum):
@@ -68,7 +60,7 @@ class ChannelMarkers(Enum):
 
 
 class BadChannelDescription(Enum):
-    FLAT = ("flat-signal",)
+    FLAT = "flat-signal"
     HIGHFREQ = "high-freq-noise"
     REFERENCE = "reference"
     DISCONNECTED = "disconnected-from-brain"
@@ -272,3 +264,32 @@ def _channel_text_scrub(raw: mne.io.BaseRaw) -> mne.io.BaseRaw:
     raw = raw.rename_channels(lambda x: _reformatchanlabel(x))
 
     return raw
+
+
+def _group_channels_by_shaft(ch_names: List[str]) -> Dict[str, List[int]]:
+    """Group channels by their electrode shaft/grid name.
+
+    Assumes channel names were normalized by :func:`_channel_text_scrub`,
+    i.e. an upper-case electrode prefix followed by the contact number
+    (e.g. ``LAH1``, ``A'10``, ``G12``). Bipolar channels named
+    ``<anode>-<cathode>`` (e.g. ``LAH1-LAH2``) are grouped by their anode.
+    Channels without a trailing contact number form a group of their own.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The channel names.
+
+    Returns
+    -------
+    groups : dict
+        Mapping of electrode name to the indices of its channels, in order
+        of first appearance.
+    """
+    groups: Dict[str, List[int]] = dict()
+    for idx, ch_name in enumerate(ch_names):
+        anode = ch_name.split("-", 1)[0] or ch_name
+        match = re.match(r"^(.*?)(\d+)$", anode)
+        electrode = match.group(1) if match and match.group(1) else anode
+        groups.setdefault(electrode, []).append(idx)
+    return groups
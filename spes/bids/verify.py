@@ -0,0 +1,403 @@
+"""Lightweight integrity checks of converted BIDS recordings.
+
+Only headers and sidecars are read, never the sample data, so a whole
+dataset can be verified in a fraction of the time it takes to load it.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+from mne_bids.tsv_handler import _from_tsv
+
+# bytes per sample of the BrainVision binary formats
+BRAINVISION_FORMATS = {"INT_16": 2, "UINT_16": 2, "INT_32": 4, "IEEE_FLOAT_32": 4}
+
+# the recording files that are verified, by extension
+RECORDING_EXTENSIONS = (".vhdr", ".edf")
+
+
+def _read_ini(fpath):
+    """Parse the sections of a BrainVision ``.vhdr`` or ``.vmrk`` file."""
+    sections = {}
+    section = None
+    with open(fpath, "r", encoding="utf-8", errors="replace") as fin:
+        for line in fin:
+            line = line.strip()
+            if not line or line.startswith(";"):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = sections.setdefault(line[1:-1], {})
+            elif section is not None and "=" in line:
+                key, val = line.split("=", 1)
+                section[key.strip()] = val.strip()
+    return sections
+
+
+def _read_vhdr(fpath):
+    sections = _read_ini(fpath)
+    common = sections.get("Common Infos", {})
+    channels = sections.get("Channel Infos", {})
+    ch_names = [
+        channels[key].split(",")[0].replace("\\1", ",")
+        for key in sorted(
+            (key for key in channels if key.startswith("Ch")),
+            key=lambda key: int(key[2:]),
+        )
+    ]
+    return {
+        "data_file": common.get("DataFile"),
+        "marker_file": common.get("MarkerFile"),
+        "data_format": common.get("DataFormat"),
+        "orientation": common.get("DataOrientation"),
+        "n_channels": int(common.get("NumberOfChannels", -1)),
+        "sfreq": 1e6 / float(common.get("SamplingInterval", "nan")),
+        "binary_format": sections.get("Binary Infos", {}).get("BinaryFormat"),
+        "ch_names": ch_names,
+    }
+
+
+def _read_vmrk(fpath):
+    sections = _read_ini(fpath)
+    positions = []
+    for key, val in sections.get("Marker Infos", {}).items():
+        fields = val.split(",")
+        if key.startswith("Mk") and len(fields) > 2 and fields[2].strip():
+            positions.append(int(fields[2]))
+    return {
+        "data_file": sections.get("Common Infos", {}).get("DataFile"),
+        "positions": positions,
+    }
+
+
+def _read_edf_header(fpath):
+    """Read the fixed and per-signal header fields of an EDF file."""
+    with open(fpath, "rb") as fin:
+        fixed = fin.read(256)
+        n_header_bytes = int(fixed[184:192])
+        n_records = int(fixed[236:244])
+        record_duration = float(fixed[244:252])
+        n_signals = int(fixed[252:256])
+        signals = fin.read(n_signals * 240)
+
+    def _field(offset, width):
+        start = offset * n_signals
+        return [
+            signals[start + idx * width : start + (idx + 1) * width]
+            .decode("latin-1")
+            .strip()
+            for idx in range(n_signals)
+        ]
+
+    # the per-signal fields are stored field by field, each for all signals
+    ch_names = _field(0, 16)
+    n_samples = [int(val) for val in _field(216, 8)]
+    return {
+        "n_header_bytes": n_header_bytes,
+        "n_records": n_records,
+        "record_duration": record_duration,
+        "ch_names": ch_names,
+        "n_samples": n_samples,
+    }
+
+
+def _sidecar(fpath, suffix, extension):
+    """The sidecar of a recording, e.g. its ``channels.tsv``."""
+    stem = fpath.name.rsplit("_", 1)[0]
+    return fpath.with_name(f"{stem}_{suffix}{extension}")
+
+
+def _scans_fpath(fpath):
+    # <session folder>/<datatype>/<recording> -> <session folder>/*_scans.tsv
+    session_dir = fpath.parent.parent
+    matches = list(session_dir.glob("*_scans.tsv"))
+    return matches[0] if matches else None
+
+
+def _check_brainvision(fpath, problems):
+    vhdr = _read_vhdr(fpath)
+    data_fpath = fpath.with_name(vhdr["data_file"] or "")
+    marker_fpath = fpath.with_name(vhdr["marker_file"] or "")
+    if not vhdr["data_file"] or not data_fpath.is_file():
+        problems.append(("vhdr", f"data file {vhdr['data_file']} does not exist"))
+        data_fpath = None
+    if not vhdr["marker_file"] or not marker_fpath.is_file():
+        problems.append(("vhdr", f"marker file {vhdr['marker_file']} does not exist"))
+        marker_fpath = None
+    if vhdr["n_channels"] != len(vhdr["ch_names"]):
+        problems.append(
+            (
+                "vhdr",
+                f"NumberOfChannels={vhdr['n_channels']}, but "
+                f"{len(vhdr['ch_names'])} channels are listed",
+            )
+        )
+    if vhdr["data_format"] != "BINARY":
+        problems.append(("vhdr", f"unsupported DataFormat {vhdr['data_format']}"))
+    nbytes = BRAINVISION_FORMATS.get(vhdr["binary_format"])
+    if nbytes is None:
+        problems.append(("vhdr", f"unknown BinaryFormat {vhdr['binary_format']}"))
+
+    n_samples = None
+    if data_fpath is not None and nbytes is not None and vhdr["n_channels"] > 0:
+        size = data_fpath.stat().st_size
+        frame_bytes = vhdr["n_channels"] * nbytes
+        if size % frame_bytes:
+            problems.append(
+                (
+                    "eeg",
+                    f"{size} bytes is not a multiple of {vhdr['n_channels']} "
+                    f"channels x {nbytes} bytes",
+                )
+            )
+        n_samples = size // frame_bytes
+
+    if marker_fpath is not None:
+        vmrk = _read_vmrk(marker_fpath)
+        if vmrk["data_file"] != vhdr["data_file"]:
+            problems.append(
+                (
+                    "vmrk",
+                    f"DataFile {vmrk['data_file']} does not match the header "
+                    f"{vhdr['data_file']}",
+                )
+            )
+        if n_samples is not None:
+            # marker positions are 1-based sample indices
+            outside = [pos for pos in vmrk["positions"] if not 1 <= pos <= n_samples]
+            if outside:
+                problems.append(
+                    ("vmrk", f"{len(outside)} markers outside {n_samples} samples")
+                )
+    return vhdr["ch_names"], vhdr["sfreq"], n_samples
+
+
+def _check_edf(fpath, problems):
+    header = _read_edf_header(fpath)
+    record_bytes = 2 * sum(header["n_samples"])
+    expected = header["n_header_bytes"] + header["n_records"] * record_bytes
+    size = fpath.stat().st_size
+    if size != expected:
+        problems.append(
+            (
+                "edf",
+                f"{size} bytes, but the header describes {expected} bytes "
+                f"({header['n_records']} records of {record_bytes} bytes)",
+            )
+        )
+    n_samples = max(header["n_samples"], default=0) * header["n_records"]
+    sfreq = max(header["n_samples"], default=0) / header["record_duration"]
+    ch_names = [ch for ch in header["ch_names"] if ch != "EDF Annotations"]
+    return ch_names, sfreq, n_samples
+
+
+def verify_recording(fpath):
+    """Check the headers and sidecars of one BIDS recording.
+
+    Checks that:
+
+    - the ``.vhdr`` points to existing ``.eeg`` and ``.vmrk`` files, the
+      ``.vmrk`` points to the same ``.eeg`` and its markers lie within the
+      recording;
+    - the size of the ``.eeg`` (or ``.edf``) file matches the number of
+      channels, samples and bytes per sample in the header;
+    - the ``channels.tsv`` lists the channels of the header, in order;
+    - the ``_ieeg.json`` sampling frequency and duration match the header;
+    - the recording is listed in the session's ``scans.tsv``.
+
+    Parameters
+    ----------
+    fpath : str | Path
+        The ``.vhdr`` or ``.edf`` file of the recording.
+
+    Returns
+    -------
+    problems : list of tuple of str
+        The ``(check, problem)`` pairs found, empty if the recording is
+        consistent.
+    """
+    fpath = Path(fpath)
+    problems = []
+    try:
+        if fpath.suffix == ".vhdr":
+            ch_names, sfreq, n_samples = _check_brainvision(fpath, problems)
+        else:
+            ch_names, sfreq, n_samples = _check_edf(fpath, problems)
+    except (OSError, ValueError) as err:
+        return problems + [("header", f"cannot be read: {err}")]
+
+    channels_fpath = _sidecar(fpath, "channels", ".tsv")
+    if not channels_fpath.is_file():
+        problems.append(("channels.tsv", "does not exist"))
+    else:
+        tsv_names = _from_tsv(channels_fpath)["name"]
+        if tsv_names != ch_names:
+            missing = set(ch_names).difference(tsv_names)
+            extra = set(tsv_names).difference(ch_names)
+            problems.append(
+                (
+                    "channels.tsv",
+                    f"{len(tsv_names)} rows do not match {len(ch_names)} header "
+                    f"channels (missing {sorted(missing)}, extra {sorted(extra)})",
+                )
+            )
+
+    json_fpath = fpath.with_suffix(".json")
+    if json_fpath.is_file():
+        with open(json_fpath, "r") as fin:
+            sidecar = json.load(fin)
+        if abs(sidecar.get("SamplingFrequency", sfreq) - sfreq) > 1e-3:
+            problems.append(
+                (
+                    "json",
+                    f"SamplingFrequency {sidecar['SamplingFrequency']} does not "
+                    f"match the header {sfreq}",
+                )
+            )
+        duration = sidecar.get("RecordingDuration")
+        if duration is not None and n_samples is not None:
+            # the duration is written as the time of the last sample
+            n_expected = round(duration * sfreq) + 1
+            if abs(n_samples - n_expected) > 1:
+                problems.append(
+                    (
+                        "json",
+                        f"RecordingDuration {duration} s does not match "
+                        f"{n_samples} samples",
+                    )
+                )
+
+    scans_fpath = _scans_fpath(fpath)
+    if scans_fpath is None:
+        problems.append(("scans.tsv", "does not exist"))
+    else:
+        scan_fname = f"{fpath.parent.name}/{fpath.name}"
+        if scan_fname not in _from_tsv(scans_fpath)["filename"]:
+            problems.append(("scans.tsv", f"{scan_fname} is not listed"))
+    return problems
+
+
+def _recording_mtimes(fpath):
+    """The modification times of the files a recording is verified from."""
+    fpaths = [
+        fpath,
+        fpath.with_suffix(".eeg"),
+        fpath.with_suffix(".vmrk"),
+        fpath.with_suffix(".json"),
+        _sidecar(fpath, "channels", ".tsv"),
+        _scans_fpath(fpath),
+    ]
+    return {
+        str(fpath): os.stat(fpath).st_mtime
+        for fpath in fpaths
+        if fpath is not None and fpath.exists()
+    }
+
+
+def _check_scans(scans_fpath):
+    """Check that every entry of a ``scans.tsv`` exists."""
+    problems = []
+    for fname in _from_tsv(scans_fpath)["filename"]:
+        if not (scans_fpath.parent / fname).exists():
+            problems.append((str(scans_fpath), "scans.tsv", f"{fname} does not exist"))
+    return problems
+
+
+def verify_bids_dataset(
+    bids_root, subjects=None, n_jobs=8, cache_fpath=None, out_fpath=None
+):
+    """Verify all recordings of a BIDS dataset from their headers.
+
+    Each recording is checked with :func:`verify_recording`, in a pool of
+    ``n_jobs`` threads. Results are cached by the modification times of
+    the files they were computed from, so only new or changed recordings
+    are checked again. The cached results of recordings outside
+    ``subjects`` are kept for later runs.
+
+    Parameters
+    ----------
+    bids_root : str | Path
+        The root of the BIDS dataset.
+    subjects : list of str | None
+        Only verify these subjects. Defaults to all.
+    n_jobs : int
+        The number of threads.
+    cache_fpath : str | Path | None
+        The JSON file caching results. Defaults to
+        ``<bids_root>/derivatives/verify/verify_cache.json``.
+    out_fpath : str | Path | None
+        If set, the problems are also written to this ``.tsv`` file.
+
+    Returns
+    -------
+    problems_df : pd.DataFrame
+        One row per problem, with the ``recording``, the ``check`` that
+        failed and the ``problem``. Empty if the dataset is consistent.
+    """
+    bids_root = Path(bids_root)
+    if cache_fpath is None:
+        cache_fpath = bids_root / "derivatives" / "verify" / "verify_cache.json"
+    cache_fpath = Path(cache_fpath)
+    cache = {}
+    if cache_fpath.exists():
+        with open(cache_fpath, "r") as fin:
+            cache = json.load(fin)
+
+    subject_dirs = (
+        [bids_root / f"sub-{subject}" for subject in subjects]
+        if subjects is not None
+        else sorted(bids_root.glob("sub-*"))
+    )
+    fpaths = [
+        fpath
+        for subject_dir in subject_dirs
+        for extension in RECORDING_EXTENSIONS
+        for fpath in sorted(subject_dir.rglob(f"*{extension}"))
+    ]
+    scans_fpaths = [
+        fpath
+        for subject_dir in subject_dirs
+        for fpath in subject_dir.rglob("*_scans.tsv")
+    ]
+
+    def _verify(fpath):
+        mtimes = _recording_mtimes(fpath)
+        cached = cache.get(str(fpath))
+        if cached is not None and cached["mtimes"] == mtimes:
+            return fpath, mtimes, cached["problems"], True
+        return fpath, mtimes, verify_recording(fpath), False
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(_verify, fpaths))
+        scan_problems = executor.map(_check_scans, scans_fpaths)
+        records = [problem for problems in scan_problems for problem in problems]
+
+    # keep the results of recordings outside this run, unless they are gone
+    new_cache = {
+        fpath: entry for fpath, entry in cache.items() if Path(fpath).exists()
+    }
+    n_cached = 0
+    for fpath, mtimes, problems, from_cache in results:
+        n_cached += from_cache
+        new_cache[str(fpath)] = {"mtimes": mtimes, "problems": problems}
+        records.extend((str(fpath), check, problem) for check, problem in problems)
+
+    cache_fpath.parent.mkdir(exist_ok=True, parents=True)
+    tmp_fpath = cache_fpath.with_name(f".{cache_fpath.name}.tmp")
+    with open(tmp_fpath, "w") as fout:
+        json.dump(new_cache, fout)
+    os.replace(tmp_fpath, cache_fpath)
+
+    problems_df = pd.DataFrame.from_records(
+        records, columns=["recording", "check", "problem"]
+    )
+    print(
+        f"Verified {len(fpaths)} recordings ({n_cached} unchanged since the last "
+        f"run): {len(problems_df)} problems in "
+        f"{problems_df['recording'].nunique()} files."
+    )
+    if out_fpath is not None:
+        problems_df.to_csv(out_fpath, sep="\t", index=False)
+    return problems_df
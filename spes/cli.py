@@ -0,0 +1,267 @@
+"""The ``spes`` command line interface.
+
+Run ``python -m spes <command> --help`` for the options of each command.
+Roots and parameters can be read from a JSON config file, with top-level
+keys shared by all commands and a section per command, e.g.::
+
+    {
+        "bids_root": "/data/epilepsy_bids",
+        "queue": "/data/epilepsy_bids/derivatives/jobqueue",
+        "fragility": {"reference": "monopolar", "subjects": ["PY18N013"]}
+    }
+
+Options given on the command line override the config file. Heavy
+dependencies (``mne``, ``mne_bids``, ``eztrack``, ``pandas``, ...) are
+only imported by the command that uses them, so starting a command, e.g.
+a queue worker, does not pay for the imports of the others.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def _load_config(config_fpath, command):
+    """Read the shared and command-specific settings of a config file."""
+    if config_fpath is None:
+        return dict()
+    with open(config_fpath, "r") as fin:
+        config = json.load(fin)
+    settings = {key: val for key, val in config.items() if not isinstance(val, dict)}
+    settings.update(config.get(command, dict()))
+    return settings
+
+
+def _get_queue(settings):
+    if settings.get("queue") is None:
+        return None
+    from spes.jobqueue import FileJobQueue
+
+    return FileJobQueue(
+        settings["queue"], lease_seconds=settings.get("lease_seconds", 600.0)
+    )
+
+
+def _run_convert_jhu(settings):
+    from spes.bids.scripts.run_bids_conversion import convert_jhu_dataset
+
+    convert_jhu_dataset(
+        bids_root=settings.get("bids_root"),
+        source_dir=settings.get("source_dir"),
+        overwrite=settings.get("overwrite", True),
+        queue=_get_queue(settings),
+    )
+
+
+def _run_convert_spes(settings):
+    from spes.scripts.bids.run_bids_conversion import convert_jhh
+
+    convert_jhh(root=settings.get("bids_root"), source_dir=settings.get("source_dir"))
+
+
+def _run_fragility(settings):
+    from spes.fragility.run_fragility_analysis import main_run_jhu
+
+    main_run_jhu(
+        root=settings.get("bids_root"),
+        deriv_root=settings.get("deriv_root"),
+        figures_path=settings.get("figures_path"),
+        subjects=settings.get("subjects"),
+        reference=settings.get("reference", "monopolar"),
+        sfreq=settings.get("sfreq"),
+        overwrite=settings.get("overwrite", False),
+        queue=_get_queue(settings),
+        dtype=settings.get("dtype"),
+        output_profile=settings.get("output_profile", "full"),
+        state_structure=settings.get("state_structure", "dense"),
+        n_jobs=settings.get("n_jobs"),
+    )
+
+
+def _n_jobs(value):
+    """An int, or ``"auto"`` to tune the workers of the fit."""
+    return value if value == "auto" else int(value)
+
+
+def _run_significance(settings):
+    from spes.fragility.significance import run_significance
+    from spes.fragility.summary import _source_bids_path, find_fragility_derivatives
+
+    if settings.get("deriv_root") is None or settings.get("bids_root") is None:
+        raise ValueError("significance needs a deriv_root and a bids_root.")
+    reference = settings.get("reference", "monopolar")
+    deriv_fpaths = find_fragility_derivatives(
+        settings["deriv_root"], reference=reference, subjects=settings.get("subjects")
+    )
+    for deriv_fpath in deriv_fpaths:
+        run_significance(
+            _source_bids_path(deriv_fpath, settings["bids_root"]),
+            settings["deriv_root"],
+            reference=reference,
+            n_surrogates=settings.get("n_surrogates", 200),
+            method=settings.get("method", "phase"),
+            seed=settings.get("seed", 0),
+            n_jobs=settings.get("n_jobs", 1),
+            overwrite=settings.get("overwrite", False),
+        )
+
+
+def _run_summarize(settings):
+    from spes.fragility.summary import summarize_fragility
+
+    if settings.get("deriv_root") is None or settings.get("bids_root") is None:
+        raise ValueError("summarize needs a deriv_root and a bids_root.")
+    summary_df = summarize_fragility(
+        settings["deriv_root"],
+        settings["bids_root"],
+        out_fpath=settings.get("out_fpath"),
+        reference=settings.get("reference"),
+        subjects=settings.get("subjects"),
+        n_jobs=settings.get("n_jobs", 1),
+    )
+    print(summary_df)
+
+
+def _run_verify(settings):
+    from spes.bids.verify import verify_bids_dataset
+
+    if settings.get("bids_root") is None:
+        raise ValueError("verify needs a bids_root.")
+    problems_df = verify_bids_dataset(
+        settings["bids_root"],
+        subjects=settings.get("subjects"),
+        n_jobs=settings.get("n_jobs", 8),
+        out_fpath=settings.get("out_fpath"),
+    )
+    if len(problems_df):
+        print(problems_df.to_string())
+
+
+def _run_worker(settings):
+    from spes.jobqueue import run_worker
+
+    queue = _get_queue(settings)
+    if queue is None:
+        raise ValueError("worker needs a queue.")
+    n_jobs = run_worker(
+        queue,
+        max_jobs=settings.get("max_jobs"),
+        exit_when_empty=settings.get("exit_when_empty", False),
+    )
+    print(f"Ran {n_jobs} jobs.")
+
+
+COMMANDS = {
+    "convert-jhu": (_run_convert_jhu, "Convert the JHU EDF files to BIDS."),
+    "convert-spes": (_run_convert_spes, "Convert the JHH SPES recordings to BIDS."),
+    "fragility": (_run_fragility, "Run the fragility analysis of a BIDS dataset."),
+    "significance": (
+        _run_significance,
+        "Compute surrogate p-values of fragility derivatives.",
+    ),
+    "summarize": (_run_summarize, "Summarize fragility derivatives into a table."),
+    "verify": (_run_verify, "Check converted BIDS headers and sidecars."),
+    "worker": (_run_worker, "Run jobs from a file-based job queue."),
+}
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog="spes", description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, (_, help) in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=help, description=help)
+        subparser.add_argument("--config", help="A JSON config file.")
+
+        if command != "worker":
+            subparser.add_argument("--bids-root", help="The root of the BIDS dataset.")
+        if command.startswith("convert"):
+            subparser.add_argument("--source-dir", help="The source data folder.")
+        if command in ("fragility", "significance", "summarize"):
+            subparser.add_argument("--deriv-root", help="The derivative root.")
+            subparser.add_argument("--reference", help="The reference to analyze.")
+        if command in ("fragility", "significance", "summarize", "verify"):
+            subparser.add_argument("--subjects", nargs="+", help="Subjects to use.")
+        if command == "fragility":
+            subparser.add_argument("--figures-path", help="Where to save heatmaps.")
+            subparser.add_argument(
+                "--sfreq", type=float, help="The frequency to resample to."
+            )
+            subparser.add_argument(
+                "--dtype",
+                choices=("float32", "float64"),
+                help="The dtype of the fit. Runs the numpy engine.",
+            )
+            subparser.add_argument(
+                "--output-profile",
+                choices=("full", "minimal"),
+                help="Which arrays to save.",
+            )
+            subparser.add_argument(
+                "--state-structure",
+                choices=("dense", "block"),
+                help="Fit a dense or a block-diagonal state matrix per shaft.",
+            )
+            subparser.add_argument(
+                "--n-jobs",
+                type=_n_jobs,
+                help="Workers of the fit, or 'auto' to tune them.",
+            )
+        if command == "significance":
+            subparser.add_argument(
+                "--n-surrogates", type=int, help="The number of surrogates."
+            )
+            subparser.add_argument(
+                "--method", choices=("phase", "shift"), help="The surrogate method."
+            )
+            subparser.add_argument("--seed", type=int, help="The random seed.")
+        if command in ("summarize", "verify"):
+            subparser.add_argument("--out-fpath", help="The table to write.")
+        if command in ("significance", "summarize", "verify"):
+            subparser.add_argument("--n-jobs", type=int, help="Parallel jobs.")
+        if command in ("convert-jhu", "fragility", "significance"):
+            subparser.add_argument(
+                "--overwrite", action="store_true", default=None, help="Overwrite."
+            )
+        if command in ("convert-jhu", "fragility", "worker"):
+            subparser.add_argument(
+                "--queue",
+                help="A job queue folder. Jobs are submitted to it, or run "
+                "from it by the worker.",
+            )
+        if command == "worker":
+            subparser.add_argument(
+                "--lease-seconds", type=float, help="The lease of claimed jobs."
+            )
+            subparser.add_argument("--max-jobs", type=int, help="Stop after N jobs.")
+            subparser.add_argument(
+                "--exit-when-empty",
+                action="store_true",
+                default=None,
+                help="Stop when the queue is empty instead of polling.",
+            )
+    return parser
+
+
+def main(argv=None):
+    """Run a ``spes`` command.
+
+    Parameters
+    ----------
+    argv : list of str | None
+        The command line arguments. Defaults to ``sys.argv[1:]``.
+    """
+    options = vars(_build_parser().parse_args(argv))
+    command = options.pop("command")
+    settings = _load_config(options.pop("config"), command)
+    settings.update({key: val for key, val in options.items() if val is not None})
+    for key in ("bids_root", "source_dir", "deriv_root", "figures_path"):
+        if settings.get(key) is not None:
+            settings[key] = Path(settings[key])
+
+    run_fn, _ = COMMANDS[command]
+    run_fn(settings)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
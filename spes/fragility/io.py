@@ -0,0 +1,370 @@
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+from mne_bids.utils import _write_json
+
+# BIDS ``desc`` entities of the saved fragility arrays
+PERTURB_DESCRIPTION = "perturbmatrix"
+STATE_DESCRIPTION = "statematrix"
+DELTAVECS_DESCRIPTION = "deltavecs"
+# BIDS ``desc`` entity of the surrogate p-values of the fragility
+PVALUES_DESCRIPTION = "fragilitypvalues"
+
+# which arrays each output profile saves, "full" is also assumed for
+# derivatives without a parameter sidecar
+OUTPUT_PROFILES = {
+    "full": (PERTURB_DESCRIPTION, STATE_DESCRIPTION, DELTAVECS_DESCRIPTION),
+    "minimal": (PERTURB_DESCRIPTION,),
+}
+
+
+def _sidecar_fpath(deriv_fpath):
+    """Get the parameter sidecar path belonging to a derivative file."""
+    deriv_fpath = Path(deriv_fpath)
+    return deriv_fpath.with_name(f"{deriv_fpath.stem}_params.json")
+
+
+def write_fragility_sidecar(deriv_fpath, params, overwrite=False):
+    """Write the parameters a fragility derivative was computed with.
+
+    The sidecar lets downstream stages (plotting, summaries) interpret the
+    saved array without loading the raw data again.
+
+    Parameters
+    ----------
+    deriv_fpath : str | Path
+        The path of the saved derivative array.
+    params : dict
+        JSON-serializable parameters. Should minimally contain ``ch_names``,
+        ``sfreq``, ``winsize`` and ``stepsize``.
+    overwrite : bool
+        Whether to overwrite an existing sidecar.
+
+    Returns
+    -------
+    sidecar_fpath : Path
+        The path of the written sidecar.
+    """
+    sidecar_fpath = _sidecar_fpath(deriv_fpath)
+    _write_json(sidecar_fpath, params, overwrite=overwrite)
+    return sidecar_fpath
+
+
+def read_fragility_sidecar(deriv_fpath):
+    """Read the parameters a fragility derivative was computed with.
+
+    Parameters
+    ----------
+    deriv_fpath : str | Path
+        The path of the saved derivative array.
+
+    Returns
+    -------
+    params : dict
+        The parameters written by :func:`write_fragility_sidecar`.
+    """
+    sidecar_fpath = _sidecar_fpath(deriv_fpath)
+    with open(sidecar_fpath, "r") as fin:
+        params = json.load(fin)
+    return params
+
+
+def get_state_fpath(deriv_fpath):
+    """Get the state matrix a perturbation matrix was computed from.
+
+    The radii of a parameter sweep share one fit, whose state matrices are
+    saved once. The sidecars of the other radii reference them by their
+    path relative to the perturbation matrix as ``"state_matrix"``.
+
+    Parameters
+    ----------
+    deriv_fpath : str | Path
+        The path of the saved perturbation matrix.
+
+    Returns
+    -------
+    state_fpath : Path
+        The path of the state matrix, which may not exist.
+    """
+    deriv_fpath = Path(deriv_fpath)
+    if _sidecar_fpath(deriv_fpath).exists():
+        state_fpath = read_fragility_sidecar(deriv_fpath).get("state_matrix")
+        if state_fpath is not None:
+            return deriv_fpath.parent / state_fpath
+    return deriv_fpath.with_name(
+        deriv_fpath.name.replace(
+            f"desc-{PERTURB_DESCRIPTION}", f"desc-{STATE_DESCRIPTION}"
+        )
+    )
+
+
+def get_output_profile(deriv_fpath):
+    """Get the output profile a perturbation matrix was saved with.
+
+    A ``"full"`` derivative whose state matrix is referenced from another
+    folder (see :func:`get_state_fpath`) only counts as full while that
+    file exists.
+
+    Parameters
+    ----------
+    deriv_fpath : str | Path
+        The path of the saved perturbation matrix.
+
+    Returns
+    -------
+    output_profile : str
+        One of the keys of ``OUTPUT_PROFILES``.
+    """
+    if not _sidecar_fpath(deriv_fpath).exists():
+        return "full"
+    params = read_fragility_sidecar(deriv_fpath)
+    output_profile = params.get("output_profile", "full")
+    if "state_matrix" in params and not get_state_fpath(deriv_fpath).exists():
+        return "minimal"
+    return output_profile
+
+
+def get_derivative_fpath(deriv_path, bids_path, description):
+    """Get the path of a ``.npy`` fragility derivative of a recording.
+
+    Parameters
+    ----------
+    deriv_path : str | Path
+        The folder of the derivatives.
+    bids_path : mne_bids.BIDSPath
+        The path of the source recording, whose entities name the file.
+    description : str
+        The BIDS ``desc`` entity, e.g. ``"perturbmatrix"``.
+
+    Returns
+    -------
+    deriv_fpath : Path
+    """
+    basename = (
+        bids_path.copy()
+        .update(
+            description=description,
+            suffix=bids_path.datatype,
+            extension=".npy",
+            check=False,
+        )
+        .basename
+    )
+    return Path(deriv_path) / basename
+
+
+def save_fragility_arrays(
+    deriv_path, bids_path, arrays, overwrite=False, sidecar_params=None
+):
+    """Save fragility arrays as ``.npy`` derivatives of a recording.
+
+    Nothing is written if any file exists and ``overwrite`` is False. The
+    arrays and the sidecar are written under temporary names first and
+    renamed in place after all of them are written: the other arrays, then
+    the sidecar, then the perturbation matrix.
+
+    Parameters
+    ----------
+    deriv_path : str | Path
+        The folder to save the derivatives to.
+    bids_path : mne_bids.BIDSPath
+        The path of the source recording, whose entities name the files.
+    arrays : dict
+        Mapping of the BIDS ``desc`` entity (e.g. ``"perturbmatrix"``) to
+        the array to save.
+    overwrite : bool
+        Whether to overwrite existing files.
+    sidecar_params : dict | None
+        If set, the parameter sidecar of the perturbation matrix, see
+        :func:`write_fragility_sidecar`.
+
+    Returns
+    -------
+    deriv_fpaths : dict
+        Mapping of the ``desc`` entity to the saved file path.
+    """
+    if sidecar_params is not None and PERTURB_DESCRIPTION not in arrays:
+        raise ValueError("The sidecar belongs to the perturbation matrix.")
+    deriv_path = Path(deriv_path)
+    deriv_path.mkdir(exist_ok=True, parents=True)
+
+    deriv_fpaths = dict()
+    for description in arrays:
+        deriv_fpath = get_derivative_fpath(deriv_path, bids_path, description)
+        if deriv_fpath.exists() and not overwrite:
+            raise FileExistsError(
+                f"{deriv_fpath} already exists. Set overwrite=True to replace it."
+            )
+        deriv_fpaths[description] = deriv_fpath
+
+    # the perturbation matrix is moved in place last, since its existence
+    # marks the recording as done, and its sidecar right before it
+    tmp_fpaths = dict()
+    try:
+        for description, deriv_fpath in deriv_fpaths.items():
+            tmp_fpaths[description] = _tmp_fpath(deriv_fpath)
+            with open(tmp_fpaths[description], "wb") as fout:
+                np.save(fout, arrays[description])
+        if sidecar_params is not None:
+            perturb_fpath = get_derivative_fpath(
+                deriv_path, bids_path, PERTURB_DESCRIPTION
+            )
+            sidecar_fpath = _sidecar_fpath(perturb_fpath)
+            tmp_fpaths["sidecar"] = _tmp_fpath(sidecar_fpath)
+            with open(tmp_fpaths["sidecar"], "w") as fout:
+                json.dump(sidecar_params, fout, indent=4)
+    except BaseException:
+        for tmp_fpath in tmp_fpaths.values():
+            tmp_fpath.unlink(missing_ok=True)
+        raise
+
+    for description in sorted(deriv_fpaths, key=lambda d: d == PERTURB_DESCRIPTION):
+        if description == PERTURB_DESCRIPTION and "sidecar" in tmp_fpaths:
+            os.replace(tmp_fpaths["sidecar"], sidecar_fpath)
+        os.replace(tmp_fpaths[description], deriv_fpaths[description])
+    return deriv_fpaths
+
+
+def _tmp_fpath(fpath):
+    """Get a temporary path next to ``fpath`` that no derivative glob matches."""
+    fpath = Path(fpath)
+    return fpath.with_name(f".{fpath.name}.tmp")
+
+
+def save_atomic(deriv_path, save_fns, last=None):
+    """Save files into a folder so they appear all at once.
+
+    Each ``save_fn`` is called with a temporary folder next to
+    ``deriv_path`` and must save exactly one file into it. The files are
+    then renamed into ``deriv_path``, so readers never see partial files.
+
+    Parameters
+    ----------
+    deriv_path : str | Path
+        The folder to save into.
+    save_fns : list of callable
+        Functions of the folder to save to, e.g.
+        ``lambda tmp_path: deriv.save(tmp_path / fname)``.
+    last : str | None
+        A substring of the file name to move in place last, e.g. the
+        ``desc`` entity whose existence marks the recording as done.
+
+    Returns
+    -------
+    fpaths : list of Path
+        The files saved into ``deriv_path``.
+    """
+    deriv_path = Path(deriv_path)
+    deriv_path.mkdir(exist_ok=True, parents=True)
+    tmp_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=deriv_path))
+    try:
+        for save_fn in save_fns:
+            save_fn(tmp_path)
+        tmp_fpaths = sorted(
+            tmp_path.iterdir(),
+            key=lambda fpath: (last is not None and last in fpath.name, fpath.suffix),
+        )
+        fpaths = []
+        for tmp_fpath in tmp_fpaths:
+            os.replace(tmp_fpath, deriv_path / tmp_fpath.name)
+            fpaths.append(deriv_path / tmp_fpath.name)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return fpaths
+
+
+class AsyncDerivativeWriter:
+    """Write derivatives in background threads.
+
+    Save jobs are put on a bounded queue and run by ``n_threads`` writer
+    threads, so the caller can compute the next recording while the
+    previous one is written to disk. :meth:`submit` blocks while
+    ``max_pending`` jobs are waiting, which bounds the number of computed
+    results held in memory to ``max_pending + n_threads``.
+
+    Parameters
+    ----------
+    max_pending : int
+        The number of save jobs that can wait for a writer thread.
+    n_threads : int
+        The number of writer threads.
+
+    Examples
+    --------
+    >>> with AsyncDerivativeWriter(max_pending=2) as writer:
+    ...     future = writer.submit(save_fragility_arrays, deriv_path, bids_path, arrays)
+    """
+
+    def __init__(self, max_pending=2, n_threads=1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(n_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, save_fn, args, kwargs, on_complete = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = save_fn(*args, **kwargs)
+                if on_complete is not None:
+                    result = on_complete(result)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def submit(self, save_fn, *args, on_complete=None, **kwargs):
+        """Queue a save job, blocking while the queue is full.
+
+        Parameters
+        ----------
+        save_fn : callable
+            The function that saves the derivatives, called with ``*args``
+            and ``**kwargs`` in a writer thread.
+        on_complete : callable | None
+            Called in the writer thread with the result of ``save_fn`` once
+            the files are written, e.g. to submit the heatmap of the saved
+            derivative.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the result of ``on_complete`` if passed, otherwise
+            to the result of ``save_fn``.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot submit to a closed writer.")
+        future = Future()
+        self._queue.put((future, save_fn, args, kwargs, on_complete))
+        return future
+
+    def close(self):
+        """Wait for all queued jobs to be written and stop the threads."""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
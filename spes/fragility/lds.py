@@ -0,0 +1,416 @@
+"""Windowed linear dynamical system (LDS) fragility in numpy.
+
+This mirrors the ``lds_raw_fragility`` model of ``eztrack``: for each
+window of ``winsize`` samples, a state matrix ``A`` is fit by regularized
+least squares such that ``x[t + 1] = A x[t]``, and for every channel the
+minimum-norm (column) perturbation of ``A`` that places an eigenvalue on
+the circle of radius ``radius`` is found. Working on plain arrays makes
+the dtype, output profile and solver controllable by the caller.
+"""
+
+import numpy as np
+from joblib import Parallel, delayed
+
+# number of points on the upper half of the circle of radius ``radius``
+# that the minimum-norm perturbation is searched over
+N_OMEGA = 51
+
+# the max absolute deviation of normalized fragility from the exact fit that
+# the truncated solvers are validated to, on windows whose dropped singular
+# vectors are numerically null
+TRUNCATION_TOLERANCE = 1e-6
+
+
+def _complex_dtype(dtype):
+    return np.result_type(dtype, np.complex64)
+
+
+def compute_n_windows(n_times, winsize, stepsize):
+    """Compute the number of windows fit on a recording."""
+    return max(0, (n_times - winsize) // stepsize + 1)
+
+
+def _randomized_svd(X, rank, n_oversamples=10, n_iter=2, seed=0):
+    """Batched randomized SVD of ``X``, shape (..., m, n).
+
+    Uses a Gaussian range finder with ``n_iter`` power iterations
+    (Halko, Martinsson & Tropp, 2011), so the cost is O(m * n * rank)
+    per matrix instead of O(m^2 * n) for the full SVD.
+    """
+    rng = np.random.default_rng(seed)
+    m, n = X.shape[-2:]
+    sketch = min(rank + n_oversamples, m, n)
+    omega = rng.standard_normal((n, sketch)).astype(X.dtype)
+    Q, _ = np.linalg.qr(np.matmul(X, omega))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(np.matmul(np.swapaxes(X, -1, -2), Q))
+        Q, _ = np.linalg.qr(np.matmul(X, Q))
+    B = np.matmul(np.swapaxes(Q, -1, -2), X)
+    Ub, s, Vh = np.linalg.svd(B, full_matrices=False)
+    U = np.matmul(Q, Ub)
+    return U[..., :rank], s[..., :rank], Vh[..., :rank, :]
+
+
+def _randomized_svd_energy(X, total_energy, energy, seed=0):
+    """Randomized SVD of ``X`` with the rank that keeps ``energy``.
+
+    The rank starts at an eighth of the full rank and is doubled until the
+    estimated singular vectors capture ``energy`` of ``||X||_F^2`` in every
+    matrix, up to the full rank.
+    """
+    full_rank = min(X.shape[-2:])
+    rank = min(full_rank, max(8, full_rank // 8))
+    while True:
+        U, s, Vh = _randomized_svd(X, rank, seed=seed)
+        captured = (s**2).sum(axis=-1) / np.where(total_energy > 0, total_energy, 1)
+        if rank == full_rank or np.all(captured >= energy):
+            return U, s, Vh
+        rank = min(2 * rank, full_rank)
+
+
+def _energy_cutoff(s, total_energy, energy):
+    """Mask of the leading singular values capturing ``energy`` of the total.
+
+    The component that crosses the ``energy`` fraction is kept.
+    """
+    cum_energy = np.cumsum(s**2, axis=-1) / total_energy[..., np.newaxis]
+    keep = np.ones(s.shape, dtype=bool)
+    keep[..., 1:] = cum_energy[..., :-1] < energy
+    return keep
+
+
+def fit_state_matrices(
+    windows, l2penalty=1e-9, solver="svd", energy=1.0, max_rank=None, seed=0
+):
+    """Fit a state matrix per window by regularized least squares.
+
+    Solves ``A = X2 X1^+`` with a Tikhonov-regularized pseudo-inverse of
+    ``X1``, batched over windows. With a small ``l2penalty`` this is the
+    Moore-Penrose pseudo-inverse.
+
+    The pseudo-inverse can be truncated to the leading singular vectors of
+    each window that capture ``energy`` of ``||X1||_F^2``. By Eckart-Young,
+    the dropped energy fraction ``1 - captured`` is the squared relative
+    error of the best rank-truncated ``X1``. With ``solver="randomized"``, only
+    the leading singular vectors are estimated with a randomized SVD, which
+    is cheaper when few of them capture ``energy``. Without ``max_rank``,
+    the rank is grown until ``energy`` is captured.
+
+    The truncated fit only reproduces the pseudo-inverse when the dropped
+    singular vectors are numerically null, e.g. on rank-deficient windows of
+    re-referenced data; there, fragility stays within ``TRUNCATION_TOLERANCE``
+    of the exact fit. Otherwise, the pseudo-inverse amplifies the weak
+    directions that the truncation drops, and the state matrices differ
+    entirely (see :func:`spes.fragility.validate.benchmark_solvers`).
+
+    Parameters
+    ----------
+    windows : np.ndarray, shape (n_windows, n_channels, winsize)
+        The data windows. The dtype of the windows is used for the fit.
+    l2penalty : float
+        The Tikhonov regularization added to the squared singular values.
+    solver : str
+        ``"svd"`` for the exact SVD, ``"randomized"`` for a randomized
+        truncated SVD.
+    energy : float
+        The fraction of energy of each window to keep, in ``(0, 1]``. Must
+        be below 1 for the randomized solver without ``max_rank``.
+    max_rank : int | None
+        The number of singular vectors estimated by the randomized solver.
+        If None, the smallest doubling of an eighth of
+        ``min(n_channels, winsize - 1)`` that captures ``energy``.
+    seed : int
+        The random seed of the randomized solver.
+
+    Returns
+    -------
+    A_mats : np.ndarray, shape (n_windows, n_channels, n_channels)
+    """
+    if solver not in ("svd", "randomized"):
+        raise ValueError(f"solver must be 'svd' or 'randomized', not {solver}.")
+    if not 0 < energy <= 1:
+        raise ValueError(f"energy must be in (0, 1], not {energy}.")
+    if solver == "randomized" and max_rank is None and energy == 1:
+        raise ValueError(
+            "The randomized solver needs energy < 1 or max_rank to truncate "
+            "the fit. Use solver='svd' to keep every singular vector."
+        )
+
+    X1 = windows[..., :-1]
+    X2 = windows[..., 1:]
+    if energy < 1 or solver == "randomized":
+        total_energy = np.einsum("...ij,...ij->...", X1, X1)
+    if solver == "svd":
+        U, s, Vh = np.linalg.svd(X1, full_matrices=False)
+    elif max_rank is not None:
+        U, s, Vh = _randomized_svd(X1, max_rank, seed=seed)
+    else:
+        U, s, Vh = _randomized_svd_energy(X1, total_energy, energy, seed=seed)
+
+    s_inv = s / (s**2 + np.asarray(l2penalty, dtype=s.dtype))
+    if energy < 1:
+        s_inv = np.where(_energy_cutoff(s, total_energy, energy), s_inv, 0)
+
+    # A = X2 V diag(s_inv) U^T
+    X2V = np.matmul(X2, np.swapaxes(Vh, -1, -2))
+    return np.matmul(X2V * s_inv[..., np.newaxis, :], np.swapaxes(U, -1, -2))
+
+
+def compute_perturbation_norms(
+    A_mats, radius, perturb_type="C", n_omega=N_OMEGA, return_vecs=False
+):
+    """Compute the minimum-norm perturbation of each channel.
+
+    For ``lambda = radius * exp(j w)``, the rank-one perturbation
+    ``delta e_k^T`` of column ``k`` moves an eigenvalue of ``A`` onto
+    ``lambda`` iff ``b_k^T delta = -1``, with ``b_k`` the ``k``-th row of
+    ``(A - lambda I)^{-1}``. The minimum-norm real ``delta`` has a closed
+    form in terms of ``Re(b_k)`` and ``Im(b_k)``, so all channels are solved
+    at once per ``w`` and the smallest norm over ``w`` is kept.
+
+    Parameters
+    ----------
+    A_mats : np.ndarray, shape (n_windows, n_channels, n_channels)
+        The state matrices.
+    radius : float | array-like of float
+        The radius of the circle to move an eigenvalue onto. If an array,
+        the norms of all radii are computed from the same inverses setup.
+    perturb_type : str
+        ``"C"`` for column perturbations, ``"R"`` for row perturbations.
+    n_omega : int
+        The number of frequencies in ``[0, pi]`` to search over.
+    return_vecs : bool
+        Whether to return the minimum-norm perturbation vectors.
+
+    Returns
+    -------
+    pert_norms : np.ndarray, shape ([n_radii,] n_windows, n_channels)
+        The minimum perturbation norm of each channel. The leading axis
+        is only present if ``radius`` is an array.
+    delta_vecs : np.ndarray, shape ([n_radii,] n_windows, n_channels, n_channels)
+        The minimum-norm perturbation vector of each channel, where
+        ``delta_vecs[..., k, :]`` perturbs channel ``k``. Only returned if
+        ``return_vecs=True``.
+    """
+    if perturb_type not in ("C", "R"):
+        raise ValueError(f"perturb_type must be 'C' or 'R', not {perturb_type}.")
+    scalar_radius = np.ndim(radius) == 0
+    radii = np.atleast_1d(np.asarray(radius, dtype=np.float64))
+
+    real_dtype = A_mats.dtype
+    n_windows, n_chs, _ = A_mats.shape
+    omegas = np.linspace(0, np.pi, n_omega)
+    lambdas = (radii[:, np.newaxis] * np.exp(1j * omegas)).astype(
+        _complex_dtype(real_dtype)
+    )
+
+    pert_norms = np.empty((len(radii), n_windows, n_chs), dtype=real_dtype)
+    if return_vecs:
+        delta_vecs = np.empty((len(radii), n_windows, n_chs, n_chs), dtype=real_dtype)
+
+    eye = np.eye(n_chs, dtype=real_dtype)
+    eps = np.finfo(real_dtype).eps
+    for ridx in range(len(radii)):
+        # (n_windows, n_omega, n_chs, n_chs)
+        shifted = A_mats[:, np.newaxis] - lambdas[ridx, :, np.newaxis, np.newaxis] * eye
+        inv = np.linalg.inv(shifted)
+        if perturb_type == "R":
+            inv = np.swapaxes(inv, -1, -2)
+        b_re, b_im = inv.real, inv.imag
+
+        # entries of the 2x2 Gram matrix [Re b, Im b]^T [Re b, Im b] per row
+        rr = np.einsum("...ij,...ij->...i", b_re, b_re)
+        ii = np.einsum("...ij,...ij->...i", b_im, b_im)
+        ri = np.einsum("...ij,...ij->...i", b_re, b_im)
+        det = rr * ii - ri**2
+
+        # on the real axis (w = 0, pi) the condition is real and the
+        # solution is the scaled row itself
+        real_axis = det <= eps * rr * ii + np.finfo(real_dtype).tiny
+        safe_det = np.where(real_axis, 1, det)
+        norms_sq = np.where(real_axis, 1 / rr, ii / safe_det)
+
+        best = np.argmin(norms_sq, axis=1)  # (n_windows, n_chs)
+        pert_norms[ridx] = np.sqrt(
+            np.take_along_axis(norms_sq, best[:, np.newaxis], axis=1)[:, 0]
+        )
+
+        if return_vecs:
+            pick = best[:, np.newaxis, :, np.newaxis]
+            re = np.take_along_axis(b_re, pick, axis=1)[:, 0]
+            im = np.take_along_axis(b_im, pick, axis=1)[:, 0]
+            pick = best[:, np.newaxis, :]
+            rr_b, ii_b, ri_b, det_b, axis_b = [
+                np.take_along_axis(arr, pick, axis=1)[:, 0][..., np.newaxis]
+                for arr in (rr, ii, ri, safe_det, real_axis)
+            ]
+            delta_vecs[ridx] = np.where(
+                axis_b, -re / rr_b, (-ii_b * re + ri_b * im) / det_b
+            )
+
+    if scalar_radius:
+        pert_norms = pert_norms[0]
+        if return_vecs:
+            delta_vecs = delta_vecs[0]
+    if return_vecs:
+        return pert_norms, delta_vecs
+    return pert_norms
+
+
+def _fit_and_solve(windows, radius, perturb_type, return_all, fit_kws):
+    A_mats = fit_state_matrices(windows, **fit_kws)
+    if return_all:
+        pert_norms, delta_vecs = compute_perturbation_norms(
+            A_mats, radius, perturb_type=perturb_type, return_vecs=True
+        )
+        return pert_norms, A_mats, delta_vecs
+    pert_norms = compute_perturbation_norms(A_mats, radius, perturb_type=perturb_type)
+    return pert_norms, None, None
+
+
+def _fragility_batch(
+    data, starts, winsize, radius, perturb_type, return_all, groups, fit_kws
+):
+    windows = np.stack([data[:, start : start + winsize] for start in starts])
+    if groups is None:
+        return _fit_and_solve(windows, radius, perturb_type, return_all, fit_kws)
+
+    # with a block-diagonal state matrix, (A - lambda I)^{-1} is block-diagonal
+    # too, so each block is fit and perturbed on its own
+    n_wins, n_chs, _ = windows.shape
+    n_radii = np.shape(radius)
+    pert_norms = np.empty(n_radii + (n_wins, n_chs), dtype=windows.dtype)
+    A_mats, delta_vecs = None, None
+    if return_all:
+        A_mats = np.zeros((n_wins, n_chs, n_chs), dtype=windows.dtype)
+        delta_vecs = np.zeros(n_radii + (n_wins, n_chs, n_chs), dtype=windows.dtype)
+    for idx in groups:
+        idx = np.asarray(idx)
+        block_norms, block_A, block_vecs = _fit_and_solve(
+            windows[:, idx], radius, perturb_type, return_all, fit_kws
+        )
+        pert_norms[..., idx] = block_norms
+        if return_all:
+            A_mats[:, idx[:, np.newaxis], idx] = block_A
+            delta_vecs[..., idx[:, np.newaxis], idx] = block_vecs
+    return pert_norms, A_mats, delta_vecs
+
+
+def lds_fragility(
+    data,
+    winsize=250,
+    stepsize=125,
+    radius=1.5,
+    l2penalty=1e-9,
+    perturb_type="C",
+    dtype=np.float64,
+    return_all=False,
+    batch_size=8,
+    n_jobs=1,
+    groups=None,
+    solver="svd",
+    energy=1.0,
+    max_rank=None,
+):
+    """Compute windowed LDS fragility of a data array.
+
+    By default a dense state matrix is fit per window, which costs
+    O(n_channels^3) per window. If ``groups`` is passed, the state matrix
+    is block-diagonal with one block per group (e.g. per electrode shaft,
+    see :func:`spes.bids.utils._group_channels_by_shaft`), which costs the
+    sum of the cubed group sizes instead.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The (preprocessed) data.
+    winsize : int
+        The number of samples per window.
+    stepsize : int
+        The number of samples between window starts.
+    radius : float | array-like of float
+        The radius to move an eigenvalue onto. If an array, the state
+        matrices are fit once and the perturbations of every radius are
+        computed from them.
+    l2penalty : float
+        The Tikhonov regularization of the least-squares fit.
+    perturb_type : str
+        ``"C"`` for column perturbations, ``"R"`` for row perturbations.
+    dtype : np.dtype
+        The floating point dtype used for fitting, solving and the outputs.
+        ``np.float32`` halves the memory and storage of the arrays; it
+        is not faster in general, see
+        :func:`spes.fragility.validate.compare_precision`.
+    return_all : bool
+        Whether to also return the state matrices and perturbation vectors.
+    batch_size : int
+        The number of windows fit and solved together.
+    n_jobs : int
+        The number of batches computed in parallel (threads).
+    groups : list of list of int | None
+        Channel indices of each block of a block-diagonal state matrix.
+        Every channel must be in exactly one group. If None, a dense state
+        matrix is fit.
+    solver : str
+        The SVD solver of the least-squares fit, see
+        :func:`fit_state_matrices`.
+    energy : float
+        The fraction of energy of each window kept in the pseudo-inverse.
+    max_rank : int | None
+        The number of singular vectors estimated by the randomized solver.
+
+    Returns
+    -------
+    pert_mat : np.ndarray, shape ([n_radii,] n_channels, n_windows)
+        The minimum-norm perturbation of each channel per window. The
+        leading axis is only present if ``radius`` is an array.
+    state_arr : np.ndarray, shape (n_channels * n_channels, n_windows)
+        The flattened (row-major) state matrix of each window. Only
+        returned if ``return_all=True``.
+    delta_vecs_arr : np.ndarray, shape ([n_radii,] n_channels * n_channels, n_windows)
+        The flattened perturbation vectors of each window, where rows
+        ``k * n_channels : (k + 1) * n_channels`` perturb channel ``k``.
+        Only returned if ``return_all=True``.
+    """
+    data = np.asarray(data, dtype=dtype)
+    n_chs, n_times = data.shape
+    n_windows = compute_n_windows(n_times, winsize, stepsize)
+    starts = np.arange(n_windows) * stepsize
+    if groups is not None:
+        covered = np.sort(np.concatenate([np.asarray(idx) for idx in groups]))
+        if not np.array_equal(covered, np.arange(n_chs)):
+            raise ValueError("Every channel must be in exactly one group.")
+
+    fit_kws = dict(l2penalty=l2penalty, solver=solver, energy=energy, max_rank=max_rank)
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_fragility_batch)(
+            data,
+            starts[idx : idx + batch_size],
+            winsize,
+            radius,
+            perturb_type,
+            return_all,
+            groups,
+            fit_kws,
+        )
+        for idx in range(0, n_windows, batch_size)
+    )
+
+    n_radii = np.shape(radius)
+    pert_mat = np.empty(n_radii + (n_chs, n_windows), dtype=dtype)
+    if return_all:
+        state_arr = np.empty((n_chs * n_chs, n_windows), dtype=dtype)
+        delta_vecs_arr = np.empty(n_radii + (n_chs * n_chs, n_windows), dtype=dtype)
+    for bidx, (pert_norms, A_mats, delta_vecs) in enumerate(results):
+        n_batch = pert_norms.shape[-2]
+        win_slice = slice(bidx * batch_size, bidx * batch_size + n_batch)
+        pert_mat[..., win_slice] = np.swapaxes(pert_norms, -1, -2)
+        if return_all:
+            state_arr[:, win_slice] = A_mats.reshape(n_batch, -1).T
+            delta_vecs_arr[..., win_slice] = np.swapaxes(
+                delta_vecs.reshape(n_radii + (n_batch, -1)), -1, -2
+            )
+
+    if return_all:
+        return pert_mat, state_arr, delta_vecs_arr
+    return pert_mat
@@ -0,0 +1,358 @@
+"""Online fragility over a live stream of sample blocks."""
+
+import socket
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+from spes.fragility.lds import compute_perturbation_norms, fit_state_matrices
+from spes.preprocess import StreamingFilter
+
+
+class OnlineFragility:
+    """Compute fragility columns as samples arrive.
+
+    The last ``winsize`` (preprocessed) samples are kept in a ring buffer.
+    Every ``stepsize`` samples, the LDS of the buffered window is fit and
+    the perturbation norm of each channel is emitted as a new column, so
+    the columns match the windows of
+    :func:`spes.fragility.lds.lds_fragility` on the same (causally
+    filtered) data.
+
+    Parameters
+    ----------
+    n_channels : int
+        The number of channels of the stream.
+    sfreq : float
+        The sampling frequency of the stream.
+    winsize, stepsize, radius, l2penalty
+        The model parameters, see :func:`spes.fragility.lds.lds_fragility`.
+    line_freq : float | None
+        The power line frequency, used by the streaming preprocessing.
+    preprocess : bool
+        Whether to filter incoming samples with
+        :class:`spes.preprocess.StreamingFilter`. Set to False if the
+        stream is already preprocessed.
+    max_latency : float | None
+        The maximum time in seconds between the arrival of a window's last
+        sample and the start of its computation. Windows that are later,
+        because computing falls behind the stream, are skipped and emitted
+        as NaN columns, so latency stays bounded.
+    max_columns : int | None
+        The number of most recent columns kept in :attr:`pert_mat`.
+    on_column : callable | None
+        Called with ``(window_index, column)`` for every emitted column.
+
+    Attributes
+    ----------
+    latencies : collections.deque of float
+        Seconds from the arrival of each computed window to its emission.
+    n_dropped : int
+        The number of windows skipped because of ``max_latency``.
+    """
+
+    def __init__(
+        self,
+        n_channels,
+        sfreq,
+        winsize=250,
+        stepsize=125,
+        radius=1.5,
+        l2penalty=1e-9,
+        line_freq=60.0,
+        preprocess=True,
+        max_latency=None,
+        max_columns=None,
+        on_column=None,
+    ):
+        if stepsize > winsize:
+            raise ValueError(
+                f"stepsize ({stepsize}) must not be larger than winsize ({winsize})."
+            )
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.winsize = winsize
+        self.stepsize = stepsize
+        self.radius = radius
+        self.l2penalty = l2penalty
+        self.max_latency = max_latency
+        self.on_column = on_column
+        self.filter = (
+            StreamingFilter(sfreq, n_channels, line_freq) if preprocess else None
+        )
+
+        self._buffer = np.zeros((n_channels, winsize))
+        self._write_idx = 0
+        self.n_samples = 0
+        self.n_windows = 0
+        self.n_dropped = 0
+        self.latencies = deque(maxlen=10_000)
+        self._columns = deque(maxlen=max_columns)
+
+    @property
+    def pert_mat(self):
+        """The emitted columns, shape (n_channels, n_columns)."""
+        if not self._columns:
+            return np.empty((self.n_channels, 0))
+        return np.column_stack(self._columns)
+
+    def _next_emit_sample(self):
+        return self.winsize + self.n_windows * self.stepsize
+
+    def _write(self, block):
+        # the block is never longer than the buffer, see ``push``
+        n = block.shape[1]
+        end = self._write_idx + n
+        if end <= self.winsize:
+            self._buffer[:, self._write_idx : end] = block
+        else:
+            split = self.winsize - self._write_idx
+            self._buffer[:, self._write_idx :] = block[:, :split]
+            self._buffer[:, : n - split] = block[:, split:]
+        self._write_idx = end % self.winsize
+        self.n_samples += n
+
+    def _window(self):
+        # oldest sample first
+        return np.concatenate(
+            [self._buffer[:, self._write_idx :], self._buffer[:, : self._write_idx]],
+            axis=1,
+        )
+
+    def _emit(self, arrival):
+        widx = self.n_windows
+        self.n_windows += 1
+        if self.max_latency is not None and (
+            time.perf_counter() - arrival > self.max_latency
+        ):
+            self.n_dropped += 1
+            column = np.full(self.n_channels, np.nan)
+        else:
+            A_mats = fit_state_matrices(
+                self._window()[np.newaxis], l2penalty=self.l2penalty
+            )
+            column = compute_perturbation_norms(A_mats, self.radius)[0]
+            self.latencies.append(time.perf_counter() - arrival)
+        self._columns.append(column)
+        if self.on_column is not None:
+            self.on_column(widx, column)
+        return widx, column
+
+    def push(self, block, arrival=None):
+        """Consume the next block of samples.
+
+        Parameters
+        ----------
+        block : np.ndarray, shape (n_channels, n_samples)
+            The next samples of the stream, of any length.
+        arrival : float | None
+            The ``time.perf_counter()`` time the block was received.
+            Defaults to now.
+
+        Returns
+        -------
+        columns : list of tuple
+            The ``(window_index, column)`` of each window completed by this
+            block.
+        """
+        if arrival is None:
+            arrival = time.perf_counter()
+        block = np.asarray(block, dtype=np.float64)
+        if self.filter is not None:
+            block = self.filter.process(block)
+
+        columns = []
+        start = 0
+        while start < block.shape[1]:
+            # write up to the end of the next window, then emit it
+            n_missing = self._next_emit_sample() - self.n_samples
+            stop = min(start + n_missing, start + self.winsize, block.shape[1])
+            self._write(block[:, start:stop])
+            start = stop
+            if self.n_samples == self._next_emit_sample():
+                columns.append(self._emit(arrival))
+        return columns
+
+    def latency_summary(self):
+        """Summarize the emission latency in seconds.
+
+        Returns
+        -------
+        summary : dict
+            The mean, median, 95th percentile and max latency, and the
+            number of computed and dropped windows.
+        """
+        latencies = np.array(self.latencies)
+        if latencies.size == 0:
+            latencies = np.array([np.nan])
+        return {
+            "n_windows": self.n_windows,
+            "n_dropped": self.n_dropped,
+            "latency_mean": float(np.mean(latencies)),
+            "latency_median": float(np.median(latencies)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_max": float(np.max(latencies)),
+        }
+
+
+def _iter_frames(read_fn, n_channels, dtype, wait_fn=None):
+    """Parse multiplexed samples from a byte stream into blocks.
+
+    ``read_fn`` returns the next available bytes, and ``b""`` if there are
+    none. If ``wait_fn`` is None, no bytes mean the end of the stream,
+    otherwise ``wait_fn`` is called and returns whether to keep waiting.
+    """
+    dtype = np.dtype(dtype)
+    frame_bytes = n_channels * dtype.itemsize
+    pending = b""
+    while True:
+        chunk = read_fn()
+        if not chunk:
+            if wait_fn is None or not wait_fn():
+                return
+            continue
+        pending += chunk
+        n_frames = len(pending) // frame_bytes
+        if n_frames == 0:
+            continue
+        data = np.frombuffer(pending[: n_frames * frame_bytes], dtype=dtype)
+        pending = pending[n_frames * frame_bytes :]
+        yield data.reshape(n_frames, n_channels).T
+
+
+def iter_file_blocks(
+    fpath,
+    n_channels,
+    dtype=np.float32,
+    block_bytes=65536,
+    poll_interval=0.05,
+    timeout=5.0,
+):
+    """Stream sample blocks from a binary file that is being appended to.
+
+    The file holds multiplexed samples (all channels of sample 0, then of
+    sample 1, ...), as in BrainVision ``.eeg`` files. Reading waits for new
+    data and stops once the file has not grown for ``timeout`` seconds.
+
+    Parameters
+    ----------
+    fpath : str | Path
+        The file to follow.
+    n_channels : int
+        The number of channels per sample.
+    dtype : np.dtype
+        The sample dtype in the file.
+    block_bytes : int
+        The maximum number of bytes read at once.
+    poll_interval : float
+        Seconds to wait before checking the file for new data.
+    timeout : float | None
+        Seconds without new data before the stream is considered ended.
+        If None, wait forever.
+
+    Yields
+    ------
+    block : np.ndarray, shape (n_channels, n_samples)
+    """
+    with open(Path(fpath), "rb") as fin:
+        last_data = time.monotonic()
+
+        def _read():
+            nonlocal last_data
+            chunk = fin.read(block_bytes)
+            if chunk:
+                last_data = time.monotonic()
+            return chunk
+
+        def _wait():
+            if timeout is not None and time.monotonic() - last_data > timeout:
+                return False
+            time.sleep(poll_interval)
+            return True
+
+        yield from _iter_frames(_read, n_channels, dtype, wait_fn=_wait)
+
+
+def iter_socket_blocks(host, port, n_channels, dtype=np.float32, block_bytes=65536):
+    """Stream sample blocks from a TCP socket.
+
+    The sender writes multiplexed samples, see :func:`iter_file_blocks`.
+    The stream ends when the sender closes the connection.
+
+    Parameters
+    ----------
+    host : str
+        The host to connect to, e.g. ``"localhost"``.
+    port : int
+        The port to connect to.
+    n_channels : int
+        The number of channels per sample.
+    dtype : np.dtype
+        The sample dtype on the wire.
+    block_bytes : int
+        The maximum number of bytes received at once.
+
+    Yields
+    ------
+    block : np.ndarray, shape (n_channels, n_samples)
+    """
+    with socket.create_connection((host, port)) as sock:
+        yield from _iter_frames(
+            lambda: sock.recv(block_bytes), n_channels, dtype, wait_fn=None
+        )
+
+
+def replay_bids(bids_path, speed=1.0, block_duration=0.1, **online_kws):
+    """Replay a BIDS recording through the online engine.
+
+    The recording is read, restricted to the channels analyzed by
+    :func:`spes.read.load_data` without its bad channels, and fed in
+    blocks of ``block_duration`` seconds, paced at ``speed`` times real
+    time. The raw samples are pushed, so preprocessing happens in the
+    engine's causal filter as it would on a live stream.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording to replay.
+    speed : float | None
+        How many times faster than real time to replay. If None, blocks
+        are pushed as fast as they are consumed.
+    block_duration : float
+        The duration of each pushed block in seconds.
+    **online_kws
+        Keyword arguments passed to :class:`OnlineFragility`.
+
+    Returns
+    -------
+    engine : OnlineFragility
+        The engine after the whole recording, with the emitted columns in
+        ``pert_mat`` and its latencies.
+    ch_names : list of str
+        The channel names of the rows of ``pert_mat``.
+    """
+    from mne_bids import read_raw_bids
+
+    raw = read_raw_bids(bids_path, verbose=False)
+    raw.pick_types(seeg=True, ecog=True, eeg=True, misc=False, exclude="bads")
+    data = raw.get_data()
+    sfreq = raw.info["sfreq"]
+    online_kws.setdefault("line_freq", raw.info["line_freq"])
+
+    engine = OnlineFragility(len(raw.ch_names), sfreq, **online_kws)
+    block_size = max(1, int(round(block_duration * sfreq)))
+    start_time = time.perf_counter()
+    for start in range(0, data.shape[1], block_size):
+        due = None
+        if speed is not None:
+            # wait until the block would have been recorded, which is when it
+            # arrives even if the engine is behind, so latency includes the
+            # backlog
+            due = start_time + (start + block_size) / sfreq / speed
+            time.sleep(max(0.0, due - time.perf_counter()))
+        engine.push(data[:, start : start + block_size], arrival=due)
+
+    print(f"Replayed {bids_path.basename}: {engine.latency_summary()}")
+    return engine, raw.ch_names
@@ -1,59 +1,561 @@
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
-import mne
 import numpy as np
-import pandas as pd
 from eztrack.fragility import lds_raw_fragility
 from eztrack.utils import logger
 from mne.utils import warn
-from mne_bids import BIDSPath, get_entity_vals
+from mne_bids import BIDSPath, get_entity_vals, read_raw_bids
 
-from spes.read import load_data
+from spes.autotune import autotune, get_resources, limit_blas_threads, plan_workers
+from spes.bids.metadata import (
+    SEIZURE_OFFSET_EVENTS,
+    SEIZURE_ONSET_EVENTS,
+    read_recording_metadata,
+)
+from spes.bids.utils import _group_channels_by_shaft
+from spes.fragility.io import (
+    OUTPUT_PROFILES,
+    PERTURB_DESCRIPTION,
+    AsyncDerivativeWriter,
+    get_output_profile,
+    save_atomic,
+    save_fragility_arrays,
+    write_fragility_sidecar,
+)
+from spes.fragility.lds import compute_n_windows, lds_fragility
+from spes.fragility.summary import summarize_fragility
+from spes.jobqueue import submit_fragility_jobs
+from spes.preprocess import REFERENCES, apply_reference
+from spes.read import load_data, prefetch_data
+from spes.viz import plot_fragility_heatmap, wait_for_figures
 
 logger.setLevel(logging.DEBUG)
 
 
 def run_analysis(
+    bids_path,
+    reference="monopolar",
+    resample_sfreq=None,
+    deriv_path=None,
+    figures_path=None,
+    verbose=True,
+    overwrite=False,
+    plot_heatmap=True,
+    plot_raw=True,
+    heatmap_executor=None,
+    writer=None,
+    raw=None,
+    dtype=None,
+    output_profile="full",
+    state_structure="dense",
+    **model_params,
+):
+    """Compute and save fragility derivatives of one recording.
+
+    The heatmap is a separate stage that only reads the saved perturbation
+    matrix. If ``heatmap_executor`` is passed, the heatmap is submitted to
+    it and the future is returned, so the caller can move on to the next
+    recording while the figure is rendered.
+
+    If ``writer`` (a :class:`spes.fragility.io.AsyncDerivativeWriter`) is
+    passed, the derivatives are saved in its background threads and a
+    future is returned that resolves once they are written, to the heatmap
+    future or None. Files are written under temporary names and renamed
+    in place, the perturbation matrix last, so an interrupted write is
+    never mistaken for a finished recording.
+
+    If ``raw`` is passed, it is used instead of loading the recording, e.g.
+    when it was loaded ahead with :func:`spes.read.prefetch_data`. It must
+    be preprocessed as by :func:`spes.read.load_data` and without bad
+    channels.
+
+    If ``dtype`` is passed (e.g. ``np.float32``), the LDS fit, perturbation
+    solve and saved derivatives use that dtype via
+    :func:`spes.fragility.lds.lds_fragility`. Reading and filtering stay in
+    float64, which MNE requires; the data is cast once after preprocessing.
+
+    ``output_profile`` selects what is saved. ``"full"`` saves the
+    perturbation matrix, state matrices and perturbation vectors.
+    ``"minimal"`` only keeps the per-channel perturbation norms, so the
+    O(n_channels^2 * n_windows) state arrays are never held in memory. The
+    profile is recorded in the parameter sidecar, and an existing minimal
+    derivative is recomputed if the full profile is requested.
+
+    ``state_structure="block"`` fits a block-diagonal state matrix with one
+    block per electrode, grouping channels by their name prefix. This
+    scales with the size of the largest electrode instead of the whole
+    montage; see :func:`spes.fragility.validate.compare_state_structure`
+    for the runtime/accuracy trade-off against the dense fit.
+
+    ``n_jobs`` defaults to the cores of the node, see
+    :func:`spes.autotune.plan_workers`. With ``n_jobs="auto"``, the number
+    of workers, BLAS threads and the batch size of the numpy engine are
+    chosen by :func:`spes.autotune.autotune` for the node and the shape of
+    the recording. This benchmarks the fit the first time a host and shape
+    are seen, which can take a minute on large montages. eztrack's
+    ``lds_raw_fragility`` (the default float64, full, dense fit) is not
+    tuned and keeps the default. The parallelism used is recorded in the
+    parameter sidecar.
+
+    Any non-default ``dtype``, ``output_profile`` or ``state_structure``
+    runs the fit with :func:`spes.fragility.lds.lds_fragility` instead of
+    eztrack. The engine is recorded as ``"engine"`` in the parameter
+    sidecar; see :func:`spes.fragility.validate.compare_engines` for the
+    agreement of the two.
+    """
+    _check_model_options(output_profile, state_structure)
+    deriv_path, figures_path = _get_derivative_paths(
+        bids_path, reference, deriv_path, figures_path
+    )
+
+    # check if we have original dataset
+    skip, overwrite = _check_existing_derivatives(
+        bids_path, deriv_path, output_profile, overwrite
+    )
+    if skip:
+        return
+
+    # load in raw data, unless it was loaded ahead by the driver
+    if raw is None:
+        raw = _load_recording(bids_path, resample_sfreq, plot_raw, verbose)
+
+    return _compute_and_save(
+        raw,
         bids_path,
-        reference="monopolar",
-        resample_sfreq=None,
-        deriv_path=None,
-        figures_path=None,
-        verbose=True,
-        overwrite=False,
-        plot_heatmap=True,
-        plot_raw=True,
+        reference,
+        deriv_path,
+        figures_path,
+        overwrite=overwrite,
+        plot_heatmap=plot_heatmap,
+        heatmap_executor=heatmap_executor,
+        writer=writer,
+        dtype=dtype,
+        output_profile=output_profile,
+        state_structure=state_structure,
         **model_params,
+    )
+
+
+def run_multi_reference_analysis(
+    bids_path,
+    references=REFERENCES,
+    resample_sfreq=None,
+    deriv_path=None,
+    figures_path=None,
+    verbose=True,
+    overwrite=False,
+    plot_heatmap=True,
+    plot_raw=True,
+    heatmap_executor=None,
+    max_workers=None,
+    **kwargs,
 ):
-    n_jobs = 3
+    """Compute fragility of one recording under several references.
+
+    The recording is read and preprocessed once. Each reference is derived
+    from the preprocessed buffer with :func:`spes.preprocess.apply_reference`
+    and the fragility computations of all references run concurrently,
+    each writing to its own ``fragility/<reference>/`` tree. References
+    whose derivatives already exist are skipped as in :func:`run_analysis`,
+    and the recording is not read at all if every reference is done.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording to analyze.
+    references : tuple of str
+        The references to compute, any of ``"monopolar"``, ``"bipolar"``
+        and ``"average"``.
+    max_workers : int | None
+        The number of references computed at the same time. Defaults to
+        all of them.
+    **kwargs
+        The remaining parameters of :func:`run_analysis`, except
+        ``reference``.
+
+    Returns
+    -------
+    heatmap_futures : dict
+        The heatmap future of each computed reference, or None if the
+        heatmap was rendered inline or not at all.
+    """
+    if "reference" in kwargs:
+        raise ValueError(
+            f"Pass the references to compute as references, not "
+            f"reference={kwargs['reference']}."
+        )
+    _check_model_options(
+        kwargs.get("output_profile", "full"),
+        kwargs.get("state_structure", "dense"),
+    )
+    pending = dict()
+    for reference in references:
+        if reference not in REFERENCES:
+            raise ValueError(f"reference must be one of {REFERENCES}, not {reference}.")
+        ref_deriv_path, ref_figures_path = _get_derivative_paths(
+            bids_path, reference, deriv_path, figures_path
+        )
+        skip, ref_overwrite = _check_existing_derivatives(
+            bids_path, ref_deriv_path, kwargs.get("output_profile", "full"), overwrite
+        )
+        if not skip:
+            pending[reference] = (ref_deriv_path, ref_figures_path, ref_overwrite)
+    if not pending:
+        return dict()
+
+    # load and preprocess the monopolar data once for all references
+    raw = _load_recording(bids_path, resample_sfreq, plot_raw, verbose)
+
+    # the references share the cores, so they are tuned together and BLAS
+    # threads are limited once for all of them
+    n_concurrent = min(max_workers or len(pending), len(pending))
+    blas_threads = None
+    use_eztrack = _use_eztrack(
+        kwargs.get("dtype"),
+        kwargs.get("output_profile", "full"),
+        kwargs.get("state_structure", "dense"),
+    )
+    kwargs["n_jobs"] = _check_n_jobs(
+        kwargs.get("n_jobs"), use_eztrack, n_concurrent=n_concurrent
+    )
+    if kwargs["n_jobs"] == "auto":
+        tuning = _autotune_recording(
+            raw, kwargs.get("dtype"), n_concurrent=n_concurrent
+        )
+        blas_threads = tuning["blas_threads"]
+        kwargs.update(n_jobs=tuning["n_jobs"], batch_size=tuning["batch_size"])
+
+    with limit_blas_threads(blas_threads), ThreadPoolExecutor(
+        max_workers=n_concurrent
+    ) as executor:
+        futures = dict()
+        for reference, ref_paths in pending.items():
+            ref_deriv_path, ref_figures_path, ref_overwrite = ref_paths
+            raw_ref = apply_reference(raw, reference)
+            futures[reference] = executor.submit(
+                _compute_and_save,
+                raw_ref,
+                bids_path,
+                reference,
+                ref_deriv_path,
+                ref_figures_path,
+                overwrite=ref_overwrite,
+                plot_heatmap=plot_heatmap,
+                heatmap_executor=heatmap_executor,
+                **kwargs,
+            )
+        heatmap_futures = {
+            reference: future.result() for reference, future in futures.items()
+        }
+    return heatmap_futures
+
+
+def run_event_analysis(
+    bids_path,
+    reference="monopolar",
+    pre_seconds=300.0,
+    post_seconds=300.0,
+    pad_seconds=10.0,
+    descriptions=SEIZURE_ONSET_EVENTS + SEIZURE_OFFSET_EVENTS,
+    resample_sfreq=None,
+    deriv_path=None,
+    figures_path=None,
+    verbose=True,
+    overwrite=False,
+    dtype=np.float64,
+    **kwargs,
+):
+    """Compute fragility only around the annotated seizure events.
+
+    The events sidecar is read first, and the spans of ``pre_seconds``
+    before to ``post_seconds`` after each event are merged where they
+    overlap. Only these spans are read from disk and preprocessed, each
+    with ``pad_seconds`` of padding on both sides that is cropped after
+    filtering. Fragility is computed per span with
+    :func:`spes.fragility.lds.lds_fragility`, after re-referencing with
+    :func:`spes.preprocess.apply_reference`.
+
+    Each span is saved with the BIDS ``split`` entity (``split-01``,
+    ``split-02``, ...) under ``<deriv_path>/events/fragility/<reference>``.
+    Spans whose perturbation matrix exists are skipped as in
+    :func:`run_analysis`, so an interrupted run computes only the missing
+    spans.
+    Its sidecar records the sample (``first_sample``) and time (``tmin``)
+    of the recording the span starts at, so window ``w`` starts at sample
+    ``first_sample + w * stepsize`` of the recording.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording to analyze.
+    reference : str
+        One of ``"monopolar"``, ``"bipolar"`` or ``"average"``.
+    pre_seconds : float
+        The duration before each event to analyze.
+    post_seconds : float
+        The duration after each event to analyze.
+    pad_seconds : float
+        The padding read on both sides of each span for the filters.
+    descriptions : tuple of str
+        The ``trial_type`` values of the events to analyze around.
+    resample_sfreq : float | None
+        The sampling frequency to resample to.
+    deriv_path : str | Path | None
+        The derivative root. Defaults to
+        ``<root>/derivatives/originalsampling/radius1.5`` of ``bids_path``.
+    figures_path : str | Path | None
+        Where to save heatmaps. Defaults to ``<deriv_path>/figures``. The raw
+        QC figure of each span is saved under
+        ``<root>/derivatives/figures/raw/sub-<subject>/events/split-<idx>``.
+    dtype : np.dtype
+        The floating point dtype of the fit and the saved arrays.
+    **kwargs
+        The remaining parameters of :func:`run_analysis`, except ``raw``.
+
+    Returns
+    -------
+    results : list
+        The return value of the save of each computed span, see
+        :func:`run_analysis`.
+    """
+    _check_model_options(
+        kwargs.get("output_profile", "full"),
+        kwargs.get("state_structure", "dense"),
+    )
+    plot_raw = kwargs.pop("plot_raw", False)
+    deriv_path, figures_path = _get_derivative_roots(
+        bids_path, deriv_path, figures_path
+    )
+    deriv_path, figures_path = _get_derivative_paths(
+        bids_path, reference, deriv_path / "events", figures_path / "events"
+    )
+    # find the spans from the sidecars and the header, before reading data
+    metadata = read_recording_metadata(bids_path)
+    duration = read_raw_bids(bids_path, verbose=False).times[-1]
+    spans = metadata.get_event_spans(
+        descriptions, pre_seconds, post_seconds, duration=duration
+    )
+    if not spans:
+        warn(f"No {descriptions} events in {bids_path.basename}. Skipping...")
+        return []
+    span_duration = sum(tmax - tmin for tmin, tmax in spans)
+    print(
+        f"Analyzing {len(spans)} spans of {span_duration:.1f}s "
+        f"({100 * span_duration / duration:.1f}% of the recording)"
+    )
+
+    results = []
+    for idx, (tmin, tmax) in enumerate(spans):
+        split = f"{idx + 1:02d}"
+        split_path = bids_path.copy().update(split=split)
+        # a run that was interrupted is completed span by span
+        skip, split_overwrite = _check_existing_derivatives(
+            split_path, deriv_path, kwargs.get("output_profile", "full"), overwrite
+        )
+        if skip:
+            continue
+        raw = load_data(
+            bids_path,
+            resample_sfreq,
+            _get_raw_figures_path(bids_path) / "events" / f"split-{split}",
+            plot_raw=plot_raw,
+            verbose=verbose,
+            tmin=tmin,
+            tmax=tmax,
+            pad=pad_seconds,
+        )
+        raw.drop_channels(raw.info["bads"])
+        raw = apply_reference(raw, reference)
+        results.append(
+            _compute_and_save(
+                raw,
+                split_path,
+                reference,
+                deriv_path,
+                figures_path,
+                overwrite=split_overwrite,
+                dtype=dtype,
+                first_sample=int(round(tmin * raw.info["sfreq"])),
+                **kwargs,
+            )
+        )
+    return results
+
+
+def _load_recording(bids_path, resample_sfreq=None, plot_raw=True, verbose=True):
+    """Load and preprocess a recording, without its bad channels."""
+    raw = load_data(
+        bids_path,
+        resample_sfreq,
+        _get_raw_figures_path(bids_path),
+        plot_raw=plot_raw,
+        verbose=verbose,
+    )
+
+    # use the same basename to save the data
+    raw.drop_channels(raw.info["bads"])
+    return raw
+
+
+def _get_raw_figures_path(bids_path):
+    """Get the directory of the raw QC figures of a recording."""
+    return (
+        bids_path.root / "derivatives" / "figures" / "raw" / f"sub-{bids_path.subject}"
+    )
+
+
+def _autotune_recording(raw, dtype, n_concurrent=1, winsize=250, stepsize=125):
+    """Choose the parallelism of the fragility fit of a loaded recording."""
+    return autotune(
+        len(raw.ch_names),
+        winsize=winsize,
+        n_windows=compute_n_windows(raw.n_times, winsize, stepsize),
+        dtype=dtype or np.float64,
+        n_concurrent=n_concurrent,
+    )
+
+
+def _use_eztrack(dtype, output_profile, state_structure):
+    """Whether the fit runs eztrack's lds_raw_fragility or the numpy engine.
+
+    Warns when the options move the fit to the numpy engine, since its
+    derivatives are only told apart from eztrack's by the ``engine`` key
+    of their sidecar.
+    """
+    changed = [
+        f"{name}={value!r}"
+        for name, value, is_default in (
+            ("dtype", dtype, dtype is None),
+            ("output_profile", output_profile, output_profile == "full"),
+            ("state_structure", state_structure, state_structure == "dense"),
+        )
+        if not is_default
+    ]
+    if changed:
+        warn(
+            f"{', '.join(changed)} is not supported by eztrack's "
+            "lds_raw_fragility, so the fit runs on the numpy engine instead. "
+            'Its sidecars record "engine": "numpy".'
+        )
+    return not changed
+
+
+def _check_n_jobs(n_jobs, use_eztrack, n_concurrent=1):
+    """Resolve the default ``n_jobs``, keeping ``"auto"`` for the numpy engine.
+
+    By default, the ``n_concurrent`` fits share the cores of the node. The
+    autotuner only benchmarks the numpy engine, so eztrack's fit keeps the
+    default number of workers.
+    """
+    if n_jobs is None or (n_jobs == "auto" and use_eztrack):
+        plan = plan_workers(background=False, n_concurrent=n_concurrent)
+        if n_jobs == "auto":
+            warn(
+                "n_jobs='auto' only tunes the numpy engine, not eztrack's "
+                f"lds_raw_fragility. Using n_jobs={plan['fit_n_jobs']}."
+            )
+        return plan["fit_n_jobs"]
+    return n_jobs
+
+
+def _check_model_options(output_profile, state_structure):
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(
+            f"output_profile must be one of {list(OUTPUT_PROFILES)}, "
+            f"not {output_profile}."
+        )
+    if state_structure not in ("dense", "block"):
+        raise ValueError(
+            f"state_structure must be 'dense' or 'block', not {state_structure}."
+        )
+
+
+def _get_derivative_roots(bids_path, deriv_path=None, figures_path=None):
+    """Get the derivative and heatmap roots, with the defaults of main_run_jhu."""
+    if deriv_path is None:
+        deriv_path = (
+            bids_path.root / "derivatives" / "originalsampling" / "radius1.5"
+        )
+    deriv_path = Path(deriv_path)
+    if figures_path is None:
+        figures_path = deriv_path / "figures"
+    return deriv_path, Path(figures_path)
+
+
+def _get_derivative_paths(bids_path, reference, deriv_path, figures_path):
+    """Get the derivative and heatmap directories of a recording."""
     subject = bids_path.subject
-    root = bids_path.root
+    deriv_path, figures_path = _get_derivative_roots(
+        bids_path, deriv_path, figures_path
+    )
 
     # get the root derivative path
     deriv_chain = Path("fragility") / reference / f"sub-{subject}"
-    raw_figures_path = root / "derivatives" / "figures" / "raw" / f"sub-{subject}"
     figures_path = figures_path / deriv_chain
     deriv_path = deriv_path / deriv_chain
+    return deriv_path, figures_path
 
-    # check if we have original dataset
+
+def _check_existing_derivatives(bids_path, deriv_path, output_profile, overwrite):
+    """Check if the derivatives of a recording can be skipped.
+
+    Returns whether to skip the recording, and whether existing files have
+    to be overwritten because they lack part of ``output_profile``. The
+    perturbation matrix is saved last, so only its existence marks the
+    recording as done. For a span of an event run, ``bids_path`` has the
+    ``split`` entity and only that span is checked.
+    """
     source_basename = bids_path.copy().update(extension=None, suffix=None).basename
-    deriv_fpaths = deriv_path.glob(f"{source_basename}*.npy")
-    if not overwrite and len(list(deriv_fpaths)) > 0:
+    perturb_fpaths = list(
+        deriv_path.glob(f"{source_basename}_*{PERTURB_DESCRIPTION}*.npy")
+    )
+    if overwrite or len(perturb_fpaths) == 0:
+        return False, overwrite
+
+    existing_profile = get_output_profile(perturb_fpaths[0])
+    if set(OUTPUT_PROFILES[output_profile]) <= set(OUTPUT_PROFILES[existing_profile]):
         warn(
             f"Not overwrite and the derivative file path for {source_basename} already exists. "
             f"Skipping..."
         )
-        return
-
-    # load in raw data
-    raw = load_data(
-        bids_path, resample_sfreq, raw_figures_path, plot_raw=plot_raw, verbose=verbose
+        return True, overwrite
+    print(
+        f"Existing derivative of {source_basename} has the {existing_profile} "
+        f"output profile, recomputing with the {output_profile} profile."
     )
+    return False, True
 
-    # use the same basename to save the data
-    raw.drop_channels(raw.info["bads"])
 
+def _compute_and_save(
+    raw,
+    bids_path,
+    reference,
+    deriv_path,
+    figures_path,
+    overwrite=False,
+    plot_heatmap=True,
+    heatmap_executor=None,
+    writer=None,
+    dtype=None,
+    output_profile="full",
+    state_structure="dense",
+    n_jobs=None,
+    batch_size=8,
+    first_sample=0,
+    **model_params,
+):
+    """Compute fragility of a loaded recording and save its derivatives.
+
+    See :func:`run_analysis` for the parameters. ``raw`` is the preloaded
+    recording without bad channels, already in ``reference``. If ``raw`` is
+    a span of the recording, ``first_sample`` is the sample of the
+    recording it starts at, which is recorded in the sidecar. If ``n_jobs``
+    is ``"auto"`` and the numpy engine is used, it, the BLAS threads and
+    ``batch_size`` are autotuned.
+    """
     print(f"Analyzing {raw} with {len(raw.ch_names)} channels.")
 
     order = model_params.get("order", 1)
@@ -71,94 +573,265 @@ def run_analysis(
         # "fb": True,
         "l2penalty": l2penalty,
     }
-    # run heatmap
-    perturb_deriv, state_arr_deriv, delta_vecs_arr_deriv = lds_raw_fragility(
-        raw,
-        order=order,
-        reference=reference,
-        return_all=True,
-        n_jobs=n_jobs,
+    use_eztrack = _use_eztrack(dtype, output_profile, state_structure)
+    blas_threads = None
+    n_jobs = _check_n_jobs(n_jobs, use_eztrack)
+    if n_jobs == "auto":
+        tuning = _autotune_recording(
+            raw,
+            dtype,
+            winsize=model_params["winsize"],
+            stepsize=model_params["stepsize"],
+        )
+        n_jobs, blas_threads = tuning["n_jobs"], tuning["blas_threads"]
+        batch_size = tuning["batch_size"]
+
+    # record the parameters next to the perturbation matrix, so the heatmap
+    # and summary stages can read it without the raw data
+    sidecar_params = {
+        "ch_names": raw.ch_names,
+        "sfreq": raw.info["sfreq"],
+        "reference": reference,
+        "order": order,
+        "engine": "eztrack" if use_eztrack else "numpy",
+        "dtype": np.dtype(dtype or np.float64).name,
+        "output_profile": output_profile,
+        "state_structure": state_structure,
+        "first_sample": first_sample,
+        "tmin": first_sample / raw.info["sfreq"],
+        "parallel": {
+            "n_jobs": n_jobs,
+            "blas_threads": blas_threads,
+            "batch_size": batch_size,
+        },
         **model_params,
+    }
+    if use_eztrack:
+        derivs = lds_raw_fragility(
+            raw,
+            order=order,
+            reference=reference,
+            return_all=True,
+            n_jobs=n_jobs,
+            **model_params,
+        )
+        save_job = partial(
+            _save_eztrack_derivatives, deriv_path, derivs, sidecar_params, overwrite
+        )
+    else:
+        return_all = output_profile == "full"
+        groups = None
+        if state_structure == "block":
+            groups = list(_group_channels_by_shaft(raw.ch_names).values())
+            if max(len(idx) for idx in groups) == 1:
+                raise ValueError(
+                    f"Every channel of {bids_path.basename} is an electrode of its "
+                    f"own, so a block-diagonal state matrix has 1x1 blocks. Use "
+                    'state_structure="dense".'
+                )
+            print(f"Fitting block-diagonal state matrices of {len(groups)} electrodes")
+        with limit_blas_threads(blas_threads):
+            fragility_arrs = lds_fragility(
+                raw.get_data(),
+                winsize=model_params["winsize"],
+                stepsize=model_params["stepsize"],
+                radius=model_params["radius"],
+                l2penalty=model_params["l2penalty"],
+                dtype=dtype or np.float64,
+                return_all=return_all,
+                batch_size=batch_size,
+                n_jobs=n_jobs,
+                groups=groups,
+            )
+        if not return_all:
+            fragility_arrs = (fragility_arrs,)
+        save_job = partial(
+            _save_numpy_derivatives,
+            deriv_path,
+            bids_path,
+            dict(zip(OUTPUT_PROFILES[output_profile], fragility_arrs)),
+            sidecar_params,
+            overwrite,
+        )
+
+    # plot heatmap as a separate stage reading the saved derivative
+    on_saved = partial(
+        _plot_heatmap,
+        bids_path=bids_path,
+        figures_path=figures_path,
+        sfreq=raw.info["sfreq"],
+        stepsize=model_params["stepsize"],
+        heatmap_executor=heatmap_executor,
+        first_sample=first_sample,
     )
+    if not plot_heatmap:
+        on_saved = None
+    if writer is not None:
+        return writer.submit(save_job, on_complete=on_saved)
+    perturb_deriv_fpath = save_job()
+    if on_saved is not None:
+        return on_saved(perturb_deriv_fpath)
 
-    # save the files
-    perturb_deriv_fpath = deriv_path / perturb_deriv.info._expected_basename
-    state_deriv_fpath = deriv_path / state_arr_deriv.info._expected_basename
-    delta_vecs_deriv_fpath = deriv_path / delta_vecs_arr_deriv.info._expected_basename
 
+def _save_eztrack_derivatives(deriv_path, derivs, sidecar_params, overwrite):
+    """Save the derivatives of ``lds_raw_fragility`` and their sidecar."""
+    deriv_fpaths = [deriv_path / deriv.info._expected_basename for deriv in derivs]
+    if not overwrite:
+        for deriv_fpath in deriv_fpaths:
+            if deriv_fpath.exists():
+                raise FileExistsError(
+                    f"{deriv_fpath} already exists. Set overwrite=True to replace it."
+                )
     print("Saving files to: ")
-    print(perturb_deriv_fpath)
-    print(state_deriv_fpath)
-    print(delta_vecs_deriv_fpath)
-    perturb_deriv.save(perturb_deriv_fpath, overwrite=overwrite)
-    state_arr_deriv.save(state_deriv_fpath, overwrite=overwrite)
-    delta_vecs_arr_deriv.save(delta_vecs_deriv_fpath, overwrite=overwrite)
-
-    # normalize and plot heatmap
-    if plot_heatmap:
-        figures_path.mkdir(exist_ok=True, parents=True)
-        perturb_deriv.normalize()
-        fig_basename = perturb_deriv_fpath.with_suffix(".pdf").name
-
-        bids_path.update(suffix="channels", extension=".tsv")
-
-        # read in vertical markers
-        vertical_markers = {}
-        events, event_id = mne.events_from_annotations(perturb_deriv)
-        if "sz event" in event_id:
-            _id = event_id.get("eeg sz onset")
-            sz_onset = int(events[np.argwhere(events[:, -1] == _id), 0].squeeze())
-            print(sz_onset)
-            vertical_markers[sz_onset] = "seizure onset"
-        # if "eeg sz offset" in event_id:
-        #     _id = event_id.get("eeg sz offset")
-        #     sz_offset = int(events[np.argwhere(events[:, -1] == _id), 0].squeeze())
-        #     vertical_markers[sz_offset] = "seizure offset"
-
-        # read in sidecar channels.tsv
-        channels_pd = pd.read_csv(bids_path.fpath, sep="\t")
-        description_chs = pd.Series(
-            channels_pd.description.values, index=channels_pd.name
-        ).to_dict()
-        print(description_chs)
-        resected_chs = [
-            ch
-            for ch, description in description_chs.items()
-            if description == "resected"
+    for deriv_fpath in deriv_fpaths:
+        print(deriv_fpath)
+
+    # the sidecar is renamed in place with the arrays, right before the
+    # perturbation matrix
+    perturb_deriv_fpath = deriv_fpaths[0]
+    save_atomic(
+        deriv_path,
+        [
+            lambda tmp_path, deriv=deriv: deriv.save(
+                tmp_path / deriv.info._expected_basename, overwrite=True
+            )
+            for deriv in derivs
         ]
-        print(f"Resected channels are {resected_chs}")
+        + [
+            lambda tmp_path: write_fragility_sidecar(
+                tmp_path / perturb_deriv_fpath.name, sidecar_params
+            )
+        ],
+        last=PERTURB_DESCRIPTION,
+    )
+    return perturb_deriv_fpath
 
-        print(f"saving figure to {figures_path} {fig_basename}")
-        perturb_deriv.plot_heatmap(
-            soz_chs=resected_chs,
-            cbarlabel="Fragility",
-            cmap="turbo",
-            vertical_markers=vertical_markers,
-            # soz_chs=soz_chs,
-            # figsize=(10, 8),
-            # fontsize=12,
-            # vmax=0.8,
-            title=fig_basename,
-            figure_fpath=(figures_path / fig_basename),
-        )
 
+def _save_numpy_derivatives(deriv_path, bids_path, arrays, sidecar_params, overwrite):
+    """Save the arrays of ``lds_fragility`` and their sidecar."""
+    deriv_fpaths = save_fragility_arrays(
+        deriv_path,
+        bids_path,
+        arrays,
+        overwrite=overwrite,
+        sidecar_params=sidecar_params,
+    )
+    print(f"Saved files to: {list(deriv_fpaths.values())}")
+    return deriv_fpaths[PERTURB_DESCRIPTION]
+
+
+def _plot_heatmap(
+    perturb_deriv_fpath,
+    bids_path,
+    figures_path,
+    sfreq,
+    stepsize,
+    heatmap_executor,
+    first_sample=0,
+):
+    """Plot the heatmap of a saved perturbation matrix."""
+    figures_path.mkdir(exist_ok=True, parents=True)
+    fig_basename = perturb_deriv_fpath.with_suffix(".pdf").name
+
+    # read in vertical markers and resected channels from the sidecars,
+    # onsets are converted from samples to fragility windows
+    metadata = read_recording_metadata(bids_path.copy().update(split=None))
+    vertical_markers = {}
+    sz_onsets = metadata.get_event_samples(SEIZURE_ONSET_EVENTS, sfreq=sfreq)
+    for sz_onset in (sz_onsets - first_sample) // stepsize:
+        if sz_onset >= 0:
+            vertical_markers[int(sz_onset)] = "seizure onset"
 
-def main_run_jhu():
-    # the root of the BIDS dataset
-    WORKSTATION = "home"
+    resected_chs = metadata.resected_chs
+    print(f"Resected channels are {resected_chs}")
 
-    if WORKSTATION == "home":
-        # bids root to write BIDS data to
+    print(f"saving figure to {figures_path} {fig_basename}")
+    heatmap_kws = dict(
+        deriv_fpath=perturb_deriv_fpath,
+        figure_fpath=figures_path / fig_basename,
+        soz_chs=resected_chs,
+        vertical_markers=vertical_markers,
+        title=fig_basename,
+        cbarlabel="Fragility",
+        cmap="turbo",
+    )
+    if heatmap_executor is not None:
+        return heatmap_executor.submit(plot_fragility_heatmap, **heatmap_kws)
+    plot_fragility_heatmap(**heatmap_kws)
+
+
+def main_run_jhu(
+    root=None,
+    deriv_root=None,
+    figures_path=None,
+    subjects=None,
+    reference="monopolar",
+    sfreq=None,
+    overwrite=False,
+    queue=None,
+    dtype=None,
+    output_profile="full",
+    state_structure="dense",
+    n_jobs=None,
+):
+    """Run the fragility analysis of the JHU dataset.
+
+    Parameters
+    ----------
+    root : str | Path | None
+        The root of the BIDS dataset. Defaults to the dataset on the
+        ``WORKSTATION``.
+    deriv_root : str | Path | None
+        The derivative root. Defaults to
+        ``<root>/derivatives/originalsampling/radius1.5``.
+    figures_path : str | Path | None
+        Where to save heatmaps. Defaults to ``<deriv_root>/figures``.
+    subjects : list of str | None
+        Only analyze these subjects. Defaults to all.
+    reference : str
+        The reference to analyze.
+    sfreq : float | None
+        The sampling frequency to resample to.
+    overwrite : bool
+        Whether to overwrite existing derivatives.
+    queue : spes.jobqueue.FileJobQueue | None
+        If set, jobs are submitted to the queue instead of run here.
+    dtype : str | None
+        The floating point dtype of the fit, e.g. ``"float32"``, see
+        :func:`run_analysis`.
+    output_profile : str
+        Which arrays to save, one of the keys of ``OUTPUT_PROFILES``.
+    state_structure : str
+        ``"dense"`` or ``"block"``, see :func:`run_analysis`.
+    n_jobs : int | str | None
+        The workers of the fit. Defaults to the cores left by the loader,
+        writer and renderer stages, see :func:`spes.autotune.plan_workers`.
+        ``"auto"`` tunes them per recording.
+    """
+    _check_model_options(output_profile, state_structure)
+    model_options = dict(
+        dtype=dtype, output_profile=output_profile, state_structure=state_structure
+    )
+    if root is None:
         # the root of the BIDS dataset
-        root = Path("/Users/adam2392/Johns Hopkins/Rachel Smith - Ictal Clips/")
-        # root = Path("/Users/adam2392/Dropbox/resection_tvb/")
+        WORKSTATION = "home"
+
+        if WORKSTATION == "home":
+            # bids root to write BIDS data to
+            # the root of the BIDS dataset
+            root = Path("/Users/adam2392/Johns Hopkins/Rachel Smith - Ictal Clips/")
+            # root = Path("/Users/adam2392/Dropbox/resection_tvb/")
+        elif WORKSTATION == "lab":
+            root = Path("/home/adam2392/hdd/epilepsy_bids/")
+    root = Path(root)
+    if deriv_root is None:
         deriv_root = root / "derivatives" / "originalsampling" / "radius1.5"
+    deriv_root = Path(deriv_root)
+    if figures_path is None:
         figures_path = deriv_root / "figures"
-    elif WORKSTATION == "lab":
-        root = Path("/home/adam2392/hdd/epilepsy_bids/")
+    figures_path = Path(figures_path)
 
     # define BIDS entities
-    SUBJECTS = []
     acquisition = 'seeg'
     datatype = "ieeg"
     extension = ".vhdr"
@@ -166,16 +839,14 @@ def main_run_jhu():
     session = "extraoperative"  # only one session
 
     # derivative analysis parameters
-    reference = "monopolar"
     order = 1
-    sfreq = None
-    overwrite = False
 
     # get the runs for this subject
+    bids_paths = []
     all_subjects = get_entity_vals(root, "subject")
     for subject in all_subjects:
-        # if subject not in SUBJECTS:
-        #     continue
+        if subjects is not None and subject not in subjects:
+            continue
         ignore_subs = [sub for sub in all_subjects if sub != subject]
 
         # get all sessions
@@ -205,19 +876,100 @@ def main_run_jhu():
                 root=root,
                 extension=extension,
             )
-            print(f"Analyzing {bids_path}")
 
-            run_analysis(
-                bids_path,
-                reference=reference,
-                resample_sfreq=sfreq,
-                deriv_path=deriv_root,
-                figures_path=figures_path,
-                plot_heatmap=True,
-                plot_raw=True,
-                overwrite=overwrite,
-                order=order,
+            # only prefetch recordings that still have to be analyzed
+            subject_deriv_path, _ = _get_derivative_paths(
+                bids_path, reference, deriv_root, figures_path
+            )
+            skip, _ = _check_existing_derivatives(
+                bids_path, subject_deriv_path, output_profile, overwrite
             )
+            if not skip:
+                bids_paths.append(bids_path)
+
+    # with a job queue, the recordings are analyzed by ``run_worker``
+    # processes on any node that mounts the dataset
+    if queue is not None:
+        job_ids = submit_fragility_jobs(
+            queue,
+            bids_paths,
+            deriv_root,
+            figures_path,
+            reference=reference,
+            resample_sfreq=sfreq,
+            plot_heatmap=True,
+            plot_raw=True,
+            overwrite=overwrite,
+            n_jobs=n_jobs,
+            **model_options,
+        )
+        print(f"Submitted {len(job_ids)} fragility jobs to {queue}")
+        return
+
+    # recordings are read and preprocessed ahead in loader threads, while
+    # the current one is analyzed, in at most 40% of the available memory.
+    # Derivatives are written in a background thread while the next
+    # recording is computed, and heatmaps are rendered in worker processes
+    # once the derivatives are saved. The cores are split between the fit
+    # and these stages, so they do not oversubscribe the node.
+    prefetch_depth = 2
+    resources = get_resources()
+    prefetch_max_bytes = 0.4 * resources["available_memory"]
+    workers = plan_workers(prefetch_depth=prefetch_depth, resources=resources)
+    writer = AsyncDerivativeWriter(max_pending=2, n_threads=workers["writer_threads"])
+    heatmap_executor = ProcessPoolExecutor(max_workers=workers["heatmap_workers"])
+    save_futures = []
+
+    load_fn = partial(
+        _load_recording, resample_sfreq=sfreq, plot_raw=True, verbose=True
+    )
+    for bids_path, raw in prefetch_data(
+        bids_paths,
+        load_fn,
+        depth=prefetch_depth,
+        max_bytes=prefetch_max_bytes,
+        n_workers=workers["prefetch_workers"],
+        resample_sfreq=sfreq,
+    ):
+        print(f"Analyzing {bids_path}")
+
+        save_future = run_analysis(
+            bids_path,
+            reference=reference,
+            resample_sfreq=sfreq,
+            deriv_path=deriv_root,
+            figures_path=figures_path,
+            plot_heatmap=True,
+            plot_raw=True,
+            overwrite=overwrite,
+            heatmap_executor=heatmap_executor,
+            writer=writer,
+            raw=raw,
+            order=order,
+            n_jobs=workers["fit_n_jobs"] if n_jobs is None else n_jobs,
+            **model_options,
+        )
+        del raw
+        if save_future is not None:
+            save_futures.append(save_future)
+
+    # make sure all derivatives and figures in the background are written
+    writer.close()
+    for save_future in save_futures:
+        heatmap_future = save_future.result()
+        print(f"Saved heatmap to {heatmap_future.result()}")
+    heatmap_executor.shutdown()
+    wait_for_figures()
+
+    # collect cohort-level features of all derivatives into one table
+    summary_fpath = deriv_root / "fragility" / f"desc-{reference}_summary.parquet"
+    summarize_fragility(
+        deriv_root,
+        root,
+        out_fpath=summary_fpath,
+        reference=reference,
+        n_jobs=workers["summary_n_jobs"],
+    )
 
 
 if __name__ == "__main__":
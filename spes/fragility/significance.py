@@ -0,0 +1,320 @@
+"""Surrogate significance of fragility.
+
+The fragility of a recording is compared against the fragility of
+surrogate recordings that keep its spectrum but not its dynamics.
+``"phase"`` surrogates randomize the Fourier phases, with the same random
+phases for every channel so the cross-spectra (and thus the zero-lag
+correlations) are kept. ``"shift"`` surrogates circularly shift each
+channel by its own random lag, which keeps every channel intact but breaks
+the alignment between channels.
+
+Each surrogate is generated from its own child of a
+:class:`numpy.random.SeedSequence` inside the worker that uses it, so
+surrogates are never stored and the p-values do not depend on the number
+of jobs. Only the running count of surrogates at least as fragile as the
+recording is kept.
+"""
+
+from pathlib import Path
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from mne.utils import warn
+
+from spes.fragility.io import (
+    PERTURB_DESCRIPTION,
+    PVALUES_DESCRIPTION,
+    get_derivative_fpath,
+    read_fragility_sidecar,
+    save_atomic,
+    write_fragility_sidecar,
+)
+from spes.fragility.lds import lds_fragility
+from spes.fragility.utils import normalize_fragility
+
+
+def phase_randomize(data, rng, shared=True):
+    """Make a phase-randomized surrogate of multichannel data.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The data.
+    rng : np.random.Generator
+        The random generator of the surrogate.
+    shared : bool
+        Whether all channels get the same random phases, which keeps the
+        cross-spectra between channels. If False, each channel gets its
+        own phases and only the power spectra are kept.
+
+    Returns
+    -------
+    surrogate : np.ndarray, shape (n_channels, n_times)
+    """
+    n_chs, n_times = data.shape
+    spectrum = np.fft.rfft(data, axis=-1)
+    n_freqs = spectrum.shape[-1]
+    phases = rng.uniform(0, 2 * np.pi, size=(1 if shared else n_chs, n_freqs))
+
+    # the DC (and Nyquist) bin of a real signal must stay real
+    phases[:, 0] = 0
+    if n_times % 2 == 0:
+        phases[:, -1] = 0
+    spectrum *= np.exp(1j * phases)
+    return np.fft.irfft(spectrum, n=n_times, axis=-1).astype(data.dtype, copy=False)
+
+
+def time_shift(data, rng, min_shift=None):
+    """Make a surrogate by circularly shifting each channel.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The data.
+    rng : np.random.Generator
+        The random generator of the surrogate.
+    min_shift : int | None
+        The smallest shift in samples, in both directions. Defaults to a
+        tenth of the recording.
+
+    Returns
+    -------
+    surrogate : np.ndarray, shape (n_channels, n_times)
+    """
+    n_chs, n_times = data.shape
+    if min_shift is None:
+        min_shift = n_times // 10
+    if 2 * min_shift >= n_times:
+        raise ValueError(
+            f"min_shift of {min_shift} samples is too long for {n_times} samples."
+        )
+    shifts = rng.integers(min_shift, n_times - min_shift + 1, size=n_chs)
+    idx = (np.arange(n_times) - shifts[:, np.newaxis]) % n_times
+    return np.take_along_axis(data, idx, axis=-1)
+
+
+SURROGATE_METHODS = {
+    "phase": phase_randomize,
+    "shift": time_shift,
+}
+
+
+def _make_surrogate(data, method, seed_seq, method_kws):
+    rng = np.random.default_rng(seed_seq)
+    return SURROGATE_METHODS[method](data, rng, **method_kws)
+
+
+def _count_exceedances(data, observed, seed_seqs, method, method_kws, model_params):
+    """Count, per channel and window, the surrogates at least as fragile."""
+    counts = np.zeros(observed.shape, dtype=np.int32)
+    for seed_seq in seed_seqs:
+        surrogate = _make_surrogate(data, method, seed_seq, method_kws)
+        pert_mat = lds_fragility(surrogate, n_jobs=1, **model_params)
+        counts += normalize_fragility(pert_mat) >= observed
+    return counts
+
+
+def fragility_pvalues(
+    data,
+    n_surrogates=200,
+    method="phase",
+    seed=0,
+    n_jobs=1,
+    method_kws=None,
+    **model_params,
+):
+    """Compute surrogate p-values of the fragility of a data array.
+
+    The fragility of the data and of each surrogate is computed with
+    :func:`spes.fragility.lds.lds_fragility`, whose windows are fit in
+    batches. Surrogates are split into chunks that run in a process pool,
+    and each chunk returns the number of its surrogates whose fragility is
+    at least the observed one, per channel and window. The p-value is
+    ``(count + 1) / (n_surrogates + 1)``.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The (preprocessed) data.
+    n_surrogates : int
+        The number of surrogates.
+    method : str
+        ``"phase"`` for phase-randomized or ``"shift"`` for time-shifted
+        surrogates, see :data:`SURROGATE_METHODS`.
+    seed : int
+        The seed of the :class:`numpy.random.SeedSequence` each surrogate
+        gets a child of.
+    n_jobs : int
+        The number of processes.
+    method_kws : dict | None
+        Keyword arguments of the surrogate method, e.g. ``shared=False``.
+    **model_params
+        Keyword arguments of :func:`spes.fragility.lds.lds_fragility`,
+        with a scalar ``radius``.
+
+    Returns
+    -------
+    pvalues : np.ndarray, shape (n_channels, n_windows)
+        The p-value of the fragility of each channel per window.
+    fragility : np.ndarray, shape (n_channels, n_windows)
+        The observed, normalized fragility.
+    """
+    if method not in SURROGATE_METHODS:
+        raise ValueError(
+            f"method must be one of {list(SURROGATE_METHODS)}, not {method}."
+        )
+    if np.ndim(model_params.get("radius", 1.5)) != 0:
+        raise ValueError("Surrogate p-values need a scalar radius.")
+    method_kws = method_kws or dict()
+    model_params.pop("return_all", None)
+    model_params.pop("n_jobs", None)
+
+    observed = normalize_fragility(lds_fragility(data, n_jobs=1, **model_params))
+
+    # a few chunks per process, so a slow chunk does not idle the others
+    seed_seqs = np.random.SeedSequence(seed).spawn(n_surrogates)
+    n_chunks = max(min(n_surrogates, 4 * effective_n_jobs(n_jobs)), 1)
+    chunks = [chunk for chunk in np.array_split(seed_seqs, n_chunks) if len(chunk)]
+    counts = Parallel(n_jobs=n_jobs)(
+        delayed(_count_exceedances)(
+            data, observed, chunk, method, method_kws, model_params
+        )
+        for chunk in chunks
+    )
+    pvalues = (np.sum(counts, axis=0) + 1) / (n_surrogates + 1)
+    return pvalues, observed
+
+
+def run_significance(
+    bids_path,
+    deriv_root,
+    reference="monopolar",
+    n_surrogates=200,
+    method="phase",
+    seed=0,
+    n_jobs=1,
+    batch_size=8,
+    overwrite=False,
+    verbose=False,
+):
+    """Compute and save the surrogate p-values of a fragility derivative.
+
+    The model parameters, channels and sampling rate are read from the
+    sidecar of the saved perturbation matrix of the recording, the
+    recording is loaded with :func:`spes.read.load_data` in the same way,
+    and the p-values of :func:`fragility_pvalues` are saved next to the
+    perturbation matrix with the ``desc-fragilitypvalues`` entity. Its
+    sidecar records the surrogate method, count and seed.
+
+    The observed fragility is recomputed with the numpy engine, so it is
+    compared against surrogates computed in exactly the same way. If the
+    saved fragility was computed by another engine, a warning is raised,
+    since the p-values then belong to the recomputed fragility.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording.
+    deriv_root : str | Path
+        The derivative root, containing ``fragility/<reference>/sub-*``.
+    reference : str
+        The reference the fragility was computed in.
+    n_surrogates : int
+        The number of surrogates.
+    method : str
+        ``"phase"`` or ``"shift"``.
+    seed : int
+        The random seed of the surrogates.
+    n_jobs : int
+        The number of processes.
+    batch_size : int
+        The number of windows fit and solved together.
+    overwrite : bool
+        Whether to overwrite existing p-values.
+    verbose : bool
+        Verbosity of reading and preprocessing.
+
+    Returns
+    -------
+    pvalues_fpath : Path | None
+        The saved p-values, or None if the recording was skipped.
+    """
+    from spes.preprocess import apply_reference
+    from spes.read import load_data
+
+    deriv_path = Path(deriv_root) / "fragility" / reference / f"sub-{bids_path.subject}"
+    perturb_fpath = get_derivative_fpath(deriv_path, bids_path, PERTURB_DESCRIPTION)
+    pvalues_fpath = get_derivative_fpath(deriv_path, bids_path, PVALUES_DESCRIPTION)
+    if not perturb_fpath.exists():
+        warn(f"No perturbation matrix for {bids_path.basename}. Skipping...")
+        return None
+    if pvalues_fpath.exists() and not overwrite:
+        warn(f"P-values of {bids_path.basename} already exist. Skipping...")
+        return None
+    params = read_fragility_sidecar(perturb_fpath)
+    if params.get("method_to_use", "pinv") != "pinv":
+        raise ValueError(
+            f"The fragility of {bids_path.basename} was fit with "
+            f"method_to_use={params['method_to_use']}, but surrogates are only "
+            f"fit with the pseudo-inverse."
+        )
+    # sidecars without an engine were written by eztrack's lds_raw_fragility
+    engine = params.get("engine", "eztrack")
+    if engine != "numpy":
+        warn(
+            f"The fragility of {bids_path.basename} was computed by the {engine} "
+            f"engine, but the observed fragility and its surrogates are "
+            f"computed by the numpy engine. The p-values belong to the "
+            f"recomputed fragility, not the saved one."
+        )
+
+    raw = load_data(bids_path, params["sfreq"], None, verbose=verbose)
+    raw = apply_reference(raw, reference)
+    missing = set(params["ch_names"]) - set(raw.ch_names)
+    if missing:
+        raise RuntimeError(
+            f"Channels {sorted(missing)} of the fragility of {bids_path.basename} "
+            f"are not in the recording."
+        )
+    raw.pick(params["ch_names"])
+    data = raw.get_data()
+
+    groups = None
+    if params.get("state_structure", "dense") == "block":
+        from spes.bids.utils import _group_channels_by_shaft
+
+        groups = list(_group_channels_by_shaft(params["ch_names"]).values())
+    print(
+        f"Computing fragility of {n_surrogates} {method} surrogates of "
+        f"{bids_path.basename}"
+    )
+    pvalues, _ = fragility_pvalues(
+        data,
+        n_surrogates=n_surrogates,
+        method=method,
+        seed=seed,
+        n_jobs=n_jobs,
+        winsize=params["winsize"],
+        stepsize=params["stepsize"],
+        radius=params["radius"],
+        l2penalty=params["l2penalty"],
+        dtype=np.dtype(params.get("dtype", "float64")),
+        batch_size=batch_size,
+        groups=groups,
+        solver="svd",
+    )
+
+    sidecar_params = {
+        **params,
+        "n_surrogates": n_surrogates,
+        "surrogate_method": method,
+        "surrogate_engine": "numpy",
+        "seed": seed,
+    }
+    write_fragility_sidecar(pvalues_fpath, sidecar_params, overwrite=True)
+    save_atomic(
+        deriv_path,
+        [lambda tmp_path: np.save(tmp_path / pvalues_fpath.name, pvalues)],
+    )
+    print(f"Saved p-values to {pvalues_fpath}")
+    return pvalues_fpath
@@ -0,0 +1,214 @@
+"""Cohort-level summaries over saved fragility derivatives."""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from mne.utils import warn
+from mne_bids import BIDSPath
+from mne_bids.path import get_entities_from_fname
+
+from spes.bids.metadata import SEIZURE_ONSET_EVENTS, read_recording_metadata
+from spes.fragility.io import (
+    PERTURB_DESCRIPTION,
+    _sidecar_fpath,
+    read_fragility_sidecar,
+)
+from spes.fragility.utils import normalize_fragility
+
+
+def find_fragility_derivatives(deriv_root, reference=None, subjects=None):
+    """Find saved perturbation matrices in a fragility derivative tree.
+
+    Parameters
+    ----------
+    deriv_root : str | Path
+        The derivative root, containing ``fragility/<reference>/sub-*``.
+    reference : str | None
+        Only return derivatives of this reference. Defaults to all.
+    subjects : list of str | None
+        Only return derivatives of these subjects. Defaults to all.
+
+    Returns
+    -------
+    deriv_fpaths : list of Path
+    """
+    reference = reference or "*"
+    pattern = f"fragility/{reference}/sub-*/*desc-{PERTURB_DESCRIPTION}*.npy"
+    deriv_fpaths = sorted(Path(deriv_root).glob(pattern))
+    if subjects is not None:
+        deriv_fpaths = [
+            fpath
+            for fpath in deriv_fpaths
+            if get_entities_from_fname(fpath.name)["subject"] in subjects
+        ]
+    return deriv_fpaths
+
+
+def _source_bids_path(deriv_fpath, bids_root):
+    """Get the BIDS path of the recording a derivative was computed from."""
+    entities = get_entities_from_fname(Path(deriv_fpath).name)
+    datatype = Path(deriv_fpath).stem.split("_")[-1]
+    if datatype not in ("ieeg", "eeg"):
+        datatype = "ieeg"
+    return BIDSPath(
+        subject=entities["subject"],
+        session=entities["session"],
+        task=entities["task"],
+        acquisition=entities["acquisition"],
+        run=entities["run"],
+        datatype=datatype,
+        suffix=datatype,
+        root=bids_root,
+    )
+
+
+def _mean_or_nan(arr):
+    return float(arr.mean()) if arr.size else np.nan
+
+
+def _summarize_recording(deriv_fpath, bids_root, pre_seconds, post_seconds):
+    """Compute the summary features of one perturbation matrix."""
+    params = read_fragility_sidecar(deriv_fpath)
+    bids_path = _source_bids_path(deriv_fpath, bids_root)
+    metadata = read_recording_metadata(bids_path)
+
+    ch_names = params["ch_names"]
+    sfreq = params["sfreq"]
+    stepsize = params["stepsize"]
+    resected_mask = metadata.align_mask(metadata.resected_mask, ch_names)
+
+    pert_mat = np.load(deriv_fpath, mmap_mode="r")
+    n_windows = pert_mat.shape[1]
+    n_pre = int(pre_seconds * sfreq / stepsize)
+    n_post = int(post_seconds * sfreq / stepsize)
+
+    # only the windows around the first seizure onset are read from disk,
+    # recordings without an onset are summarized over the whole duration
+    # derivatives of a span of the recording start at ``first_sample``
+    sz_onsets = metadata.get_event_samples(SEIZURE_ONSET_EVENTS, sfreq=sfreq)
+    sz_onsets = sz_onsets - params.get("first_sample", 0)
+    sz_onsets = sz_onsets[sz_onsets >= 0]
+    if len(sz_onsets):
+        onset_win = int(min(sz_onsets.min() // stepsize, n_windows))
+        start = max(onset_win - n_pre, 0)
+        stop = min(onset_win + n_post, n_windows)
+    else:
+        onset_win = None
+        start, stop = 0, n_windows
+
+    fragility = normalize_fragility(np.asarray(pert_mat[:, start:stop], dtype=float))
+    if onset_win is not None:
+        pre = fragility[:, : onset_win - start]
+        post = fragility[:, onset_win - start :]
+    else:
+        pre = fragility[:, :0]
+        post = fragility
+
+    entities = get_entities_from_fname(Path(deriv_fpath).name)
+    record = {
+        "subject": entities["subject"],
+        "session": entities["session"],
+        "task": entities["task"],
+        "acquisition": entities["acquisition"],
+        "run": entities["run"],
+        "split": entities["split"],
+        "reference": params.get("reference"),
+        "n_channels": len(ch_names),
+        "n_resected": int(resected_mask.sum()),
+        "n_windows": n_windows,
+        "sz_onset_window": onset_win if onset_win is not None else -1,
+        "fragility_resected": _mean_or_nan(post[resected_mask]),
+        "fragility_nonresected": _mean_or_nan(post[~resected_mask]),
+        "fragility_pre": _mean_or_nan(pre),
+        "fragility_post": _mean_or_nan(post),
+        "fragility_resected_pre": _mean_or_nan(pre[resected_mask]),
+        "fragility_resected_post": _mean_or_nan(post[resected_mask]),
+        "deriv_fpath": str(deriv_fpath),
+    }
+    record["resected_separation"] = (
+        record["fragility_resected"] - record["fragility_nonresected"]
+    )
+    record["onset_contrast"] = record["fragility_post"] - record["fragility_pre"]
+    return record
+
+
+def summarize_fragility(
+    deriv_root,
+    bids_root,
+    out_fpath=None,
+    reference=None,
+    subjects=None,
+    pre_seconds=30.0,
+    post_seconds=30.0,
+    n_jobs=1,
+):
+    """Summarize all fragility derivatives of a cohort into one table.
+
+    For each saved perturbation matrix, only the windows within
+    ``pre_seconds`` before and ``post_seconds`` after the first seizure
+    onset are read from disk. They are normalized and reduced to one row of
+    features per recording:
+
+    - ``fragility_resected`` / ``fragility_nonresected``: mean fragility
+      of resected and non-resected channels after onset, and their
+      difference ``resected_separation``.
+    - ``fragility_pre`` / ``fragility_post``: mean fragility of all channels
+      before and after onset, and their difference ``onset_contrast``.
+
+    Parameters
+    ----------
+    deriv_root : str | Path
+        The derivative root, containing ``fragility/<reference>/sub-*``.
+    bids_root : str | Path
+        The BIDS root of the source recordings, to read sidecars from.
+    out_fpath : str | Path | None
+        Where to write the table. ``.parquet`` and ``.feather`` are
+        supported. If None, the table is only returned.
+    reference : str | None
+        Only summarize derivatives of this reference.
+    subjects : list of str | None
+        Only summarize derivatives of these subjects.
+    pre_seconds : float
+        The duration before seizure onset to summarize.
+    post_seconds : float
+        The duration after seizure onset to summarize.
+    n_jobs : int
+        The number of recordings to summarize in parallel.
+
+    Returns
+    -------
+    summary_df : pd.DataFrame
+        One row per recording.
+    """
+    deriv_fpaths = find_fragility_derivatives(
+        deriv_root, reference=reference, subjects=subjects
+    )
+    missing = [fpath for fpath in deriv_fpaths if not _sidecar_fpath(fpath).exists()]
+    if missing:
+        warn(
+            f"Skipping {len(missing)} derivatives without a parameter sidecar: "
+            f"{[fpath.name for fpath in missing]}"
+        )
+    deriv_fpaths = [fpath for fpath in deriv_fpaths if fpath not in missing]
+
+    records = Parallel(n_jobs=n_jobs)(
+        delayed(_summarize_recording)(fpath, bids_root, pre_seconds, post_seconds)
+        for fpath in deriv_fpaths
+    )
+    summary_df = pd.DataFrame.from_records(records)
+
+    if out_fpath is not None:
+        out_fpath = Path(out_fpath)
+        out_fpath.parent.mkdir(exist_ok=True, parents=True)
+        if out_fpath.suffix == ".parquet":
+            summary_df.to_parquet(out_fpath, index=False)
+        elif out_fpath.suffix == ".feather":
+            summary_df.to_feather(out_fpath)
+        else:
+            raise ValueError(
+                f"Summary table must be saved as .parquet or .feather, "
+                f"not {out_fpath.suffix}."
+            )
+    return summary_df
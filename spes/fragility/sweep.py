@@ -0,0 +1,596 @@
+"""Parameter sweeps of the fragility model over a cohort."""
+
+import itertools
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from mne.utils import warn
+from mne_bids.path import get_entities_from_fname
+
+from spes.autotune import get_resources
+from spes.fragility.io import (
+    OUTPUT_PROFILES,
+    PERTURB_DESCRIPTION,
+    STATE_DESCRIPTION,
+    _sidecar_fpath,
+    _tmp_fpath,
+    get_derivative_fpath,
+    read_fragility_sidecar,
+    save_fragility_arrays,
+    write_fragility_sidecar,
+)
+from spes.fragility.lds import (
+    N_OMEGA,
+    _complex_dtype,
+    compute_perturbation_norms,
+    lds_fragility,
+)
+
+# the model parameters that can be swept, with the defaults of run_analysis
+SWEEP_DEFAULTS = {
+    "winsize": 250,
+    "stepsize": 125,
+    "radius": 1.5,
+    "l2penalty": 1e-9,
+}
+
+# the relative tolerance to which the perturbation matrix recomputed from
+# the saved state matrices must match the saved one at the stored radius
+RECOMPUTE_RTOL = 1e-4
+
+
+def make_sweep_grid(param_grid):
+    """Expand a grid of model parameters into a list of configurations.
+
+    Parameters
+    ----------
+    param_grid : dict
+        Mapping of a parameter in ``SWEEP_DEFAULTS`` to the list of values
+        to sweep. Parameters that are not in the grid keep their default.
+
+    Returns
+    -------
+    configs : list of dict
+        One dictionary of all model parameters per configuration.
+    """
+    unknown = set(param_grid) - set(SWEEP_DEFAULTS)
+    if unknown:
+        raise ValueError(
+            f"Can only sweep over {list(SWEEP_DEFAULTS)}, not {sorted(unknown)}."
+        )
+    grid = {
+        param: np.atleast_1d(param_grid.get(param, default)).tolist()
+        for param, default in SWEEP_DEFAULTS.items()
+    }
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def get_config_name(config):
+    """Get the name of the derivative tree of a sweep configuration."""
+    return (
+        f"win-{config['winsize']}_step-{config['stepsize']}_"
+        f"radius-{config['radius']}_l2-{config['l2penalty']:g}"
+    )
+
+
+def _config_deriv_path(deriv_root, config, reference, subject):
+    return (
+        Path(deriv_root)
+        / "sweep"
+        / get_config_name(config)
+        / "fragility"
+        / reference
+        / f"sub-{subject}"
+    )
+
+
+def run_sweep(
+    bids_paths,
+    deriv_root,
+    param_grid,
+    reference="monopolar",
+    resample_sfreq=None,
+    output_profile="minimal",
+    dtype=np.float64,
+    n_jobs=1,
+    overwrite=False,
+    summary_fpath=None,
+):
+    """Compute fragility of a cohort for every configuration of a grid.
+
+    Each recording is read, preprocessed and re-referenced once. The
+    configurations are grouped by ``(winsize, stepsize, l2penalty)``, which
+    determine the LDS fit, so the state matrices of a group are fit once
+    and the perturbations of all its radii are computed from them.
+
+    Every configuration is written to its own derivative tree,
+    ``<deriv_root>/sweep/<config name>/fragility/<reference>/sub-*``, with
+    the usual parameter sidecars, so :func:`spes.fragility.summary.summarize_fragility`
+    can be pointed at each tree. With the ``"full"`` output profile, the
+    state matrices of a fit are saved once, in the tree of its first
+    computed radius, and the sidecar of every radius of the fit references
+    them as ``"state_matrix"``, see
+    :func:`spes.fragility.io.get_state_fpath`.
+
+    Parameters
+    ----------
+    bids_paths : list of mne_bids.BIDSPath
+        The recordings to analyze.
+    deriv_root : str | Path
+        The derivative root to write the sweep trees to.
+    param_grid : dict
+        The grid of model parameters, see :func:`make_sweep_grid`.
+    reference : str
+        The reference to compute fragility in, see
+        :func:`spes.preprocess.apply_reference`.
+    resample_sfreq : float | None
+        The sampling frequency to resample to.
+    output_profile : str
+        Which arrays to save, one of the keys of ``OUTPUT_PROFILES``.
+    dtype : np.dtype
+        The floating point dtype of the fit and the saved arrays.
+    n_jobs : int
+        The number of window batches computed in parallel.
+    overwrite : bool
+        Whether to recompute configurations that already exist.
+    summary_fpath : str | Path | None
+        Where to write the runtime table as a ``.tsv``. Defaults to
+        ``<deriv_root>/sweep/sweep_runtimes.tsv``.
+
+    Returns
+    -------
+    runtime_df : pd.DataFrame
+        One row per recording and configuration, with the wall time of the
+        shared fit (``runtime_fit``), its share per radius
+        (``runtime_config``) and the time to load the recording.
+    """
+    from spes.preprocess import apply_reference
+    from spes.read import load_data
+
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(
+            f"output_profile must be one of {list(OUTPUT_PROFILES)}, "
+            f"not {output_profile}."
+        )
+    configs = make_sweep_grid(param_grid)
+    fit_groups = dict()
+    for config in configs:
+        fit_key = (config["winsize"], config["stepsize"], config["l2penalty"])
+        fit_groups.setdefault(fit_key, []).append(config["radius"])
+
+    records = []
+    for bids_path in bids_paths:
+        # only read the recording if any configuration is missing
+        pending = dict()
+        for fit_key, radii in fit_groups.items():
+            todo = []
+            for radius in radii:
+                config = dict(zip(("winsize", "stepsize", "l2penalty"), fit_key))
+                config["radius"] = radius
+                deriv_path = _config_deriv_path(
+                    deriv_root, config, reference, bids_path.subject
+                )
+                if (
+                    not overwrite
+                    and get_derivative_fpath(
+                        deriv_path, bids_path, PERTURB_DESCRIPTION
+                    ).exists()
+                ):
+                    continue
+                todo.append(radius)
+            if todo:
+                pending[fit_key] = todo
+        if not pending:
+            warn(f"All sweep configurations of {bids_path.basename} exist. Skipping...")
+            continue
+
+        start = time.perf_counter()
+        raw = load_data(bids_path, resample_sfreq, None, plot_raw=False)
+        raw.drop_channels(raw.info["bads"])
+        raw = apply_reference(raw, reference)
+        data = raw.get_data()
+        runtime_load = time.perf_counter() - start
+        print(
+            f"Sweeping {len(pending)} fits of {raw} with {len(raw.ch_names)} channels"
+        )
+
+        records.extend(
+            _sweep_recording(
+                data,
+                raw.ch_names,
+                raw.info["sfreq"],
+                bids_path,
+                deriv_root,
+                pending,
+                reference=reference,
+                output_profile=output_profile,
+                dtype=dtype,
+                n_jobs=n_jobs,
+                overwrite=overwrite,
+                runtime_load=runtime_load,
+            )
+        )
+
+    runtime_df = pd.DataFrame.from_records(records)
+    if summary_fpath is None:
+        summary_fpath = Path(deriv_root) / "sweep" / "sweep_runtimes.tsv"
+    summary_fpath = Path(summary_fpath)
+    summary_fpath.parent.mkdir(exist_ok=True, parents=True)
+    if summary_fpath.exists() and not overwrite:
+        # keep the runtimes of configurations computed in earlier sweeps
+        prev_df = pd.read_csv(summary_fpath, sep="\t")
+        runtime_df = pd.concat([prev_df, runtime_df], ignore_index=True)
+    runtime_df.to_csv(summary_fpath, sep="\t", index=False)
+    print(runtime_df)
+    return runtime_df
+
+
+def _sweep_recording(
+    data,
+    ch_names,
+    sfreq,
+    bids_path,
+    deriv_root,
+    pending,
+    reference="monopolar",
+    output_profile="minimal",
+    dtype=np.float64,
+    n_jobs=1,
+    overwrite=False,
+    runtime_load=0.0,
+):
+    """Fit and save the pending sweep configurations of a loaded recording.
+
+    ``pending`` maps each ``(winsize, stepsize, l2penalty)`` fit to the
+    radii to compute from it. Returns the runtime records of
+    :func:`run_sweep`.
+    """
+    records = []
+    for (winsize, stepsize, l2penalty), radii in pending.items():
+        return_all = output_profile == "full"
+        start = time.perf_counter()
+        fragility_arrs = lds_fragility(
+            data,
+            winsize=winsize,
+            stepsize=stepsize,
+            radius=np.array(radii),
+            l2penalty=l2penalty,
+            dtype=dtype,
+            return_all=return_all,
+            n_jobs=n_jobs,
+        )
+        runtime_fit = time.perf_counter() - start
+        if not return_all:
+            fragility_arrs = (fragility_arrs,)
+
+        state_fpath = None
+        for ridx, radius in enumerate(radii):
+            config = dict(
+                winsize=winsize,
+                stepsize=stepsize,
+                radius=radius,
+                l2penalty=l2penalty,
+            )
+            deriv_path = _config_deriv_path(
+                deriv_root, config, reference, bids_path.subject
+            )
+            # the state matrices are shared by all radii of a fit, so they
+            # are saved with the first radius and referenced by the others
+            arrays = dict()
+            descriptions = OUTPUT_PROFILES[output_profile]
+            for description, arr in zip(descriptions, fragility_arrs):
+                if description == STATE_DESCRIPTION and state_fpath is not None:
+                    continue
+                arrays[description] = arr if arr.ndim == 2 else arr[ridx]
+            if STATE_DESCRIPTION in arrays:
+                state_fpath = get_derivative_fpath(
+                    deriv_path, bids_path, STATE_DESCRIPTION
+                )
+            sidecar_params = {
+                "ch_names": list(ch_names),
+                "sfreq": sfreq,
+                "reference": reference,
+                "engine": "numpy",
+                "dtype": np.dtype(dtype).name,
+                "output_profile": output_profile,
+                "method_to_use": "pinv",
+                **config,
+            }
+            if state_fpath is not None:
+                sidecar_params["state_matrix"] = os.path.relpath(
+                    state_fpath, deriv_path
+                )
+            deriv_fpaths = save_fragility_arrays(
+                deriv_path,
+                bids_path,
+                arrays,
+                overwrite=overwrite,
+                sidecar_params=sidecar_params,
+            )
+            records.append(
+                {
+                    "recording": bids_path.basename,
+                    "config": get_config_name(config),
+                    **config,
+                    "n_channels": len(ch_names),
+                    "n_windows": arrays[PERTURB_DESCRIPTION].shape[1],
+                    "runtime_load": runtime_load,
+                    "runtime_fit": runtime_fit,
+                    "runtime_config": runtime_fit / len(radii),
+                    "deriv_fpath": str(deriv_fpaths[PERTURB_DESCRIPTION]),
+                }
+            )
+    return records
+
+
+def _solve_radii_batch(state_arr, out_mats, radii, n_chs, start, stop, perturb_type):
+    # (n_chs * n_chs, n_batch) row-major state matrices -> (n_batch, n_chs, n_chs)
+    A_mats = np.asarray(state_arr[:, start:stop]).T.reshape(-1, n_chs, n_chs)
+    pert_norms = compute_perturbation_norms(A_mats, radii, perturb_type=perturb_type)
+    for out_mat, norms in zip(out_mats, pert_norms):
+        out_mat[:, start:stop] = norms.T
+
+
+def _radii_batch_size(n_chs, dtype, n_jobs, memory_fraction=0.25, max_size=64):
+    """The number of windows whose perturbations fit in memory per thread.
+
+    Each window holds ``N_OMEGA`` shifted state matrices, their complex
+    inverses and the real and imaginary parts of the inverses.
+    """
+    real_size = np.dtype(dtype).itemsize
+    complex_size = np.dtype(_complex_dtype(dtype)).itemsize
+    window_nbytes = N_OMEGA * n_chs**2 * 2 * (complex_size + real_size)
+    budget = memory_fraction * get_resources()["available_memory"] / n_jobs
+    return int(np.clip(budget // window_nbytes, 1, max_size))
+
+
+def _check_state_layout(state_arr, perturb_fpath, params, n_chs, batch_size):
+    """Check that the saved perturbations are reproduced from the states.
+
+    The state matrices may be saved by eztrack's ``lds_raw_fragility``, so
+    the numpy perturbation solver is only trusted on them if it reproduces
+    the saved perturbation matrix at the stored radius.
+    """
+    if not perturb_fpath.exists():
+        raise RuntimeError(
+            f"No perturbation matrix {perturb_fpath.name} to check the state "
+            f"matrices against."
+        )
+    saved_mat = np.load(perturb_fpath, mmap_mode="r")
+    if saved_mat.shape != (n_chs, state_arr.shape[1]):
+        raise ValueError(
+            f"{perturb_fpath.name} has shape {saved_mat.shape}, but the state "
+            f"matrices are of {n_chs} channels and {state_arr.shape[1]} windows."
+        )
+    stop = min(batch_size, state_arr.shape[1])
+    check_mat = np.empty((n_chs, stop), dtype=state_arr.dtype)
+    _solve_radii_batch(
+        state_arr,
+        [check_mat],
+        np.array([params["radius"]]),
+        n_chs,
+        0,
+        stop,
+        params.get("perturb_type", "C"),
+    )
+    if not np.allclose(check_mat, saved_mat[:, :stop], rtol=RECOMPUTE_RTOL, atol=0):
+        max_dev = np.abs(check_mat / saved_mat[:, :stop] - 1).max()
+        raise ValueError(
+            f"Recomputing {perturb_fpath.name} at its radius {params['radius']} "
+            f"deviates by up to {max_dev:.2e} (relative) from the saved matrix. "
+            f"The state matrices are not in the row-major layout of "
+            f"lds_fragility, or were fit with another perturbation model."
+        )
+
+
+def recompute_radii(
+    state_fpath,
+    radii,
+    out_root,
+    perturb_type="C",
+    batch_size=None,
+    n_jobs=1,
+    overwrite=False,
+):
+    """Recompute perturbation matrices for new radii from saved state matrices.
+
+    The radius only enters the minimum-norm perturbation, not the LDS fit,
+    so the saved state matrices of a recording are enough to compute its
+    fragility for other radii. The state matrices are memory-mapped and
+    read in batches of ``batch_size`` windows. Each batch is solved for all
+    radii at once, and written into memory-mapped outputs, so memory use
+    is independent of the recording length.
+
+    Before anything is written, the first batch is recomputed at the radius
+    of the saved perturbation matrix and checked against it, since the state
+    matrices may have been fit by eztrack. The outputs are written under
+    temporary names and renamed in place once complete, after their
+    sidecars, so an interrupted run never leaves a matrix that looks done.
+
+    The perturbation matrix of each radius is written to the sweep tree of
+    its configuration (see :func:`run_sweep`) with the ``"minimal"`` output
+    profile.
+
+    Parameters
+    ----------
+    state_fpath : str | Path
+        The saved state matrix, shape (n_channels * n_channels, n_windows),
+        holding the row-major state matrix of each window.
+    radii : list of float
+        The radii to compute.
+    out_root : str | Path
+        The derivative root to write the sweep trees to.
+    perturb_type : str
+        ``"C"`` for column perturbations, ``"R"`` for row perturbations.
+    batch_size : int | None
+        The number of windows read and solved together. Defaults to as
+        many as fit in a quarter of the available memory across ``n_jobs``
+        threads, at most 64.
+    n_jobs : int
+        The number of batches solved in parallel (threads).
+    overwrite : bool
+        Whether to overwrite existing perturbation matrices.
+
+    Returns
+    -------
+    deriv_fpaths : dict
+        Mapping of each radius to its perturbation matrix.
+    """
+    state_fpath = Path(state_fpath)
+    perturb_fpath = state_fpath.with_name(
+        state_fpath.name.replace(
+            f"desc-{STATE_DESCRIPTION}", f"desc-{PERTURB_DESCRIPTION}"
+        )
+    )
+    if _sidecar_fpath(perturb_fpath).exists():
+        params = read_fragility_sidecar(perturb_fpath)
+    else:
+        warn(
+            f"No parameter sidecar found for {state_fpath.name}, assuming the "
+            f"default model parameters {SWEEP_DEFAULTS}."
+        )
+        params = dict(SWEEP_DEFAULTS)
+    params.setdefault("reference", state_fpath.parent.parent.name)
+    subject = get_entities_from_fname(state_fpath.name)["subject"]
+
+    state_arr = np.load(state_fpath, mmap_mode="r")
+    n_chs = int(round(np.sqrt(state_arr.shape[0])))
+    if n_chs * n_chs != state_arr.shape[0]:
+        raise ValueError(
+            f"{state_fpath.name} has {state_arr.shape[0]} rows, which is not "
+            f"the number of entries of a square state matrix."
+        )
+    n_windows = state_arr.shape[1]
+    if batch_size is None:
+        batch_size = _radii_batch_size(n_chs, state_arr.dtype, n_jobs)
+    _check_state_layout(state_arr, perturb_fpath, params, n_chs, batch_size)
+
+    radii = [float(radius) for radius in radii]
+    deriv_fpaths, out_mats = dict(), []
+    for radius in radii:
+        config = {param: params.get(param) for param in SWEEP_DEFAULTS}
+        config["radius"] = radius
+        deriv_path = _config_deriv_path(out_root, config, params["reference"], subject)
+        deriv_path.mkdir(exist_ok=True, parents=True)
+        deriv_fpath = deriv_path / perturb_fpath.name
+        if deriv_fpath.exists() and not overwrite:
+            raise FileExistsError(
+                f"{deriv_fpath} already exists. Set overwrite=True to replace it."
+            )
+        deriv_fpaths[radius] = deriv_fpath
+    try:
+        for deriv_fpath in deriv_fpaths.values():
+            out_mats.append(
+                np.lib.format.open_memmap(
+                    _tmp_fpath(deriv_fpath),
+                    mode="w+",
+                    dtype=state_arr.dtype,
+                    shape=(n_chs, n_windows),
+                )
+            )
+
+        Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(_solve_radii_batch)(
+                state_arr,
+                out_mats,
+                np.array(radii),
+                n_chs,
+                start,
+                min(start + batch_size, n_windows),
+                perturb_type,
+            )
+            for start in range(0, n_windows, batch_size)
+        )
+        for out_mat in out_mats:
+            out_mat.flush()
+    except BaseException:
+        for deriv_fpath in deriv_fpaths.values():
+            _tmp_fpath(deriv_fpath).unlink(missing_ok=True)
+        raise
+    finally:
+        del out_mats
+
+    for radius, deriv_fpath in deriv_fpaths.items():
+        sidecar_params = {
+            **params,
+            "engine": "numpy",
+            "radius": radius,
+            "perturb_type": perturb_type,
+            "output_profile": "minimal",
+            "source_state_matrix": str(state_fpath),
+        }
+        write_fragility_sidecar(deriv_fpath, sidecar_params, overwrite=True)
+        os.replace(_tmp_fpath(deriv_fpath), deriv_fpath)
+    return deriv_fpaths
+
+
+def run_radius_study(
+    deriv_root,
+    radii,
+    out_root=None,
+    reference=None,
+    subjects=None,
+    batch_size=None,
+    n_jobs=1,
+    overwrite=False,
+):
+    """Recompute the fragility of a cohort for new radii.
+
+    Runs :func:`recompute_radii` on every saved state matrix of a fragility
+    derivative tree, without reading any raw data.
+
+    Parameters
+    ----------
+    deriv_root : str | Path
+        The derivative root, containing ``fragility/<reference>/sub-*``.
+    radii : list of float
+        The radii to compute.
+    out_root : str | Path | None
+        The derivative root to write the sweep trees to. Defaults to
+        ``deriv_root``.
+    reference : str | None
+        Only recompute derivatives of this reference.
+    subjects : list of str | None
+        Only recompute derivatives of these subjects.
+    batch_size : int | None
+        The number of windows read and solved together, see
+        :func:`recompute_radii`.
+    n_jobs : int
+        The number of batches solved in parallel (threads).
+    overwrite : bool
+        Whether to overwrite existing perturbation matrices.
+
+    Returns
+    -------
+    deriv_fpaths : list of dict
+        The output of :func:`recompute_radii` per recording.
+    """
+    out_root = deriv_root if out_root is None else out_root
+    reference = reference or "*"
+    pattern = f"fragility/{reference}/sub-*/*desc-{STATE_DESCRIPTION}*.npy"
+    state_fpaths = sorted(Path(deriv_root).glob(pattern))
+    if subjects is not None:
+        state_fpaths = [
+            fpath
+            for fpath in state_fpaths
+            if get_entities_from_fname(fpath.name)["subject"] in subjects
+        ]
+
+    deriv_fpaths = []
+    for state_fpath in state_fpaths:
+        print(f"Recomputing {len(radii)} radii from {state_fpath.name}")
+        deriv_fpaths.append(
+            recompute_radii(
+                state_fpath,
+                radii,
+                out_root,
+                batch_size=batch_size,
+                n_jobs=n_jobs,
+                overwrite=overwrite,
+            )
+        )
+    return deriv_fpaths
@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def normalize_fragility(pert_mat):
+    """Normalize perturbation norms to fragility column by column.
+
+    Each window is scaled by its largest perturbation norm, so the most
+    fragile channel (smallest norm) of a window is closest to 1.
+
+    Parameters
+    ----------
+    pert_mat : np.ndarray, shape (n_channels, n_windows)
+        The minimum-norm perturbation of each channel per window.
+
+    Returns
+    -------
+    fragility : np.ndarray, shape (n_channels, n_windows)
+    """
+    col_max = pert_mat.max(axis=0, keepdims=True)
+    col_max = np.where(col_max == 0, 1.0, col_max)
+    return (col_max - pert_mat) / col_max
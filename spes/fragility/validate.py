@@ -0,0 +1,418 @@
+"""Validation harnesses for the numpy fragility engine."""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from spes.fragility.lds import (
+    TRUNCATION_TOLERANCE,
+    compute_perturbation_norms,
+    fit_state_matrices,
+    lds_fragility,
+)
+from spes.fragility.utils import normalize_fragility
+
+# the model parameters of run_analysis
+ENGINE_DEFAULTS = dict(winsize=250, stepsize=125, radius=1.5, l2penalty=1e-9)
+# the max absolute deviation of normalized fragility between the numpy
+# engine and eztrack's lds_raw_fragility in float64
+ENGINE_TOLERANCE = 1e-6
+
+
+def simulate_lds_data(
+    n_chs=50,
+    n_times=5000,
+    spectral_radius=0.95,
+    n_sources=None,
+    noise=0.01,
+    seed=0,
+):
+    """Simulate data from a stable, noise-driven linear dynamical system.
+
+    Parameters
+    ----------
+    n_chs : int
+        The number of channels.
+    n_times : int
+        The number of samples.
+    spectral_radius : float
+        The largest absolute eigenvalue of the simulated state matrix.
+    n_sources : int | None
+        If set, a ``n_sources`` dimensional system is simulated and mixed
+        into ``n_chs`` channels with ``noise`` sensor noise, giving
+        spatially correlated, approximately low-rank data like
+        volume-conducted iEEG.
+    noise : float
+        The standard deviation of the sensor noise relative to the mixed
+        data. With ``noise=0``, the data has rank ``n_sources``.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    data : np.ndarray, shape (n_chs, n_times)
+        The simulated data, scaled to amplitudes typical of iEEG (Volts).
+    """
+    rng = np.random.default_rng(seed)
+    n_states = n_chs if n_sources is None else n_sources
+    A = rng.standard_normal((n_states, n_states)) / np.sqrt(n_states)
+    A *= spectral_radius / np.abs(np.linalg.eigvals(A)).max()
+
+    data = np.empty((n_states, n_times))
+    data[:, 0] = rng.standard_normal(n_states)
+    innovations = rng.standard_normal((n_states, n_times))
+    for idx in range(1, n_times):
+        data[:, idx] = A @ data[:, idx - 1] + innovations[:, idx]
+
+    if n_sources is not None:
+        mixing = rng.standard_normal((n_chs, n_sources)) / np.sqrt(n_sources)
+        data = mixing @ data
+        data += noise * data.std() * rng.standard_normal(data.shape)
+    return data * 50e-6
+
+
+def compare_precision(data, dtype=np.float32, **model_params):
+    """Compare fragility computed in ``dtype`` against a float64 reference.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The data to compute fragility on.
+    dtype : np.dtype
+        The reduced precision dtype to validate.
+    **model_params
+        Keyword arguments passed to :func:`spes.fragility.lds.lds_fragility`.
+
+    Returns
+    -------
+    result : dict
+        The max and mean absolute deviation of the normalized fragility
+        heatmap, and the runtime of both precisions in seconds.
+    """
+    start = time.perf_counter()
+    ref_mat = lds_fragility(data, dtype=np.float64, **model_params)
+    ref_runtime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    test_mat = lds_fragility(data, dtype=dtype, **model_params)
+    test_runtime = time.perf_counter() - start
+
+    deviation = np.abs(
+        normalize_fragility(ref_mat) - normalize_fragility(test_mat.astype(np.float64))
+    )
+    return {
+        "dtype": np.dtype(dtype).name,
+        "n_channels": data.shape[0],
+        "n_windows": ref_mat.shape[1],
+        "max_abs_dev": float(deviation.max()),
+        "mean_abs_dev": float(deviation.mean()),
+        "runtime_float64": ref_runtime,
+        f"runtime_{np.dtype(dtype).name}": test_runtime,
+    }
+
+
+def compare_engines(raw, reference="monopolar", n_jobs=1, **model_params):
+    """Compare the float64 numpy engine against eztrack's lds_raw_fragility.
+
+    :func:`spes.fragility.run_fragility_analysis.run_analysis` runs eztrack's
+    ``lds_raw_fragility`` by default and switches to
+    :func:`spes.fragility.lds.lds_fragility` for any non-default dtype,
+    output profile or state structure, so the numpy engine has to reproduce
+    eztrack's fit before its results are comparable across recordings.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The preloaded, preprocessed recording without bad channels.
+    reference : str
+        The reference of ``raw``, passed to ``lds_raw_fragility``.
+    n_jobs : int
+        The number of workers of both engines.
+    **model_params
+        ``winsize``, ``stepsize``, ``radius`` and ``l2penalty`` of the fit.
+
+    Returns
+    -------
+    result : dict
+        The max absolute deviation of the normalized fragility heatmap and
+        whether it is within ``ENGINE_TOLERANCE``, the max relative
+        deviation of the perturbation norms and state matrices, and the
+        runtime of both engines in seconds.
+    """
+    from eztrack.fragility import lds_raw_fragility
+
+    model_params = {**ENGINE_DEFAULTS, **model_params}
+    start = time.perf_counter()
+    derivs = lds_raw_fragility(
+        raw,
+        reference=reference,
+        return_all=True,
+        n_jobs=n_jobs,
+        method_to_use="pinv",
+        **model_params,
+    )
+    eztrack_runtime = time.perf_counter() - start
+    eztrack_mat = derivs[0].get_data()
+    eztrack_state = derivs[1].get_data()
+
+    start = time.perf_counter()
+    numpy_mat, numpy_state, _ = lds_fragility(
+        raw.get_data(),
+        dtype=np.float64,
+        return_all=True,
+        n_jobs=n_jobs,
+        **model_params,
+    )
+    numpy_runtime = time.perf_counter() - start
+
+    deviation = np.abs(normalize_fragility(eztrack_mat) - normalize_fragility(numpy_mat))
+    return {
+        "n_channels": len(raw.ch_names),
+        "n_windows": numpy_mat.shape[1],
+        "max_abs_dev": float(deviation.max()),
+        "within_tolerance": bool(deviation.max() <= ENGINE_TOLERANCE),
+        "max_rel_dev_perturbation": float(
+            np.abs(eztrack_mat - numpy_mat).max() / np.abs(eztrack_mat).max()
+        ),
+        "rel_error_state": float(
+            np.linalg.norm(eztrack_state.reshape(numpy_state.shape) - numpy_state)
+            / np.linalg.norm(eztrack_state)
+        ),
+        "runtime_eztrack": eztrack_runtime,
+        "runtime_numpy": numpy_runtime,
+    }
+
+
+def _prediction_error(data, state_arr, winsize, stepsize):
+    """Mean relative one-step prediction error of the fitted state matrices."""
+    n_chs, n_windows = data.shape[0], state_arr.shape[1]
+    errors = np.empty(n_windows)
+    for widx in range(n_windows):
+        window = data[:, widx * stepsize : widx * stepsize + winsize]
+        A = state_arr[:, widx].reshape(n_chs, n_chs)
+        residual = window[:, 1:] - A @ window[:, :-1]
+        errors[widx] = np.linalg.norm(residual) / np.linalg.norm(window[:, 1:])
+    return float(errors.mean())
+
+
+def compare_state_structure(data, groups, **model_params):
+    """Compare a block-diagonal LDS fit against the dense fit.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The data to compute fragility on.
+    groups : list of list of int
+        Channel indices of each block, e.g. the values of
+        :func:`spes.bids.utils._group_channels_by_shaft`.
+    **model_params
+        Keyword arguments passed to :func:`spes.fragility.lds.lds_fragility`.
+
+    Returns
+    -------
+    result : dict
+        The runtime of both fits, the max and mean absolute deviation of
+        the normalized fragility heatmap, and the mean relative one-step
+        prediction error of each fit.
+    """
+    winsize = model_params.get("winsize", 250)
+    stepsize = model_params.get("stepsize", 125)
+
+    start = time.perf_counter()
+    dense_mat, dense_state, _ = lds_fragility(data, return_all=True, **model_params)
+    dense_runtime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    block_mat, block_state, _ = lds_fragility(
+        data, return_all=True, groups=groups, **model_params
+    )
+    block_runtime = time.perf_counter() - start
+
+    deviation = np.abs(normalize_fragility(dense_mat) - normalize_fragility(block_mat))
+    return {
+        "n_channels": data.shape[0],
+        "n_groups": len(groups),
+        "max_group_size": max(len(idx) for idx in groups),
+        "runtime_dense": dense_runtime,
+        "runtime_block": block_runtime,
+        "max_abs_dev": float(deviation.max()),
+        "mean_abs_dev": float(deviation.mean()),
+        "prediction_error_dense": _prediction_error(
+            data, dense_state, winsize, stepsize
+        ),
+        "prediction_error_block": _prediction_error(
+            data, block_state, winsize, stepsize
+        ),
+    }
+
+
+def benchmark_solvers(
+    shapes=((50, 250), (100, 250), (200, 250), (240, 250)),
+    energy=0.99,
+    n_windows=64,
+    n_sources=40,
+    noise=0.01,
+    l2penalty=1e-9,
+):
+    """Benchmark the randomized truncated solver against the exact pinv.
+
+    For each ``(n_channels, winsize)`` shape, ``n_windows`` windows of
+    simulated data are fit with the exact SVD and with the randomized
+    solver truncated at ``energy``.
+
+    With sensor noise, the pseudo-inverse fits the weak noise directions
+    that the truncation drops, so the state matrices and fragility of the
+    two fits differ entirely. Only with ``noise=0`` (rank-deficient
+    windows) is fragility within ``TRUNCATION_TOLERANCE`` of the exact fit.
+
+    Parameters
+    ----------
+    shapes : tuple of tuple of int
+        The ``(n_channels, winsize)`` shapes to benchmark.
+    energy : float
+        The fraction of energy kept by the truncated solver.
+    n_windows : int
+        The number of windows fit per shape.
+    n_sources : int
+        The number of latent sources of the simulated data.
+    noise : float
+        The relative sensor noise of the simulated data.
+    l2penalty : float
+        The Tikhonov regularization of both fits.
+
+    Returns
+    -------
+    result_df : pd.DataFrame
+        Per shape: runtimes, the relative Frobenius error of the state
+        matrices and of the one-step prediction against the exact fit,
+        the max deviation of the normalized fragility and whether it is
+        within ``TRUNCATION_TOLERANCE``, and the dropped energy fraction.
+        Its square root is the relative error of the best rank-truncated
+        snapshot matrix (Eckart-Young), which the randomized solver can
+        only approach.
+    """
+    records = []
+    for n_chs, winsize in shapes:
+        data = simulate_lds_data(
+            n_chs=n_chs,
+            n_times=n_windows * winsize,
+            n_sources=n_sources,
+            noise=noise,
+        )
+        windows = data.reshape(n_chs, n_windows, winsize).transpose(1, 0, 2)
+        X1, X2 = windows[..., :-1], windows[..., 1:]
+
+        start = time.perf_counter()
+        A_exact = fit_state_matrices(windows, l2penalty=l2penalty)
+        runtime_exact = time.perf_counter() - start
+
+        start = time.perf_counter()
+        A_approx = fit_state_matrices(
+            windows,
+            l2penalty=l2penalty,
+            solver="randomized",
+            energy=energy,
+        )
+        runtime_approx = time.perf_counter() - start
+
+        # the energy the truncated solver dropped, from the exact spectrum
+        s = np.linalg.svd(X1, compute_uv=False)
+        cum_energy = np.cumsum(s**2, axis=-1) / (s**2).sum(axis=-1, keepdims=True)
+        rank = (cum_energy < energy).sum(axis=-1) + 1
+        dropped = 1 - np.take_along_axis(cum_energy, rank[:, None] - 1, axis=-1)
+
+        pred_exact = np.matmul(A_exact, X1)
+        pred_approx = np.matmul(A_approx, X1)
+        norms_exact = compute_perturbation_norms(A_exact, 1.5).T
+        norms_approx = compute_perturbation_norms(A_approx, 1.5).T
+        max_abs_dev = np.abs(
+            normalize_fragility(norms_exact) - normalize_fragility(norms_approx)
+        ).max()
+        records.append(
+            {
+                "n_channels": n_chs,
+                "winsize": winsize,
+                "energy": energy,
+                "mean_rank": float(rank.mean()),
+                "runtime_pinv": runtime_exact,
+                "runtime_randomized": runtime_approx,
+                "rel_error_state": float(
+                    np.linalg.norm(A_exact - A_approx) / np.linalg.norm(A_exact)
+                ),
+                "rel_error_prediction": float(
+                    np.linalg.norm(pred_exact - pred_approx) / np.linalg.norm(X2)
+                ),
+                "max_abs_dev_fragility": float(max_abs_dev),
+                "within_tolerance": bool(max_abs_dev <= TRUNCATION_TOLERANCE),
+                "max_dropped_energy": float(dropped.max()),
+                "snapshot_error_bound": float(np.sqrt(dropped.max())),
+            }
+        )
+
+    result_df = pd.DataFrame.from_records(records)
+    print(result_df)
+    return result_df
+
+
+def validate_precision(
+    bids_paths=None, dtype=np.float32, n_chs=(20, 50, 100), resample_sfreq=None
+):
+    """Validate reduced precision fragility on synthetic and real recordings.
+
+    Each recording is first computed with the float64 numpy engine and
+    eztrack's ``lds_raw_fragility`` (see :func:`compare_engines`), then in
+    ``dtype`` against the float64 numpy engine (see
+    :func:`compare_precision`).
+
+    Parameters
+    ----------
+    bids_paths : list of mne_bids.BIDSPath | None
+        Real recordings to validate on, loaded and preprocessed with
+        :func:`spes.read.load_data`.
+    dtype : np.dtype
+        The reduced precision dtype to validate.
+    n_chs : tuple of int
+        The channel counts of the synthetic recordings.
+    resample_sfreq : float | None
+        The sampling frequency to resample real recordings to.
+
+    Returns
+    -------
+    result_df : pd.DataFrame
+        One row per recording with the deviation of the numpy engine
+        against eztrack (``max_abs_dev_eztrack``) and of ``dtype`` against
+        float64.
+    """
+    import mne
+
+    recordings = []
+    for n_ch in n_chs:
+        data = simulate_lds_data(n_chs=n_ch, n_times=10_000)
+        info = mne.create_info(n_ch, sfreq=1000.0, ch_types="seeg")
+        recordings.append((f"synthetic-{n_ch}", mne.io.RawArray(data, info)))
+
+    if bids_paths is not None:
+        from spes.read import load_data
+
+        for bids_path in bids_paths:
+            raw = load_data(bids_path, resample_sfreq, None, plot_raw=False)
+            raw.drop_channels(raw.info["bads"])
+            recordings.append((bids_path.basename, raw))
+
+    records = []
+    for recording, raw in recordings:
+        engines = compare_engines(raw, **ENGINE_DEFAULTS)
+        record = compare_precision(raw.get_data(), dtype=dtype, **ENGINE_DEFAULTS)
+        record["recording"] = recording
+        record["max_abs_dev_eztrack"] = engines["max_abs_dev"]
+        record["eztrack_within_tolerance"] = engines["within_tolerance"]
+        records.append(record)
+
+    result_df = pd.DataFrame.from_records(records)
+    print(result_df)
+    return result_df
+
+
+if __name__ == "__main__":
+    validate_precision()
@@ -0,0 +1,701 @@
+"""A work queue on a shared filesystem, for workers on several nodes.
+
+Jobs are JSON files that move between the folders of the queue::
+
+    <queue root>/pending/<job id>.json
+    <queue root>/claimed/<job id>__<worker id>.json
+    <queue root>/done/<job id>.json
+    <queue root>/failed/<job id>.json
+
+A worker claims a job by renaming it from ``pending`` into ``claimed``,
+which is atomic, so exactly one worker gets each job. While working, it
+renews its lease by touching the claimed file. Leases whose file was not
+touched for ``lease_seconds`` (e.g. the node died) are moved back to
+``pending`` by any worker, until a job failed ``max_attempts`` times.
+Lease times are compared against the file server's clock, so the nodes'
+clocks do not have to agree. Its offset from the local clock is measured
+with a file every few minutes, not on every check.
+
+A job is finished by renaming its claimed file to a hidden
+``.<claimed name>.finishing`` file before it is written to its next
+state. If the worker dies in between, the job is requeued once the lease
+of that file expired, like an expired claim.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from mne.utils import warn
+
+JOB_STATES = ("pending", "claimed", "done", "failed")
+
+# how often the offset of the file server's clock is measured again
+CLOCK_REFRESH_SECONDS = 300.0
+
+
+def _atomic_write_json(fpath, content):
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(f".{fpath.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_fpath, "w") as fout:
+        json.dump(content, fout, indent=4)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_fpath, fpath)
+
+
+def _read_json(fpath):
+    with open(fpath, "r") as fin:
+        return json.load(fin)
+
+
+class FileJobQueue:
+    """A job queue in a folder of a shared filesystem.
+
+    Parameters
+    ----------
+    root : str | Path
+        The folder of the queue, e.g. ``<bids root>/derivatives/jobqueue``.
+    lease_seconds : float
+        The time after the last heartbeat when a claimed job is requeued.
+    max_attempts : int
+        The number of times a job is tried before it is moved to ``failed``.
+    """
+
+    def __init__(self, root, lease_seconds=600.0, max_attempts=3):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in JOB_STATES:
+            (self.root / state).mkdir(exist_ok=True, parents=True)
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._clock_offset = None
+        self._clock_checked = None
+
+    def __repr__(self):
+        counts = ", ".join(f"{n} {state}" for state, n in self.counts().items())
+        return f"<FileJobQueue | {self.root}, {counts}>"
+
+    def _state_path(self, state):
+        return self.root / state
+
+    def _fs_now(self):
+        """The current time of the file server.
+
+        The offset of the server's clock is measured by touching a file,
+        once every ``CLOCK_REFRESH_SECONDS``, so polling does not write to
+        the shared filesystem.
+        """
+        now = time.time()
+        if (
+            self._clock_offset is None
+            or now - self._clock_checked > CLOCK_REFRESH_SECONDS
+        ):
+            clock_fpath = self.root / f".clock-{self.worker_id}-{uuid.uuid4().hex}"
+            clock_fpath.touch()
+            try:
+                self._clock_offset = clock_fpath.stat().st_mtime - time.time()
+            finally:
+                clock_fpath.unlink(missing_ok=True)
+            self._clock_checked = now
+        return time.time() + self._clock_offset
+
+    def counts(self):
+        """Count the jobs in each state.
+
+        Returns
+        -------
+        counts : dict
+            Mapping of each state to its number of jobs.
+        """
+        return {
+            state: len(list(self._state_path(state).glob("*.json")))
+            for state in JOB_STATES
+        }
+
+    def _job_exists(self, job_id):
+        for state in ("pending", "done", "failed"):
+            if (self._state_path(state) / f"{job_id}.json").exists():
+                return True
+        return any(self._state_path("claimed").glob(f"{job_id}__*.json"))
+
+    def submit(self, kind, params, job_id=None):
+        """Add a job to the queue, unless it was already submitted.
+
+        Parameters
+        ----------
+        kind : str
+            The job type, a key of the worker's handlers, e.g.
+            ``"fragility"`` or ``"convert"``.
+        params : dict
+            JSON-serializable keyword arguments of the handler.
+        job_id : str | None
+            A unique name of the job. Defaults to a hash of ``kind`` and
+            ``params``, so submitting the same job twice is a no-op.
+
+        Returns
+        -------
+        job_id : str | None
+            The id of the job, or None if it already exists.
+        """
+        if job_id is None:
+            digest = hashlib.sha1(
+                json.dumps([kind, params], sort_keys=True).encode()
+            ).hexdigest()
+            job_id = f"{kind}-{digest[:16]}"
+        if "__" in job_id:
+            raise ValueError(f"job_id cannot contain '__', got {job_id}.")
+        if self._job_exists(job_id):
+            return None
+
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "params": params,
+            "attempts": 0,
+            "submitted": time.time(),
+            "history": [],
+        }
+        _atomic_write_json(self._state_path("pending") / f"{job_id}.json", job)
+        return job_id
+
+    def claim(self):
+        """Claim the next pending job.
+
+        Returns
+        -------
+        job : dict | None
+            The job, with its claimed file in ``job["claim_fpath"]``, or
+            None if no job is pending.
+        """
+        for job_fpath in sorted(self._state_path("pending").glob("*.json")):
+            claim_fpath = (
+                self._state_path("claimed") / f"{job_fpath.stem}__{self.worker_id}.json"
+            )
+            # the rename keeps the mtime, so the lease is started before it,
+            # otherwise the job would look expired until it is touched
+            try:
+                os.utime(job_fpath)
+                os.rename(job_fpath, claim_fpath)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            try:
+                job = _read_json(claim_fpath)
+            except FileNotFoundError:
+                # the lease was taken away before it was read
+                continue
+            job["claim_fpath"] = str(claim_fpath)
+            return job
+        return None
+
+    def heartbeat(self, job):
+        """Renew the lease of a claimed job.
+
+        Returns
+        -------
+        alive : bool
+            False if the lease expired and the job was taken away.
+        """
+        try:
+            os.utime(job["claim_fpath"])
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _finish(self, job, state, record):
+        claim_fpath = Path(job["claim_fpath"])
+        content = {key: val for key, val in job.items() if key != "claim_fpath"}
+        content["history"] = content["history"] + [record]
+        if state == "pending":
+            content["attempts"] += 1
+            if content["attempts"] >= self.max_attempts:
+                state = "failed"
+
+        # take the claimed file first, so a lost lease is not finished twice
+        finishing_fpath = claim_fpath.with_name(f".{claim_fpath.name}.finishing")
+        try:
+            os.rename(claim_fpath, finishing_fpath)
+        except FileNotFoundError:
+            warn(f"Lease of job {job['id']} expired, it was requeued.")
+            return None
+        _atomic_write_json(self._state_path(state) / f"{job['id']}.json", content)
+        finishing_fpath.unlink()
+        return state
+
+    def complete(self, job, result=None):
+        """Move a claimed job to ``done``."""
+        record = {"worker": self.worker_id, "finished": time.time(), "result": result}
+        return self._finish(job, "done", record)
+
+    def fail(self, job, error):
+        """Requeue a claimed job that failed, or move it to ``failed``."""
+        record = {"worker": self.worker_id, "finished": time.time(), "error": error}
+        return self._finish(job, "pending", record)
+
+    @contextmanager
+    def lock(self, name, poll_interval=1.0):
+        """Hold a named lock shared by all workers of the queue.
+
+        The lock is a file created exclusively in ``<queue root>/locks``.
+        A lock not released within ``lease_seconds`` (e.g. its holder
+        died) is broken by renaming it to a unique name, which only one
+        worker can do. If the renamed file turns out to be a fresh lock
+        another worker took in the meantime, it is given back.
+        """
+        lock_dir = self.root / "locks"
+        lock_dir.mkdir(exist_ok=True)
+        lock_fpath = lock_dir / f"{name}.lock"
+        token = f"{self.worker_id}-{uuid.uuid4().hex}"
+        while True:
+            try:
+                fd = os.open(lock_fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    lock_stat = lock_fpath.stat()
+                    age = self._fs_now() - lock_stat.st_mtime
+                except FileNotFoundError:
+                    continue
+                if age > self.lease_seconds:
+                    self._break_lock(lock_fpath, lock_stat)
+                else:
+                    time.sleep(poll_interval)
+                continue
+            os.write(fd, token.encode())
+            os.close(fd)
+            break
+        try:
+            yield
+        finally:
+            # only release the lock if it was not broken and taken by another
+            # worker while it was held
+            try:
+                owned = lock_fpath.read_text() == token
+            except FileNotFoundError:
+                owned = False
+            if owned:
+                lock_fpath.unlink(missing_ok=True)
+            else:
+                warn(f"Lock {lock_fpath} was broken while it was held.")
+
+    def _break_lock(self, lock_fpath, lock_stat):
+        """Remove a stale lock, unless another worker replaced it already."""
+        stale_fpath = lock_fpath.with_name(
+            f".{lock_fpath.name}.{uuid.uuid4().hex}.stale"
+        )
+        try:
+            os.rename(lock_fpath, stale_fpath)
+        except FileNotFoundError:
+            # another worker broke it first
+            return
+        stale_stat = stale_fpath.stat()
+        if (stale_stat.st_ino, stale_stat.st_mtime_ns) != (
+            lock_stat.st_ino,
+            lock_stat.st_mtime_ns,
+        ):
+            # the stale lock was broken and retaken by another worker since it
+            # was checked, so the fresh lock is put back
+            try:
+                os.link(stale_fpath, lock_fpath)
+            except FileExistsError:
+                warn(f"Could not give back the lock {lock_fpath} taken by mistake.")
+        else:
+            warn(f"Breaking stale lock {lock_fpath}.")
+        stale_fpath.unlink(missing_ok=True)
+
+    def _recover_finishing(self, now):
+        """Give the jobs of workers that died while finishing them back.
+
+        A job whose next state was written is done, and only the finishing
+        file is removed. Otherwise the file is renamed back to its claimed
+        name, keeping its expired lease.
+        """
+        for finishing_fpath in self._state_path("claimed").glob(".*.finishing"):
+            try:
+                expired = now - finishing_fpath.stat().st_mtime > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            claim_name = finishing_fpath.name[1 : -len(".finishing")]
+            job_id = claim_name.split("__", 1)[0]
+            if any(
+                (self._state_path(state) / f"{job_id}.json").exists()
+                for state in ("pending", "done", "failed")
+            ):
+                finishing_fpath.unlink(missing_ok=True)
+                continue
+            try:
+                os.rename(finishing_fpath, self._state_path("claimed") / claim_name)
+            except FileNotFoundError:
+                # another worker recovered it first
+                continue
+
+    def requeue_expired(self):
+        """Move claimed jobs with an expired lease back to ``pending``.
+
+        Jobs whose worker died while finishing them are requeued as well.
+
+        Returns
+        -------
+        job_ids : list of str
+            The requeued jobs.
+        """
+        now = self._fs_now()
+        self._recover_finishing(now)
+        job_ids = []
+        for claim_fpath in self._state_path("claimed").glob("*.json"):
+            try:
+                expired = now - claim_fpath.stat().st_mtime > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            try:
+                job = _read_json(claim_fpath)
+            except FileNotFoundError:
+                continue
+            job["claim_fpath"] = str(claim_fpath)
+            worker_id = claim_fpath.stem.split("__", 1)[1]
+            record = {"worker": worker_id, "finished": time.time(), "error": "expired"}
+            if self._finish(job, "pending", record) is not None:
+                job_ids.append(job["id"])
+        return job_ids
+
+
+class _Heartbeat:
+    """Renew the lease of a job in a background thread while it runs."""
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        self.alive = True
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = self.queue.lease_seconds / 3
+        while not self._stop.wait(interval):
+            if not self.queue.heartbeat(self.job):
+                self.alive = False
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def _run_fragility_job(
+    bids_root, entities, deriv_path, figures_path, references=None, **kwargs
+):
+    """Run the fragility analysis of one recording."""
+    from mne_bids import BIDSPath
+
+    from spes.fragility.run_fragility_analysis import (
+        run_analysis,
+        run_multi_reference_analysis,
+    )
+
+    bids_path = BIDSPath(**entities, root=bids_root)
+    if references is not None:
+        run_multi_reference_analysis(
+            bids_path,
+            references=tuple(references),
+            deriv_path=Path(deriv_path),
+            figures_path=Path(figures_path),
+            **kwargs,
+        )
+    else:
+        run_analysis(
+            bids_path,
+            deriv_path=Path(deriv_path),
+            figures_path=Path(figures_path),
+            **kwargs,
+        )
+    return bids_path.basename
+
+
+def _merge_participants(staged_fpath, participants_fpath, participant_id):
+    """Replace the row of a participant in ``participants.tsv``."""
+    from mne_bids.tsv_handler import _from_tsv, _to_tsv
+
+    staged = _from_tsv(staged_fpath)
+    if not participants_fpath.exists():
+        os.replace(staged_fpath, participants_fpath)
+        return
+    participants = _from_tsv(participants_fpath)
+    keep = [
+        idx
+        for idx, val in enumerate(participants["participant_id"])
+        if val != participant_id
+    ]
+    columns = list(participants) + [col for col in staged if col not in participants]
+    merged = dict()
+    for column in columns:
+        old_vals = participants.get(
+            column, ["n/a"] * len(participants["participant_id"])
+        )
+        new_vals = staged.get(column, ["n/a"] * len(staged["participant_id"]))
+        merged[column] = [old_vals[idx] for idx in keep] + list(new_vals)
+    tmp_fpath = participants_fpath.with_name(
+        f".{participants_fpath.name}.{uuid.uuid4().hex}.tmp"
+    )
+    _to_tsv(merged, tmp_fpath)
+    os.replace(tmp_fpath, participants_fpath)
+
+
+def _staging_path(bids_root):
+    """The staging folder of conversions, next to but outside the BIDS root."""
+    bids_root = Path(bids_root)
+    return bids_root.parent / f".{bids_root.name}-staging"
+
+
+def _run_convert_job(runs, bids_root, queue_root=None, **kwargs):
+    """Convert the EDF files of one subject to BIDS.
+
+    The runs of a subject share its ``scans.tsv``, so they are converted
+    in one job. Each job converts into its own staging root, next to the
+    BIDS root so that readers of the dataset never see it, so the EDF
+    files are read and written in parallel with other jobs, and then
+    moves the subject folder into ``bids_root``. Only the merge of the
+    files shared by all subjects (``participants.tsv``, the dataset
+    description) holds the queue's ``bids-root`` lock.
+
+    Before the subject's files are moved, a marker is written next to the
+    staging roots and it is only removed once the job is done. A retry of a
+    job that failed while moving finds the marker and replaces the files
+    the earlier attempt moved, instead of failing on them.
+    """
+    from eztrack.preprocess.bids_conversion import append_original_fname_to_scans
+
+    from spes.bids.scripts.run_bids_conversion import write_edf_to_bids
+
+    queue = FileJobQueue(queue_root) if queue_root is not None else None
+    bids_root = Path(bids_root)
+    subject = runs[0]["bids_kwargs"]["subject"]
+    staging_path = _staging_path(bids_root)
+    staging_root = staging_path / f"sub-{subject}-{uuid.uuid4().hex}"
+    moving_fpath = staging_path / f"sub-{subject}.moving"
+    output_fnames = []
+    try:
+        for run in runs:
+            output_dict = write_edf_to_bids(
+                edf_fpath=run["edf_fpath"],
+                bids_kwargs=run["bids_kwargs"],
+                bids_root=staging_root,
+                **kwargs,
+            )
+            append_original_fname_to_scans(
+                Path(run["edf_fpath"]).name, staging_root, output_dict["output_fname"]
+            )
+            output_fnames.append(output_dict["output_fname"])
+
+        # the subject folder only belongs to this job, and files left by an
+        # earlier attempt of it are replaced
+        staged_subject = staging_root / f"sub-{subject}"
+        staged_fpaths = [
+            fpath for fpath in sorted(staged_subject.rglob("*")) if not fpath.is_dir()
+        ]
+        if not kwargs.get("overwrite", False) and not moving_fpath.exists():
+            for staged_fpath in staged_fpaths:
+                fpath = bids_root / staged_fpath.relative_to(staging_root)
+                if fpath.exists():
+                    raise FileExistsError(
+                        f"{fpath} already exists. Set overwrite=True to replace it."
+                    )
+        moving_fpath.touch()
+        for staged_fpath in staged_fpaths:
+            fpath = bids_root / staged_fpath.relative_to(staging_root)
+            fpath.parent.mkdir(exist_ok=True, parents=True)
+            os.replace(staged_fpath, fpath)
+
+        with queue.lock("bids-root") if queue is not None else nullcontext():
+            for staged_fpath in sorted(staging_root.iterdir()):
+                fpath = bids_root / staged_fpath.name
+                if staged_fpath.name == "participants.tsv":
+                    _merge_participants(staged_fpath, fpath, f"sub-{subject}")
+                elif staged_fpath.is_file() and not fpath.exists():
+                    os.replace(staged_fpath, fpath)
+        moving_fpath.unlink(missing_ok=True)
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+    return output_fnames
+
+
+JOB_HANDLERS = {
+    "fragility": _run_fragility_job,
+    "convert": _run_convert_job,
+}
+
+
+def submit_fragility_jobs(queue, bids_paths, deriv_path, figures_path, **kwargs):
+    """Submit the fragility analysis of recordings to a job queue.
+
+    Parameters
+    ----------
+    queue : FileJobQueue
+        The queue.
+    bids_paths : list of mne_bids.BIDSPath
+        The recordings.
+    deriv_path, figures_path : str | Path
+        The derivative and figure roots, see
+        :func:`spes.fragility.run_fragility_analysis.run_analysis`.
+    **kwargs
+        JSON-serializable keyword arguments of ``run_analysis``. Pass
+        ``references`` (a list) instead of ``reference`` to run
+        :func:`spes.fragility.run_fragility_analysis.run_multi_reference_analysis`
+        instead.
+
+    Returns
+    -------
+    job_ids : list of str
+        The ids of the newly submitted jobs.
+    """
+    if "references" in kwargs and "reference" in kwargs:
+        raise ValueError("Pass either reference or references, not both.")
+    job_ids = []
+    for bids_path in bids_paths:
+        entities = {
+            "subject": bids_path.subject,
+            "session": bids_path.session,
+            "task": bids_path.task,
+            "acquisition": bids_path.acquisition,
+            "run": bids_path.run,
+            "datatype": bids_path.datatype,
+            "suffix": bids_path.suffix,
+            "extension": bids_path.extension,
+        }
+        params = {
+            "bids_root": str(bids_path.root),
+            "entities": entities,
+            "deriv_path": str(deriv_path),
+            "figures_path": str(figures_path),
+            **kwargs,
+        }
+        references = kwargs.get("references", [kwargs.get("reference", "monopolar")])
+        job_id = queue.submit(
+            "fragility",
+            params,
+            job_id=f"fragility-{bids_path.basename}-{'-'.join(references)}",
+        )
+        if job_id is not None:
+            job_ids.append(job_id)
+    return job_ids
+
+
+def submit_conversion_jobs(queue, runs, bids_root, **kwargs):
+    """Submit the BIDS conversion of EDF files to a job queue.
+
+    Parameters
+    ----------
+    queue : FileJobQueue
+        The queue.
+    runs : list of dict
+        The ``edf_fpath`` and ``bids_kwargs`` of each EDF file, see
+        :func:`spes.bids.scripts.run_bids_conversion.write_edf_to_bids`.
+        One job is submitted per subject.
+    bids_root : str | Path
+        The BIDS root to write to.
+    **kwargs
+        JSON-serializable keyword arguments of ``write_edf_to_bids``.
+
+    Returns
+    -------
+    job_ids : list of str
+        The ids of the newly submitted jobs.
+    """
+    subject_runs = dict()
+    for run in runs:
+        subject = run["bids_kwargs"]["subject"]
+        subject_runs.setdefault(subject, []).append(
+            {"edf_fpath": str(run["edf_fpath"]), "bids_kwargs": run["bids_kwargs"]}
+        )
+
+    job_ids = []
+    for subject, runs in subject_runs.items():
+        params = {
+            "runs": runs,
+            "bids_root": str(bids_root),
+            "queue_root": str(queue.root),
+            **kwargs,
+        }
+        job_id = queue.submit("convert", params, job_id=f"convert-sub-{subject}")
+        if job_id is not None:
+            job_ids.append(job_id)
+    return job_ids
+
+
+def run_worker(
+    queue, handlers=None, poll_interval=30.0, max_jobs=None, exit_when_empty=False
+):
+    """Pull and run jobs from a queue until it is empty or stopped.
+
+    Any number of workers, on any node that mounts the queue, can run this
+    at the same time.
+
+    Parameters
+    ----------
+    queue : FileJobQueue
+        The queue.
+    handlers : dict | None
+        Mapping of job ``kind`` to the function that runs it with the job's
+        ``params``. Defaults to ``JOB_HANDLERS``.
+    poll_interval : float
+        Seconds to wait when no job is pending.
+    max_jobs : int | None
+        Stop after this many jobs.
+    exit_when_empty : bool
+        Stop when no job is pending or claimed, instead of polling.
+
+    Returns
+    -------
+    n_jobs : int
+        The number of jobs this worker ran.
+    """
+    handlers = JOB_HANDLERS if handlers is None else handlers
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        requeued = queue.requeue_expired()
+        if requeued:
+            print(f"Requeued jobs with expired leases: {requeued}")
+
+        job = queue.claim()
+        if job is None:
+            counts = queue.counts()
+            if exit_when_empty and counts["pending"] == 0 and counts["claimed"] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        print(f"{queue.worker_id} running {job['id']}")
+        with _Heartbeat(queue, job) as heartbeat:
+            try:
+                result = handlers[job["kind"]](**job["params"])
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Job {job['id']} failed:\n{error}")
+                queue.fail(job, error)
+            else:
+                if not heartbeat.alive:
+                    warn(f"Lease of job {job['id']} was lost while running.")
+                queue.complete(job, result=result)
+        n_jobs += 1
+    return n_jobs
+
+
+if __name__ == "__main__":
+    import sys
+
+    run_worker(FileJobQueue(sys.argv[1]), exit_when_empty=True)
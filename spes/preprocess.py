@@ -0,0 +1,673 @@
+"""Preprocessing operators applied to already loaded recordings."""
+
+import contextlib
+import re
+from fractions import Fraction
+
+import mne
+import numpy as np
+from scipy import signal, sparse
+
+from spes.bids.utils import _group_channels_by_shaft
+
+REFERENCES = ("monopolar", "bipolar", "average")
+
+
+def _contact_number(ch_name):
+    match = re.search(r"(\d+)$", ch_name)
+    return int(match.group(1)) if match else 0
+
+
+def make_reference_operator(ch_names, reference):
+    """Build the linear operator of a re-reference montage.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The monopolar channel names, normalized by
+        :func:`spes.bids.utils._channel_text_scrub`.
+    reference : str
+        One of ``"monopolar"``, ``"bipolar"`` or ``"average"``.
+
+    Returns
+    -------
+    operator : scipy.sparse.csr_matrix | None
+        Sparse matrix of shape (n_new_channels, n_channels) mapping the
+        monopolar data to the re-referenced data. None for the monopolar
+        and common average references, which are applied without a
+        matrix product.
+    new_ch_names : list of str
+        The names of the re-referenced channels. Bipolar channels are named
+        ``<anode>-<cathode>`` of neighboring contacts on the same electrode.
+    """
+    if reference not in REFERENCES:
+        raise ValueError(f"reference must be one of {REFERENCES}, not {reference}.")
+    if reference in ("monopolar", "average"):
+        return None, list(ch_names)
+
+    rows, cols, vals, new_ch_names = [], [], [], []
+    for idx in _group_channels_by_shaft(ch_names).values():
+        idx = sorted(idx, key=lambda ch_idx: _contact_number(ch_names[ch_idx]))
+        for anode, cathode in zip(idx[:-1], idx[1:]):
+            row = len(new_ch_names)
+            rows.extend([row, row])
+            cols.extend([anode, cathode])
+            vals.extend([1.0, -1.0])
+            new_ch_names.append(f"{ch_names[anode]}-{ch_names[cathode]}")
+
+    operator = sparse.csr_matrix(
+        (vals, (rows, cols)), shape=(len(new_ch_names), len(ch_names))
+    )
+    return operator, new_ch_names
+
+
+def apply_reference(raw, reference):
+    """Re-reference a preloaded, preprocessed recording.
+
+    The re-referenced data is computed with one linear transform of the
+    loaded buffer, so several montages can be derived from a single read
+    and filter pass.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The preloaded monopolar recording, without bad channels.
+    reference : str
+        One of ``"monopolar"``, ``"bipolar"`` or ``"average"``.
+
+    Returns
+    -------
+    raw_ref : mne.io.Raw
+        The re-referenced recording. For ``"monopolar"``, ``raw`` itself.
+    """
+    if reference == "monopolar":
+        return raw
+
+    operator, new_ch_names = make_reference_operator(raw.ch_names, reference)
+    data = raw.get_data()
+    if reference == "average":
+        data -= data.mean(axis=0, keepdims=True)
+        ch_types = raw.get_channel_types()
+    else:
+        data = operator @ data
+        orig_types = np.array(raw.get_channel_types())
+        anodes = operator.indices[operator.data > 0]
+        ch_types = orig_types[anodes].tolist()
+
+    info = mne.create_info(new_ch_names, raw.info["sfreq"], ch_types)
+    info["line_freq"] = raw.info["line_freq"]
+    raw_ref = mne.io.RawArray(data, info, first_samp=raw.first_samp, verbose=False)
+    raw_ref.set_meas_date(raw.info["meas_date"])
+    raw_ref.set_annotations(raw.annotations)
+    return raw_ref
+
+
+def design_preprocess_sos(sfreq, line_freq=60.0, l_freq=0.5, h_freq=200.0, order=4):
+    """Design the causal IIR filter cascade of the iEEG preprocessing.
+
+    The cascade mirrors the filters of :func:`spes.read.load_data`: a
+    Butterworth band-pass from ``l_freq`` to ``h_freq`` and notch filters at
+    the harmonics of ``line_freq`` within the pass-band.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    line_freq : float | None
+        The power line frequency. No notches if None.
+    l_freq : float
+        The high-pass edge of the band-pass.
+    h_freq : float
+        The low-pass edge of the band-pass. Lowered to 95% of the Nyquist
+        frequency if it is above it.
+    order : int
+        The order of the Butterworth band-pass.
+
+    Returns
+    -------
+    sos : np.ndarray, shape (n_sections, 6)
+        The second-order sections of the whole cascade.
+    """
+    nyq = sfreq / 2.0
+    h_freq = min(h_freq, 0.95 * nyq)
+    sections = [
+        signal.butter(order, [l_freq, h_freq], btype="bandpass", fs=sfreq, output="sos")
+    ]
+    if line_freq:
+        for freq in np.arange(line_freq, h_freq, line_freq):
+            b, a = signal.iirnotch(freq, Q=30.0, fs=sfreq)
+            sections.append(signal.tf2sos(b, a))
+    return np.vstack(sections)
+
+
+class StreamingFilter:
+    """Causal, stateful preprocessing of a multichannel sample stream.
+
+    Applies the cascade of :func:`design_preprocess_sos` block by block.
+    The filter state is carried over between blocks, so filtering a
+    recording in blocks of any size gives the same result as filtering it
+    at once with :func:`scipy.signal.sosfilt`.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    n_channels : int
+        The number of channels.
+    line_freq : float | None
+        The power line frequency.
+    l_freq, h_freq : float
+        The band-pass edges.
+    """
+
+    def __init__(self, sfreq, n_channels, line_freq=60.0, l_freq=0.5, h_freq=200.0):
+        self.sos = design_preprocess_sos(
+            sfreq, line_freq=line_freq, l_freq=l_freq, h_freq=h_freq
+        )
+        self.n_channels = n_channels
+        self._zi = None
+
+    def reset(self):
+        """Forget the filter state, e.g. after a gap in the stream."""
+        self._zi = None
+
+    def process(self, block):
+        """Filter the next block of samples.
+
+        Parameters
+        ----------
+        block : np.ndarray, shape (n_channels, n_samples)
+            The next samples of the stream.
+
+        Returns
+        -------
+        filtered : np.ndarray, shape (n_channels, n_samples)
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] != self.n_channels:
+            raise ValueError(
+                f"Expected {self.n_channels} channels, got {block.shape[0]}."
+            )
+        if block.shape[1] == 0:
+            return block
+        if self._zi is None:
+            # start in the steady state of the first sample, so a DC offset
+            # does not ring through the high-pass
+            self._zi = (
+                signal.sosfilt_zi(self.sos)[:, np.newaxis, :]
+                * block[np.newaxis, :, 0, np.newaxis]
+            )
+        filtered, self._zi = signal.sosfilt(self.sos, block, axis=-1, zi=self._zi)
+        return filtered
+
+
+def design_preprocess_fir(sfreq, line_freq=60.0, l_freq=0.5, h_freq=200.0):
+    """Design the linear-phase FIR kernel of the iEEG preprocessing.
+
+    The kernel combines the band-pass of :func:`mne.filter.filter_data` and
+    the notches of :func:`mne.filter.notch_filter` with their default
+    designs, so zero-phase filtering with it matches filtering in memory
+    with MNE away from the edges.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    line_freq : float | None
+        The power line frequency. No notches if None.
+    l_freq, h_freq : float
+        The band-pass edges. ``h_freq`` is lowered to 95% of the Nyquist
+        frequency if it is above it.
+
+    Returns
+    -------
+    h : np.ndarray, shape (n_taps,)
+        The kernel, with an odd number of taps.
+    """
+    h_freq = min(h_freq, 0.95 * sfreq / 2.0)
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    if line_freq:
+        freqs = np.arange(line_freq, h_freq, line_freq)
+        if len(freqs):
+            # the band-stops of mne.filter.notch_filter with its defaults
+            trans_bandwidth, notch_widths = 1.0, freqs / 200.0
+            lows = freqs - notch_widths / 2.0 - trans_bandwidth / 2.0
+            highs = freqs + notch_widths / 2.0 + trans_bandwidth / 2.0
+            h_notch = mne.filter.create_filter(
+                None,
+                sfreq,
+                highs,
+                lows,
+                l_trans_bandwidth=trans_bandwidth / 2.0,
+                h_trans_bandwidth=trans_bandwidth / 2.0,
+                verbose=False,
+            )
+            h = np.convolve(h, h_notch)
+    return h
+
+
+def _settling_samples(sos, tol=1e-6, max_samples=1_000_000):
+    """Number of samples until the impulse response decays below ``tol``."""
+    impulse = np.zeros(min(max_samples, 2**16))
+    while True:
+        impulse[0] = 1.0
+        response = np.abs(signal.sosfilt(sos, impulse))
+        above = np.flatnonzero(response > tol * response.max())
+        if above[-1] < len(impulse) - 1 or len(impulse) >= max_samples:
+            return int(above[-1]) + 1
+        impulse = np.zeros(min(max_samples, 2 * len(impulse)))
+
+
+class BlockwiseFilter:
+    """Block-wise preprocessing of arbitrarily long recordings.
+
+    Applies the band-pass and line-noise notches of the iEEG preprocessing
+    chunk by chunk, carrying the filter state between chunks:
+
+    - ``method="iir"``: the cascade of :func:`design_preprocess_sos`.
+      With ``phase="zero"`` it is applied forward-backward like
+      :func:`scipy.signal.sosfiltfilt`. The forward pass is exact; the
+      backward pass of each chunk also runs over the next ``overlap``
+      samples, so its error from starting in the wrong state decays like
+      the tail of the impulse response.
+    - ``method="fir"``: the kernel of :func:`design_preprocess_fir`, applied
+      by overlap-save. With ``phase="zero"`` the output is shifted by the
+      kernel's group delay, which is exact.
+
+    Zero-phase outputs lag the inputs by :attr:`latency` samples; the rest
+    is returned by :meth:`flush` at the end of the recording.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    n_channels : int
+        The number of channels.
+    line_freq : float | None
+        The power line frequency.
+    l_freq, h_freq : float
+        The band-pass edges.
+    method : str
+        ``"iir"`` or ``"fir"``.
+    phase : str
+        ``"causal"`` or ``"zero"``.
+    overlap : int | None
+        The look-ahead of the zero-phase IIR backward pass in samples.
+        Defaults to the settling time of the cascade for ``tol``.
+    tol : float
+        The default ``overlap`` is the number of samples until the impulse
+        response of the cascade decays below ``tol`` of its peak.
+    """
+
+    def __init__(
+        self,
+        sfreq,
+        n_channels,
+        line_freq=60.0,
+        l_freq=0.5,
+        h_freq=200.0,
+        method="iir",
+        phase="causal",
+        overlap=None,
+        tol=1e-8,
+    ):
+        if method not in ("iir", "fir"):
+            raise ValueError(f"method must be 'iir' or 'fir', not {method}.")
+        if phase not in ("causal", "zero"):
+            raise ValueError(f"phase must be 'causal' or 'zero', not {phase}.")
+        self.n_channels = n_channels
+        self.method = method
+        self.phase = phase
+
+        if method == "iir":
+            self._forward = StreamingFilter(
+                sfreq, n_channels, line_freq=line_freq, l_freq=l_freq, h_freq=h_freq
+            )
+            self.sos = self._forward.sos
+            if overlap is None:
+                overlap = _settling_samples(self.sos, tol=tol)
+            self.overlap = overlap if phase == "zero" else 0
+            self._pending = np.empty((n_channels, 0))
+        else:
+            self.h = design_preprocess_fir(
+                sfreq, line_freq=line_freq, l_freq=l_freq, h_freq=h_freq
+            )
+            self.overlap = (len(self.h) - 1) // 2 if phase == "zero" else 0
+            self._history = np.zeros((n_channels, len(self.h) - 1))
+            self._n_skip = self.overlap
+
+    @property
+    def latency(self):
+        """The number of samples the outputs lag behind the inputs."""
+        return self.overlap
+
+    def _fir(self, block):
+        extended = np.concatenate([self._history, block], axis=1)
+        self._history = extended[:, extended.shape[1] - self._history.shape[1] :]
+        filtered = signal.oaconvolve(extended, self.h[np.newaxis], mode="valid", axes=1)
+        # drop the group delay of the zero-phase output
+        n_skip = min(self._n_skip, filtered.shape[1])
+        self._n_skip -= n_skip
+        return filtered[:, n_skip:]
+
+    def _backward(self, segment):
+        reversed_segment = segment[:, ::-1]
+        zi = (
+            signal.sosfilt_zi(self.sos)[:, np.newaxis, :]
+            * reversed_segment[np.newaxis, :, 0, np.newaxis]
+        )
+        filtered, _ = signal.sosfilt(self.sos, reversed_segment, axis=-1, zi=zi)
+        return filtered[:, ::-1]
+
+    def process(self, block):
+        """Filter the next chunk of samples.
+
+        Parameters
+        ----------
+        block : np.ndarray, shape (n_channels, n_samples)
+            The next samples of the recording.
+
+        Returns
+        -------
+        filtered : np.ndarray, shape (n_channels, n_out)
+            The filtered samples that are final, which lag ``block`` by
+            :attr:`latency` samples.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if self.method == "fir":
+            return self._fir(block)
+
+        forward = self._forward.process(block)
+        if self.phase == "causal":
+            return forward
+        self._pending = np.concatenate([self._pending, forward], axis=1)
+        n_out = self._pending.shape[1] - self.overlap
+        if n_out <= 0:
+            return np.empty((self.n_channels, 0))
+        filtered = self._backward(self._pending)[:, :n_out]
+        self._pending = self._pending[:, n_out:]
+        return filtered
+
+    def flush(self):
+        """Return the remaining samples at the end of the recording.
+
+        Returns
+        -------
+        filtered : np.ndarray, shape (n_channels, latency)
+        """
+        if self.method == "fir":
+            return self._fir(np.zeros((self.n_channels, self.overlap)))
+        if self.phase == "causal" or self._pending.shape[1] == 0:
+            return np.empty((self.n_channels, 0))
+        filtered = self._backward(self._pending)
+        self._pending = np.empty((self.n_channels, 0))
+        return filtered
+
+
+def preprocess_blockwise(
+    raw,
+    block_duration=10.0,
+    method="iir",
+    phase="zero",
+    l_freq=0.5,
+    h_freq=200.0,
+    out_fpath=None,
+):
+    """Preprocess a recording chunk by chunk.
+
+    The channels analyzed by :func:`spes.read.load_data` are read in chunks
+    of ``block_duration`` seconds with :meth:`mne.io.Raw.get_data`, so the
+    recording does not have to be preloaded, and filtered with
+    :class:`BlockwiseFilter`.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The recording, preloaded or not.
+    block_duration : float
+        The duration of each chunk in seconds.
+    method, phase : str
+        See :class:`BlockwiseFilter`.
+    l_freq, h_freq : float
+        The band-pass edges.
+    out_fpath : str | Path | None
+        If given, the output is written to this ``.npy`` file as a memory
+        map instead of being held in memory.
+
+    Returns
+    -------
+    data : np.ndarray, shape (n_channels, n_times)
+        The preprocessed data of the picked channels.
+    ch_names : list of str
+        The names of the picked channels.
+    """
+    picks = mne.pick_types(
+        raw.info, seeg=True, ecog=True, eeg=True, misc=False, exclude=[]
+    )
+    sfreq = raw.info["sfreq"]
+    engine = BlockwiseFilter(
+        sfreq,
+        len(picks),
+        line_freq=raw.info["line_freq"],
+        l_freq=l_freq,
+        h_freq=h_freq,
+        method=method,
+        phase=phase,
+    )
+
+    shape = (len(picks), raw.n_times)
+    if out_fpath is not None:
+        data = np.lib.format.open_memmap(
+            out_fpath, mode="w+", dtype=np.float64, shape=shape
+        )
+    else:
+        data = np.empty(shape)
+
+    block_size = max(int(block_duration * sfreq), 1)
+    write_idx = 0
+    for start in range(0, raw.n_times, block_size):
+        block = raw.get_data(picks=picks, start=start, stop=start + block_size)
+        filtered = engine.process(block)
+        data[:, write_idx : write_idx + filtered.shape[1]] = filtered
+        write_idx += filtered.shape[1]
+    filtered = engine.flush()
+    data[:, write_idx : write_idx + filtered.shape[1]] = filtered
+    return data, [raw.ch_names[pick] for pick in picks]
+
+
+def compare_blockwise_preprocessing(
+    data,
+    sfreq,
+    line_freq=60.0,
+    block_duration=1.0,
+    method="iir",
+    phase="zero",
+    edge_duration=None,
+):
+    """Compare block-wise preprocessing against filtering in memory.
+
+    The in-memory reference is :func:`scipy.signal.sosfilt` started in the
+    steady state of the first sample (causal) or
+    :func:`scipy.signal.sosfiltfilt` (zero phase) of the whole array for
+    ``method="iir"``, and :func:`mne.filter.filter_data` followed by
+    :func:`mne.filter.notch_filter` for ``method="fir"``. MNE's causal
+    filters are minimum-phase, not the causal linear-phase kernel of
+    :class:`BlockwiseFilter`, so the causal FIR is compared against MNE's
+    zero-phase output delayed by the group delay of the kernel. The two only
+    differ in how the edges of the recording are padded, so samples within
+    ``edge_duration`` of either end are excluded.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_channels, n_times)
+        The unfiltered data.
+    sfreq : float
+        The sampling frequency.
+    line_freq : float | None
+        The power line frequency.
+    block_duration : float
+        The chunk duration of the block-wise path in seconds.
+    method, phase : str
+        See :class:`BlockwiseFilter`.
+    edge_duration : float | None
+        The duration excluded at both ends in seconds. Defaults to the
+        look-ahead of the zero-phase IIR cascade, the kernel length of
+        the FIR, and nothing for the causal IIR, which is exact.
+
+    Returns
+    -------
+    result : dict
+        The max absolute error in the interior, relative to the max
+        absolute amplitude of the reference, and the runtime of both paths.
+    """
+    import time
+
+    n_chs = data.shape[0]
+    start = time.perf_counter()
+    engine = BlockwiseFilter(
+        sfreq, n_chs, line_freq=line_freq, method=method, phase=phase
+    )
+    block_size = max(int(block_duration * sfreq), 1)
+    chunks = [
+        engine.process(data[:, idx : idx + block_size])
+        for idx in range(0, data.shape[1], block_size)
+    ]
+    blockwise = np.concatenate(chunks + [engine.flush()], axis=1)
+    runtime_blockwise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if method == "iir" and phase == "zero":
+        reference = signal.sosfiltfilt(engine.sos, data, axis=-1)
+        edge = engine.overlap
+    elif method == "iir":
+        zi = signal.sosfilt_zi(engine.sos)[:, np.newaxis, :] * data[:, 0, np.newaxis]
+        reference, _ = signal.sosfilt(engine.sos, data, axis=-1, zi=zi)
+        edge = 0
+    else:
+        h_freq = min(200.0, 0.95 * sfreq / 2.0)
+        reference = mne.filter.filter_data(
+            data, sfreq, 0.5, h_freq, phase="zero", verbose=False
+        )
+        freqs = np.arange(line_freq, h_freq, line_freq) if line_freq else []
+        if len(freqs):
+            reference = mne.filter.notch_filter(
+                reference, sfreq, freqs, phase="zero", verbose=False
+            )
+        if phase == "causal":
+            delay = (len(engine.h) - 1) // 2
+            reference = np.concatenate(
+                [np.zeros((n_chs, delay)), reference[:, : data.shape[1] - delay]],
+                axis=1,
+            )
+        edge = len(engine.h)
+    runtime_in_memory = time.perf_counter() - start
+
+    if edge_duration is not None:
+        edge = int(edge_duration * sfreq)
+    interior = slice(edge, data.shape[1] - edge)
+    if interior.start >= interior.stop:
+        raise ValueError("The data is too short to compare away from the edges.")
+    error = np.abs(blockwise[:, interior] - reference[:, interior]).max()
+    return {
+        "method": method,
+        "phase": phase,
+        "n_samples_compared": interior.stop - interior.start,
+        "max_rel_error": float(error / np.abs(reference[:, interior]).max()),
+        "runtime_blockwise": runtime_blockwise,
+        "runtime_in_memory": runtime_in_memory,
+    }
+
+
+def _polyphase_factors(sfreq, new_sfreq, max_denominator=1000):
+    """The up and down factors of a rational resampling ratio."""
+    ratio = Fraction(new_sfreq / sfreq).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+def design_polyphase_filter(up, down):
+    """Design the anti-aliasing filter of :func:`scipy.signal.resample_poly`.
+
+    Returns
+    -------
+    h : np.ndarray
+        The filter, padded the way ``resample_poly`` pads it.
+    n_pre_remove : int
+        The number of leading output samples of the filter delay.
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0)) * up
+    n_pre_pad = down - half_len % down
+    n_pre_remove = (half_len + n_pre_pad) // down
+    return np.concatenate([np.zeros(n_pre_pad), h]), n_pre_remove
+
+
+def resample_blockwise(raw, new_sfreq, block_size=8192, picks=None):
+    """Resample a recording by polyphase filtering in fixed-size blocks.
+
+    The rational factor ``up / down`` of the resampling is applied with
+    :func:`scipy.signal.upfirdn` to blocks of ``block_size`` output
+    samples, each read with the overlap the filter needs via
+    :meth:`mne.io.Raw.get_data`. The output equals
+    :func:`scipy.signal.resample_poly` over the whole recording, while
+    time and memory of the filtering are proportional to the picked
+    channels times the block size, and the recording does not have to be
+    preloaded.
+
+    Pick channels and drop bad channels before calling this, so they are
+    never read or filtered.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The recording, preloaded or not.
+    new_sfreq : float
+        The sampling frequency to resample to.
+    block_size : int
+        The number of output samples per block.
+    picks : array of int | None
+        The channels to resample. Defaults to all channels of ``raw``.
+
+    Returns
+    -------
+    raw : mne.io.RawArray
+        The resampled recording with the picked channels and the
+        annotations of ``raw``.
+    """
+    sfreq = raw.info["sfreq"]
+    up, down = _polyphase_factors(sfreq, new_sfreq)
+    if picks is None:
+        picks = np.arange(len(raw.ch_names))
+    h, n_pre_remove = design_polyphase_filter(up, down)
+
+    n_in = raw.n_times
+    n_out = n_in * up // down + bool(n_in * up % down)
+    data = np.empty((len(picks), n_out))
+    for out_start in range(0, n_out, block_size):
+        out_stop = min(out_start + block_size, n_out)
+        # the samples of the full upfirdn output this block takes
+        y_start, y_stop = out_start + n_pre_remove, out_stop + n_pre_remove
+        # the inputs contributing to them; the first one is a multiple of
+        # ``down``, so the block's output grid lines up with the full one
+        in_start = max(0, -(-(y_start * down - (len(h) - 1)) // up))
+        in_start -= in_start % down
+        in_stop = min(n_in, (y_stop - 1) * down // up + 1)
+        block = raw.get_data(picks=picks, start=in_start, stop=in_stop)
+        filtered = signal.upfirdn(h, block, up, down, axis=1)
+        offset = in_start * up // down
+        data[:, out_start:out_stop] = filtered[:, y_start - offset : y_stop - offset]
+
+    info = mne.pick_info(raw.info, picks)
+    # ``Info`` is locked from mne 1.0 on; older versions set keys directly
+    unlock = getattr(info, "_unlock", contextlib.nullcontext)
+    with unlock():
+        info["sfreq"] = sfreq * up / down
+        info["lowpass"] = min(info["lowpass"], info["sfreq"] / 2.0)
+    resampled = mne.io.RawArray(
+        data,
+        info,
+        first_samp=int(round(raw.first_samp * up / down)),
+        verbose=False,
+    )
+    resampled.set_annotations(raw.annotations)
+    return resampled
@@ -1,37 +1,190 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import mne
 import numpy as np
 from eztrack import preprocess_ieeg
 from mne_bids import read_raw_bids
 
+from spes.preprocess import resample_blockwise
+from spes.viz import plot_raw_envelope
+
 
-def load_data(bids_path, resample_sfreq, deriv_root, plot_raw=False, verbose=None):
+def load_data(
+    bids_path,
+    resample_sfreq,
+    deriv_root,
+    plot_raw=False,
+    fig_extension=".png",
+    verbose=None,
+    tmin=None,
+    tmax=None,
+    pad=0.0,
+    exclude_bads=True,
+):
     # load in the data
     raw = read_raw_bids(bids_path)
 
-    if resample_sfreq:
-        # perform resampling
-        raw = raw.resample(resample_sfreq, n_jobs=-1)
+    # only decode the requested span, padded so the filters settle
+    crop = tmin is not None or tmax is not None
+    if crop:
+        tmin = 0.0 if tmin is None else tmin
+        tmax = raw.times[-1] if tmax is None else tmax
+        tmin_pad = max(tmin - pad, 0.0)
+        tmax_pad = min(tmax + pad, raw.times[-1])
+        raw.crop(tmin_pad, tmax_pad)
 
-    raw = raw.pick_types(seeg=True, ecog=True, eeg=True, misc=False, exclude=[])
-    raw.load_data()
+    # select channels before any data is read, so misc, EKG, DC and bad
+    # channels are never decoded or resampled. The raw figure shows the bad
+    # channels too, so they are only dropped after it is plotted
+    raw = raw.pick_types(
+        seeg=True,
+        ecog=True,
+        eeg=True,
+        misc=False,
+        exclude="bads" if exclude_bads and not plot_raw else [],
+    )
+    if resample_sfreq and resample_sfreq != raw.info["sfreq"]:
+        # polyphase resampling in blocks, reading the recording once
+        raw = resample_blockwise(raw, resample_sfreq)
+    else:
+        raw.load_data()
 
     # pre-process the data using preprocess pipeline
     print("Power Line frequency is : ", raw.info["line_freq"])
     l_freq = 0.5
     h_freq = 200
     raw = preprocess_ieeg(raw, l_freq=l_freq, h_freq=h_freq, verbose=verbose)
+    if crop:
+        raw.crop(tmin - tmin_pad, min(tmax - tmin_pad, raw.times[-1]))
 
     if plot_raw is True:
-        # plot raw data
+        # plot a decimated envelope of the raw data in the background
         deriv_root.mkdir(exist_ok=True, parents=True)
-        fig_basename = bids_path.copy().update(extension=".svg", check=False).basename
-        scale = 200e-6
-        fig = raw.plot(
-            decim=40,
-            duration=20,
-            scalings={"ecog": scale, "seeg": scale},
-            n_channels=len(raw.ch_names),
-            clipping=None,
+        fig_basename = (
+            bids_path.copy().update(extension=fig_extension, check=False).basename
         )
-        fig.savefig(deriv_root / fig_basename)
+        scale = 200e-6
+        plot_raw_envelope(raw, deriv_root / fig_basename, scale=scale)
+        if exclude_bads:
+            raw = raw.pick_types(
+                seeg=True, ecog=True, eeg=True, misc=False, exclude="bads"
+            )
     return raw
+
+
+def estimate_loaded_nbytes(bids_path, resample_sfreq=None):
+    """Estimate the memory of a recording loaded with :func:`load_data`.
+
+    Only the header is read, so this is cheap compared to loading.
+
+    Parameters
+    ----------
+    bids_path : mne_bids.BIDSPath
+        The recording.
+    resample_sfreq : float | None
+        The sampling frequency it will be resampled to.
+
+    Returns
+    -------
+    nbytes : int
+        The size of the float64 data buffer of the picked channels.
+    """
+    raw = read_raw_bids(bids_path, verbose=False)
+    picks = mne.pick_types(
+        raw.info, seeg=True, ecog=True, eeg=True, misc=False, exclude="bads"
+    )
+    n_times = raw.n_times
+    if resample_sfreq:
+        n_times = int(np.ceil(n_times * resample_sfreq / raw.info["sfreq"]))
+    return len(picks) * n_times * np.dtype(np.float64).itemsize
+
+
+def prefetch_data(
+    bids_paths,
+    load_fn=None,
+    depth=2,
+    max_bytes=None,
+    n_workers=None,
+    resample_sfreq=None,
+):
+    """Load recordings ahead of their use in background threads.
+
+    While the caller analyzes one recording, up to ``depth`` of the next
+    recordings are read and preprocessed in a thread pool. Recordings are
+    yielded in the order of ``bids_paths``.
+
+    Parameters
+    ----------
+    bids_paths : list of mne_bids.BIDSPath
+        The recordings to load.
+    load_fn : callable | None
+        Function of a ``BIDSPath`` returning the loaded recording.
+        Defaults to :func:`load_data` resampling to ``resample_sfreq``,
+        without plotting.
+    depth : int
+        The number of recordings loaded ahead of the current one.
+    max_bytes : int | None
+        The memory cap of the current and prefetched recordings, estimated
+        with :func:`estimate_loaded_nbytes`. Prefetching pauses until the
+        next recording fits. A recording is always loaded if nothing else
+        is in memory, even if it exceeds the cap.
+    n_workers : int | None
+        The number of loader threads. Defaults to ``depth``.
+    resample_sfreq : float | None
+        The sampling frequency ``load_fn`` resamples to, used to estimate
+        the memory of the recordings against ``max_bytes``.
+
+    Yields
+    ------
+    bids_path : mne_bids.BIDSPath
+        The recording.
+    raw : mne.io.Raw
+        The loaded recording. Exceptions raised while loading are raised
+        when the recording is reached.
+    """
+    if load_fn is None:
+        load_fn = partial(load_data, resample_sfreq=resample_sfreq, deriv_root=None)
+    if depth < 1:
+        raise ValueError(f"depth must be at least 1, not {depth}.")
+
+    bids_paths = deque(bids_paths)
+    pending = deque()
+    next_nbytes = None
+    executor = ThreadPoolExecutor(max_workers=n_workers or depth)
+
+    def _fill(current_nbytes):
+        nonlocal next_nbytes
+        while bids_paths and len(pending) < depth:
+            if max_bytes is not None:
+                if next_nbytes is None:
+                    next_nbytes = estimate_loaded_nbytes(
+                        bids_paths[0], resample_sfreq=resample_sfreq
+                    )
+                in_memory = current_nbytes + sum(nbytes for _, nbytes, _ in pending)
+                if in_memory > 0 and in_memory + next_nbytes > max_bytes:
+                    return
+            bids_path = bids_paths.popleft()
+            pending.append(
+                (bids_path, next_nbytes or 0, executor.submit(load_fn, bids_path))
+            )
+            next_nbytes = None
+
+    try:
+        while True:
+            if not pending:
+                _fill(0)
+            if not pending:
+                break
+            bids_path, nbytes, future = pending.popleft()
+            # keep loading the next recordings while waiting for this one
+            _fill(nbytes)
+            raw = future.result()
+            yield bids_path, raw
+            del raw
+    finally:
+        # ``shutdown(cancel_futures=True)`` needs Python 3.9
+        for _, _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
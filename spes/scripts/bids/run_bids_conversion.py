@@ -15,7 +15,6 @@ from mne import Annotations, events_from_annotations
 from mne_bids import (
     BIDSPath,
     make_dataset_description,
-    update_sidecar_json,
     read_raw_bids, write_raw_bids
 )
 from mne_bids.path import get_entities_from_fname, get_entity_vals
@@ -26,6 +25,8 @@ import hdf5storage
 from pymatreader import read_mat
 from BCI2kReader import BCI2kReader as b2k
 
+from spes.bids.sidecars import SidecarTransaction
+
 class MatReader:
     """
     Object to read mat files into a nested dictionary if need be.
@@ -136,39 +137,28 @@ def _convert_stimulation_file(fname, params_file, clinical_file, bids_path):
     return raw, ch_clin_labels, annotations
 
 
-def _write_stimulation_metadata(bids_path, stim_type, stim_site, stim_current):
-    event_df = pd.read_csv(bids_path, sep='\t')
-
-    event_df['electrical_stimulation_type'] = stim_type
-    event_df['electrical_stimulation_site'] = stim_site
-    event_df['electrical_stimulation_current'] = stim_current
-    event_df.to_csv(bids_path, sep='\t')
-
-    # write an events.json
-    json_fpath = bids_path.update(extension='.json')
-    if json_fpath.fpath.exists():
-        with open(json_fpath, 'r') as fin:
-            event_json = json.load(fin)
-    else:
-        event_json = dict()
-
-    event_json['electrical_stimulation_type'] = {
-        'Description': 'The type of stimulation.',
-        'Levels': {
-            'biphasic': 'Biphasic stimulation',
-            'complex': 'Complex stimulation',
-        }
-    }
-
-    event_json['electrical_stimulation_site'] = {
-        'Description': 'Where stimulation took place in terms of electrode site.'
-    }
-
-    event_json['electrical_stimulation_current'] = {
-        'Description': 'The amplitude of the stimulation current in Amps.',
-        'Units': 'Milli-Amperes'
-    }
-    _write_json(json_fpath, event_json, overwrite=True)
+def _write_stimulation_metadata(sidecars, stim_type, stim_site, stim_current):
+    sidecars.set_tsv_column('events', 'electrical_stimulation_type', stim_type)
+    sidecars.set_tsv_column('events', 'electrical_stimulation_site', stim_site)
+    sidecars.set_tsv_column('events', 'electrical_stimulation_current', stim_current)
+
+    # describe the columns in the events.json
+    sidecars.update_json('events', {
+        'electrical_stimulation_type': {
+            'Description': 'The type of stimulation.',
+            'Levels': {
+                'biphasic': 'Biphasic stimulation',
+                'complex': 'Complex stimulation',
+            }
+        },
+        'electrical_stimulation_site': {
+            'Description': 'Where stimulation took place in terms of electrode site.'
+        },
+        'electrical_stimulation_current': {
+            'Description': 'The amplitude of the stimulation current in Amps.',
+            'Units': 'Milli-Amperes'
+        },
+    })
 
 
 def _update_sidecar_tsv_byname(
@@ -301,7 +291,7 @@ def _write_clinical_chs(bids_path, col_name, col_value, col_units):
     ch_df = pd.read_csv(bids_path, sep='\t')
 
     ch_df[col_name] = col_value
-    ch_df.to_csv(bids_path, sep='\t')
+    ch_df.to_csv(bids_path, sep='\t', index=False)
 
 def _extract_stim_ch(fname, subject):
     fname_parts = fname.name.split('_')
@@ -310,9 +300,18 @@ def _extract_stim_ch(fname, subject):
     stim_amt = fname_parts[3]
     return stim_chs, int(stim_amt)
 
-def convert_jhh():
-    root = Path('/Users/adam2392/Downloads/epilepsy_spes')
-    source_dir = root / 'sourcedata'
+def convert_jhh(root=None, source_dir=None):
+    """Convert the JHH SPES recordings in ``<source_dir>/<subject>`` to BIDS.
+
+    ``root`` defaults to the local dataset and ``source_dir`` to
+    ``<root>/sourcedata``.
+    """
+    if root is None:
+        root = Path('/Users/adam2392/Downloads/epilepsy_spes')
+    root = Path(root)
+    if source_dir is None:
+        source_dir = root / 'sourcedata'
+    source_dir = Path(source_dir)
 
     datatype = 'ieeg'
     suffix = 'ieeg'
@@ -375,34 +374,27 @@ def convert_jhh():
                     format='EDF', allow_preload=True, 
                     anonymize=dict(keep_source=True), overwrite=True)
                 
-                # augment the events.tsv 
-                events_bids_path = bids_path.copy().update(extension='.tsv', suffix='events')
-                if events_bids_path.fpath.exists():
-                    _write_stimulation_metadata(events_bids_path, stim_type, stim_chs, stim_amt)
-
-                # augment the channels tsv
-                ch_bids_path = bids_path.copy().update(extension='.tsv', suffix='channels')
-                ch_json_path = ch_bids_path.copy().update(extension='.json')
-                
-                ch_json = {
-                    'clinical_grouping': {
-                        'Description': 'Clinical annotations of epileptogenicity per channel',
-                        'Levels': {
-                            0: 'non-epileptogenic',
-                            1: 'seizure onset zone (SOZ)',
-                            2: 'early spread',
-                            3: 'irritative zone',
+                # all sidecar edits of the recording are written at once; a
+                # failure while staging them leaves every sidecar unchanged,
+                # but the final moves are only atomic per file
+                with SidecarTransaction(bids_path) as sidecars:
+                    # augment the events.tsv
+                    if sidecars.exists('events'):
+                        _write_stimulation_metadata(sidecars, stim_type, stim_chs, stim_amt)
+
+                    # augment the channels tsv
+                    sidecars.update_json('channels', {
+                        'clinical_grouping': {
+                            'Description': 'Clinical annotations of epileptogenicity per channel',
+                            'Levels': {
+                                0: 'non-epileptogenic',
+                                1: 'seizure onset zone (SOZ)',
+                                2: 'early spread',
+                                3: 'irritative zone',
+                            }
                         }
-                    }
-                }
-                if not ch_json_path.fpath.exists():
-                    _write_json(ch_json_path, dict())
-                update_sidecar_json(ch_json_path, ch_json)
-                col_name = 'clinical_grouping'
-                
-                ch_df = pd.read_csv(ch_bids_path, sep='\t')
-                ch_df[col_name] = ch_clin_labels
-                ch_df.to_csv(ch_bids_path, sep='\t')
+                    })
+                    sidecars.set_tsv_column('channels', 'clinical_grouping', ch_clin_labels)
 
         break
 
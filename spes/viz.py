@@ -0,0 +1,360 @@
+"""Static figure rendering that stays off the analysis critical path."""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from spes.fragility.utils import normalize_fragility
+
+# a single background worker renders figures in submission order, so
+# matplotlib never draws two figures concurrently
+_FIGURE_EXECUTOR = None
+_PENDING_FIGURES = []
+
+
+def _get_figure_executor():
+    global _FIGURE_EXECUTOR
+    if _FIGURE_EXECUTOR is None:
+        _FIGURE_EXECUTOR = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="spes-figures"
+        )
+    return _FIGURE_EXECUTOR
+
+
+def _column_edges(n_times, n_columns):
+    """Sample indices splitting ``n_times`` into contiguous pixel columns."""
+    n_columns = max(1, min(n_columns, n_times))
+    return np.linspace(0, n_times, n_columns + 1).astype(np.int64)
+
+
+def _envelope_decimate(raw, n_columns, start=0, stop=None, chunk_columns=256):
+    """Compute the min/max envelope of each channel per pixel column.
+
+    The data is read ``chunk_columns`` pixel columns at a time, so memory
+    stays proportional to the number of channels times the chunk length,
+    not the recording length.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The raw data.
+    n_columns : int
+        The number of pixel columns in the output image.
+    start : int
+        The first sample to render.
+    stop : int | None
+        The last sample (exclusive) to render. Defaults to the end.
+    chunk_columns : int
+        The number of pixel columns to read per block.
+
+    Returns
+    -------
+    mins : np.ndarray, shape (n_channels, n_columns)
+    maxs : np.ndarray, shape (n_channels, n_columns)
+    times : np.ndarray, shape (n_columns,)
+        The center time of each pixel column in seconds.
+    """
+    if stop is None:
+        stop = raw.n_times
+    edges = _column_edges(stop - start, n_columns) + start
+    n_columns = len(edges) - 1
+
+    n_chs = len(raw.ch_names)
+    mins = np.empty((n_chs, n_columns))
+    maxs = np.empty((n_chs, n_columns))
+    for col_start in range(0, n_columns, chunk_columns):
+        col_stop = min(col_start + chunk_columns, n_columns)
+        block = raw.get_data(start=edges[col_start], stop=edges[col_stop])
+        block_edges = edges[col_start:col_stop] - edges[col_start]
+        mins[:, col_start:col_stop] = np.minimum.reduceat(block, block_edges, axis=1)
+        maxs[:, col_start:col_stop] = np.maximum.reduceat(block, block_edges, axis=1)
+
+    times = (edges[:-1] + edges[1:]) / 2.0 / raw.info["sfreq"]
+    return mins, maxs, times
+
+
+def render_raw_figure(
+    mins,
+    maxs,
+    times,
+    ch_names,
+    fig_fpath,
+    scale=200e-6,
+    title=None,
+    dpi=100,
+    bads=(),
+):
+    """Render a min/max envelope of raw traces to a static image.
+
+    All channels are drawn as a single line collection on an Agg canvas,
+    which is safe to call from a background thread.
+
+    Parameters
+    ----------
+    mins : np.ndarray, shape (n_channels, n_columns)
+        Per-column minimum of each channel.
+    maxs : np.ndarray, shape (n_channels, n_columns)
+        Per-column maximum of each channel.
+    times : np.ndarray, shape (n_columns,)
+        Time of each column in seconds.
+    ch_names : list of str
+        The channel names, drawn top to bottom.
+    fig_fpath : str | Path
+        Where to save the figure. The format is inferred from the extension.
+    scale : float
+        The amplitude that spans half of the spacing between channels.
+    title : str | None
+        The figure title.
+    dpi : int
+        Resolution of the saved figure.
+    bads : list of str
+        The bad channels, drawn in gray as in :meth:`mne.io.Raw.plot`.
+
+    Returns
+    -------
+    fig_fpath : Path
+        The path of the saved figure.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    n_chs, n_columns = mins.shape
+
+    # zig-zag between the min and max of each column, so the envelope
+    # of every pixel column is drawn by a single polyline per channel
+    xs = np.repeat(times, 2)
+    envelope = np.empty((n_chs, 2 * n_columns))
+    envelope[:, 0::2] = mins
+    envelope[:, 1::2] = maxs
+    offsets = np.arange(n_chs)[:, np.newaxis]
+    ys = offsets - envelope / (2 * scale)
+
+    segments = np.empty((n_chs, 2 * n_columns, 2))
+    segments[..., 0] = xs
+    segments[..., 1] = ys
+
+    width = n_columns / dpi
+    height = max(4.0, 0.12 * n_chs)
+    fig = Figure(figsize=(width, height), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    colors = ["lightgray" if ch_name in bads else "k" for ch_name in ch_names]
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=0.5))
+    ax.set_xlim(times[0], times[-1])
+    ax.set_ylim(n_chs, -1)
+    ax.set_yticks(np.arange(n_chs))
+    ax.set_yticklabels(ch_names, fontsize=max(2, min(8, 600 // max(n_chs, 1))))
+    ax.set_xlabel("Time (s)")
+    if title is not None:
+        ax.set_title(title)
+
+    fig_fpath = Path(fig_fpath)
+    fig.savefig(fig_fpath, dpi=dpi, bbox_inches="tight")
+    return fig_fpath
+
+
+def plot_raw_envelope(
+    raw,
+    fig_fpath,
+    scale=200e-6,
+    width=2000,
+    tmin=None,
+    tmax=None,
+    dpi=100,
+    block=False,
+):
+    """Plot a decimated quality-control figure of raw traces.
+
+    The min/max envelope is computed in the calling thread, which is a
+    single vectorized pass over the data. Drawing and encoding the image
+    is handed to a background worker unless ``block=True``.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The raw data to plot.
+    fig_fpath : str | Path
+        Where to save the figure. Use a ``.png`` extension for a raster
+        image; vector formats work but lose the benefit of decimation.
+    scale : float
+        The amplitude that spans half of the spacing between channels.
+    width : int
+        The width of the rendered data area in pixels.
+    tmin : float | None
+        Start time in seconds. Defaults to the start of the recording.
+    tmax : float | None
+        End time in seconds. Defaults to the end of the recording.
+    dpi : int
+        Resolution of the saved figure.
+    block : bool
+        Whether to render in the calling thread.
+
+    Returns
+    -------
+    result : Path | concurrent.futures.Future
+        The saved figure path if ``block=True``, otherwise a future that
+        resolves to it.
+    """
+    sfreq = raw.info["sfreq"]
+    start = 0 if tmin is None else int(round(tmin * sfreq))
+    stop = raw.n_times if tmax is None else min(int(round(tmax * sfreq)), raw.n_times)
+    mins, maxs, times = _envelope_decimate(raw, width, start=start, stop=stop)
+
+    render_kws = dict(
+        ch_names=list(raw.ch_names),
+        fig_fpath=fig_fpath,
+        scale=scale,
+        title=Path(fig_fpath).stem,
+        dpi=dpi,
+        bads=list(raw.info["bads"]),
+    )
+    if block:
+        return render_raw_figure(mins, maxs, times, **render_kws)
+
+    future = _get_figure_executor().submit(
+        render_raw_figure, mins, maxs, times, **render_kws
+    )
+    _PENDING_FIGURES.append(future)
+    return future
+
+
+def wait_for_figures():
+    """Block until all figures submitted in the background are written.
+
+    Returns
+    -------
+    fig_fpaths : list of Path
+        The paths of the figures that were rendered.
+    """
+    fig_fpaths = []
+    while _PENDING_FIGURES:
+        future = _PENDING_FIGURES.pop(0)
+        fig_fpaths.append(future.result())
+    return fig_fpaths
+
+
+def _downsample_fragility(pert_mat, n_columns, chunk_columns=256):
+    """Normalize and average fragility windows into pixel columns.
+
+    ``pert_mat`` may be a memory-mapped array; only ``chunk_columns``
+    output columns worth of windows are read into memory at a time.
+    """
+    n_chs, n_windows = pert_mat.shape
+    edges = _column_edges(n_windows, n_columns)
+    n_columns = len(edges) - 1
+
+    image = np.empty((n_chs, n_columns))
+    for col_start in range(0, n_columns, chunk_columns):
+        col_stop = min(col_start + chunk_columns, n_columns)
+        block = np.asarray(
+            pert_mat[:, edges[col_start] : edges[col_stop]], dtype=np.float64
+        )
+        block = normalize_fragility(block)
+        block_edges = edges[col_start:col_stop] - edges[col_start]
+        counts = np.diff(edges[col_start : col_stop + 1])
+        image[:, col_start:col_stop] = (
+            np.add.reduceat(block, block_edges, axis=1) / counts
+        )
+    return image, edges
+
+
+def plot_fragility_heatmap(
+    deriv_fpath,
+    figure_fpath,
+    soz_chs=None,
+    vertical_markers=None,
+    title=None,
+    cmap="turbo",
+    cbarlabel="Fragility",
+    width=1600,
+    dpi=150,
+):
+    """Plot a fragility heatmap from a saved perturbation matrix.
+
+    The perturbation matrix is memory-mapped and only read in blocks of
+    windows, which are normalized and averaged down to ``width`` pixel
+    columns. The image layer is rasterized, while the axes, labels and
+    markers stay as vector graphics, so PDF output stays small regardless
+    of the recording length.
+
+    This function only takes paths and plain Python objects, so it can be
+    submitted to a thread or process pool once the derivative is saved.
+
+    Parameters
+    ----------
+    deriv_fpath : str | Path
+        The path to the saved perturbation matrix ``.npy`` file. The
+        parameter sidecar written by
+        :func:`spes.fragility.io.write_fragility_sidecar` must exist.
+    figure_fpath : str | Path
+        Where to save the figure.
+    soz_chs : list of str | None
+        Channels to highlight on the y-axis.
+    vertical_markers : dict | None
+        Mapping of window index to a text label drawn as a vertical line.
+    title : str | None
+        The figure title.
+    cmap : str
+        The colormap of the heatmap.
+    cbarlabel : str
+        The colorbar label.
+    width : int
+        The maximum number of pixel columns of the heatmap image.
+    dpi : int
+        Resolution of the rasterized image layer.
+
+    Returns
+    -------
+    figure_fpath : Path
+        The path of the saved figure.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from spes.fragility.io import read_fragility_sidecar
+
+    params = read_fragility_sidecar(deriv_fpath)
+    ch_names = params["ch_names"]
+    pert_mat = np.load(deriv_fpath, mmap_mode="r")
+    image, edges = _downsample_fragility(pert_mat, width)
+    n_chs, n_windows = pert_mat.shape
+
+    if soz_chs is None:
+        soz_chs = []
+    if vertical_markers is None:
+        vertical_markers = dict()
+
+    fig = Figure(figsize=(min(16, 4 + image.shape[1] / dpi), max(6, 0.1 * n_chs)))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    im = ax.imshow(
+        image,
+        aspect="auto",
+        cmap=cmap,
+        interpolation="nearest",
+        extent=(0, n_windows, n_chs - 0.5, -0.5),
+        vmin=0,
+        vmax=1,
+        rasterized=True,
+    )
+    ax.set_yticks(np.arange(n_chs))
+    ax.set_yticklabels(ch_names, fontsize=max(2, min(8, 600 // max(n_chs, 1))))
+    for ticklabel in ax.get_yticklabels():
+        if ticklabel.get_text() in soz_chs:
+            ticklabel.set_color("red")
+
+    for window_idx, label in vertical_markers.items():
+        ax.axvline(window_idx, color="k", linestyle="--", linewidth=1)
+        ax.text(window_idx, -1, label, rotation=90, va="bottom", fontsize=8)
+
+    ax.set_xlabel("Window")
+    if title is not None:
+        ax.set_title(title)
+    cbar = fig.colorbar(im, ax=ax)
+    cbar.set_label(cbarlabel)
+
+    figure_fpath = Path(figure_fpath)
+    fig.savefig(figure_fpath, dpi=dpi, bbox_inches="tight")
+    return figure_fpath
@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+import pytest
+from mne_bids.tsv_handler import _from_tsv
+
+from spes.bids.atlas import CentroidAtlas, VolumeAtlas, label_electrodes
+
+
+def _write_electrodes(bids_root, subject, rows, columns=(), units="mm"):
+    ieeg_dir = bids_root / f"sub-{subject}" / "ieeg"
+    ieeg_dir.mkdir(parents=True)
+    lines = ["\t".join(("name", "x", "y", "z") + tuple(columns))]
+    lines += ["\t".join(row) for row in rows]
+    fpath = ieeg_dir / f"sub-{subject}_electrodes.tsv"
+    fpath.write_text("\n".join(lines) + "\n")
+    with open(ieeg_dir / f"sub-{subject}_coordsystem.json", "w") as fout:
+        json.dump({"iEEGCoordinateUnits": units}, fout)
+    return fpath
+
+
+def test_centroid_atlas():
+    """Test that contacts without coordinates or too far are not labeled."""
+    atlas = CentroidAtlas(
+        ["left", "right"], np.array([[-10.0, 0, 0], [10.0, 0, 0]]), max_distance=5.0
+    )
+    coords = np.array(
+        [[-9.0, 0, 0], [np.nan, 0, 0], [11.0, 1.0, 0], [0.0, 0, 0], [10.0, 10, 0]]
+    )
+    names = atlas.lookup(coords)
+    assert names.tolist() == ["left", "n/a", "right", "n/a", "n/a"]
+    # without a maximum distance, every contact with coordinates is labeled
+    atlas.max_distance = None
+    assert atlas.lookup(coords)[[0, 2, 4]].tolist() == ["left", "right", "right"]
+
+
+def test_volume_atlas(tmp_path):
+    """Test that voxels are looked up through the affine of the volume."""
+    nib = pytest.importorskip("nibabel")
+    data = np.zeros((4, 4, 4), dtype=np.int16)
+    data[1, 2, 3] = 7
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -4.0
+    fpath = tmp_path / "atlas.nii"
+    nib.save(nib.Nifti1Image(data, affine), str(fpath))
+
+    atlas = VolumeAtlas(fpath, {0: "unknown", 7: "hippocampus"})
+    coords = np.array([[-2.0, 0.0, 2.0], [-4.0, -4.0, -4.0], [20.0, 0, 0]])
+    assert atlas.lookup(coords).tolist() == ["hippocampus", "unknown", "n/a"]
+
+
+def test_label_electrodes(tmp_path):
+    """Test that only missing atlas columns are added, in millimeters."""
+    atlas = CentroidAtlas(["left", "right"], np.array([[-10.0, 0, 0], [10.0, 0, 0]]))
+    labeled_fpath = _write_electrodes(
+        tmp_path,
+        "01",
+        [("A1", "-9", "0", "0", "manual")],
+        columns=("dk",),
+    )
+    # coordinates in meters are scaled to the millimeters of the atlas
+    unlabeled_fpath = _write_electrodes(
+        tmp_path,
+        "02",
+        [("A1", "0.009", "0", "0"), ("A2", "n/a", "n/a", "n/a")],
+        units="m",
+    )
+
+    fpaths = label_electrodes(tmp_path, {"dk": atlas, "destrieux": atlas})
+    assert fpaths == [labeled_fpath, unlabeled_fpath]
+    labeled = _from_tsv(labeled_fpath)
+    assert labeled["dk"] == ["manual"]
+    assert labeled["destrieux"] == ["left"]
+    unlabeled = _from_tsv(unlabeled_fpath)
+    assert unlabeled["dk"] == unlabeled["destrieux"] == ["right", "n/a"]
+
+    # every column exists, so nothing is written unless overwriting
+    assert label_electrodes(tmp_path, {"dk": atlas}) == []
+    assert label_electrodes(tmp_path, {"dk": atlas}, overwrite=True) == fpaths
+    assert _from_tsv(labeled_fpath)["dk"] == ["left"]
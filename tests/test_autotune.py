@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pytest
+
+from spes.autotune import _cache_key, autotune, plan_workers
+
+RESOURCES = {
+    "host": "node",
+    "n_cpus": 8,
+    "available_memory": 16e9,
+    "blas_libraries": ["openblas"],
+    "blas_threads": 8,
+}
+
+# windows per second of each split of the cores and batch size
+ENTRY = {
+    "splits": {"8x1": 100.0, "4x2": 150.0, "2x4": 120.0, "1x8": 90.0},
+    "batch_sizes": {"4": 10.0, "8": 30.0, "16": 20.0, "32": 5.0},
+    "peak_bytes_per_window": 1e6,
+}
+
+
+@pytest.fixture
+def cache_fpath(tmp_path):
+    cache_fpath = tmp_path / "autotune.json"
+    key = _cache_key(RESOURCES, 8, 64, 250, np.float64)
+    cache_fpath.write_text(json.dumps({key: ENTRY}))
+    return cache_fpath
+
+
+@pytest.mark.parametrize(
+    "available_memory, n_windows, expected",
+    [
+        # the fastest split and batch size
+        (16e9, None, (4, 8)),
+        # no more workers than batches of windows
+        (16e9, 12, (2, 8)),
+        # the fastest batch size that fits in half the memory
+        (32e6, None, (4, 4)),
+        # not even the smallest batches fit, so fewer workers are used
+        (16e6, None, (2, 4)),
+    ],
+)
+def test_autotune(cache_fpath, available_memory, n_windows, expected):
+    """Test the choice of workers and batch size from cached benchmarks."""
+    resources = {**RESOURCES, "available_memory": available_memory}
+    tuning = autotune(
+        60, n_windows=n_windows, cache_fpath=cache_fpath, resources=resources
+    )
+    assert (tuning["n_jobs"], tuning["batch_size"]) == expected
+    assert tuning["blas_threads"] == 2
+
+
+def test_cache_key():
+    """Test that the benchmarks of other BLAS libraries are not reused."""
+    key = _cache_key(RESOURCES, 8, 64, 250, np.float64)
+    assert np.__version__ in key
+    mkl = {**RESOURCES, "blas_libraries": ["mkl"]}
+    assert _cache_key(mkl, 8, 64, 250, np.float64) != key
+    assert _cache_key(RESOURCES, 8, 64, 250, np.float32) != key
+
+
+@pytest.mark.parametrize(
+    "n_cpus, background, n_concurrent, expected",
+    [
+        (16, True, 1, dict(fit_n_jobs=12, prefetch_workers=2, heatmap_workers=2)),
+        (16, True, 3, dict(fit_n_jobs=4, prefetch_workers=2, heatmap_workers=2)),
+        (16, False, 1, dict(fit_n_jobs=16, prefetch_workers=0, heatmap_workers=0)),
+        (2, True, 1, dict(fit_n_jobs=1, prefetch_workers=1, heatmap_workers=1)),
+    ],
+)
+def test_plan_workers(n_cpus, background, n_concurrent, expected):
+    """Test the split of the cores between the stages of a cohort run."""
+    plan = plan_workers(
+        background=background,
+        n_concurrent=n_concurrent,
+        resources={**RESOURCES, "n_cpus": n_cpus},
+    )
+    assert {key: plan[key] for key in expected} == expected
+    assert plan["summary_n_jobs"] == n_cpus
@@ -0,0 +1,89 @@
+import numpy as np
+from mne_bids import BIDSPath
+from mne_bids.tsv_handler import _from_tsv
+
+from spes.bids.bads import (
+    ChannelStatistics,
+    _neighbor_pairs,
+    label_bad_channels,
+    write_bad_channels,
+)
+from spes.bids.utils import BadChannelDescription
+
+SFREQ = 1000.0
+
+
+def _simulate_electrode(n_chs=10, n_times=20000, seed=0):
+    """Contacts that share a slow signal, with their own noise."""
+    rng = np.random.default_rng(seed)
+    shared = np.cumsum(rng.standard_normal(n_times)) * 1e-6
+    return shared + 2e-6 * rng.standard_normal((n_chs, n_times))
+
+
+def _compute_stats(data, ch_names, line_freq=60.0):
+    accumulator = ChannelStatistics(ch_names, SFREQ, line_freq=line_freq)
+    # in blocks, as read from disk
+    for start in range(0, data.shape[1], 5000):
+        accumulator.update(data[:, start : start + 5000])
+    return accumulator.compute()
+
+
+def test_neighbor_pairs():
+    """Test that contacts are paired by their number, per electrode."""
+    pairs = _neighbor_pairs(["A2", "B1", "A1", "A10", "B2", "A3"])
+    assert sorted(map(tuple, pairs)) == [(0, 5), (1, 4), (2, 0), (5, 3)]
+
+
+def test_label_bad_channels():
+    """Test that flat and line noise channels are labeled bad."""
+    ch_names = [f"A{idx}" for idx in range(1, 11)]
+    data = _simulate_electrode(len(ch_names))
+    data[3] = 0
+    times = np.arange(data.shape[1]) / SFREQ
+    data[7] += 1e-4 * np.sin(2 * np.pi * 60 * times)
+
+    stats = label_bad_channels(_compute_stats(data, ch_names))
+    bads = stats.dropna(subset=["description"])
+    assert dict(zip(bads["name"], bads["description"])) == {
+        "A4": BadChannelDescription.FLAT.value,
+        "A8": BadChannelDescription.DISCONNECTED.value,
+    }
+
+
+def test_label_without_line_freq():
+    """Test that channels are labeled without a line frequency."""
+    ch_names = [f"A{idx}" for idx in range(1, 11)]
+    data = _simulate_electrode(len(ch_names))
+    stats = label_bad_channels(_compute_stats(data, ch_names, line_freq=None))
+    assert stats["line_ratio"].isna().all()
+    assert stats["description"].isna().all()
+
+
+def test_write_bad_channels(tmp_path):
+    """Test that only new bad channels are written to channels.tsv."""
+    bids_path = BIDSPath(
+        subject="01",
+        task="rest",
+        datatype="ieeg",
+        suffix="ieeg",
+        extension=".vhdr",
+        root=tmp_path,
+    )
+    channels_fpath = bids_path.copy().update(suffix="channels", extension=".tsv")
+    channels_fpath.mkdir()
+    channels_fpath.fpath.write_text(
+        "name\ttype\tstatus\tstatus_description\n"
+        "A1\tSEEG\tgood\tn/a\n"
+        "A2\tSEEG\tbad\tclinician\n"
+        "A3\tSEEG\tgood\tn/a\n"
+    )
+    flat = BadChannelDescription.FLAT.value
+    stats = label_bad_channels(_compute_stats(np.ones((3, 2000)), ["A1", "A2", "A3"]))
+    stats["description"] = [None, flat, flat]
+
+    assert write_bad_channels(bids_path, stats) == ["A3"]
+    channels_tsv = _from_tsv(channels_fpath.fpath)
+    assert channels_tsv["status"] == ["good", "bad", "bad"]
+    assert channels_tsv["status_description"] == ["n/a", "clinician", flat]
+    # no new bad channels, so nothing is written
+    assert write_bad_channels(bids_path, stats) == []
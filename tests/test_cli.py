@@ -0,0 +1,36 @@
+from spes.benchmarks import HEAVY_MODULES, MAX_STARTUP_SECONDS, _import_time
+from spes.cli import _build_parser
+
+
+def test_cli_startup():
+    """Test that the command line interface starts without heavy imports."""
+    # the fastest of a few fresh interpreters, to not measure a cold cache
+    import_time, imported = min(_import_time("spes.cli") for _ in range(3))
+    for module in ("mne", "eztrack", "matplotlib"):
+        assert module in HEAVY_MODULES
+    assert not imported.intersection(HEAVY_MODULES)
+    assert import_time < MAX_STARTUP_SECONDS
+
+
+def test_fragility_options():
+    """Test that the options of the fragility analysis reach its settings."""
+    options = vars(
+        _build_parser().parse_args(
+            [
+                "fragility",
+                "--dtype",
+                "float32",
+                "--output-profile",
+                "minimal",
+                "--state-structure",
+                "block",
+                "--n-jobs",
+                "auto",
+            ]
+        )
+    )
+    assert options["dtype"] == "float32"
+    assert options["output_profile"] == "minimal"
+    assert options["state_structure"] == "block"
+    assert options["n_jobs"] == "auto"
+    assert _build_parser().parse_args(["fragility", "--n-jobs", "4"]).n_jobs == 4
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from mne_bids import BIDSPath
+
+from spes.fragility.io import (
+    PERTURB_DESCRIPTION,
+    STATE_DESCRIPTION,
+    get_derivative_fpath,
+    read_fragility_sidecar,
+    save_atomic,
+    save_fragility_arrays,
+)
+
+
+def test_save_atomic(tmp_path):
+    """Test that files appear together and leftovers do not block saving."""
+    # a temporary folder left behind by a crashed run
+    (tmp_path / ".tmp-leftover").mkdir()
+    fpaths = save_atomic(
+        tmp_path,
+        [
+            lambda tmp: np.save(tmp / "b_desc-perturbmatrix.npy", np.ones(2)),
+            lambda tmp: np.save(tmp / "a_desc-statematrix.npy", np.zeros(2)),
+        ],
+        last=PERTURB_DESCRIPTION,
+    )
+    assert [fpath.name for fpath in fpaths] == [
+        "a_desc-statematrix.npy",
+        "b_desc-perturbmatrix.npy",
+    ]
+    assert sorted(fpath.name for fpath in tmp_path.iterdir()) == [
+        ".tmp-leftover",
+        "a_desc-statematrix.npy",
+        "b_desc-perturbmatrix.npy",
+    ]
+
+
+def test_save_fragility_arrays(tmp_path):
+    """Test that nothing is written if any derivative exists."""
+    bids_path = BIDSPath(subject="01", task="rest", datatype="ieeg", root=tmp_path)
+    arrays = {PERTURB_DESCRIPTION: np.ones((2, 3)), STATE_DESCRIPTION: np.ones((4, 3))}
+    deriv_fpaths = save_fragility_arrays(
+        tmp_path, bids_path, arrays, sidecar_params={"radius": 1.5}
+    )
+    assert read_fragility_sidecar(deriv_fpaths[PERTURB_DESCRIPTION]) == {
+        "radius": 1.5
+    }
+
+    deriv_fpaths[PERTURB_DESCRIPTION].unlink()
+    with pytest.raises(FileExistsError):
+        save_fragility_arrays(
+            tmp_path, bids_path, arrays, sidecar_params={"radius": 2.0}
+        )
+    assert not get_derivative_fpath(tmp_path, bids_path, PERTURB_DESCRIPTION).exists()
+    assert read_fragility_sidecar(deriv_fpaths[PERTURB_DESCRIPTION]) == {
+        "radius": 1.5
+    }
+    assert not list(tmp_path.glob(".*.tmp"))
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from mne_bids import BIDSPath
+
+from spes.jobqueue import FileJobQueue, run_worker, submit_fragility_jobs
+
+
+def _age(fpath, seconds):
+    """Set the modification time of a file to ``seconds`` ago."""
+    mtime = time.time() - seconds
+    os.utime(fpath, (mtime, mtime))
+
+
+def test_claim_once(tmp_path):
+    """Test that a job is claimed by exactly one of several workers."""
+    queues = [FileJobQueue(tmp_path) for _ in range(8)]
+    assert queues[0].submit("test", {"value": 1}) is not None
+    # submitting the same job again is a no-op
+    assert queues[1].submit("test", {"value": 1}) is None
+
+    claims = [None] * len(queues)
+    barrier = threading.Barrier(len(queues))
+
+    def _claim(idx):
+        barrier.wait()
+        claims[idx] = queues[idx].claim()
+
+    threads = [threading.Thread(target=_claim, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = [job for job in claims if job is not None]
+    assert len(claimed) == 1
+    assert queues[0].counts() == {"pending": 0, "claimed": 1, "done": 0, "failed": 0}
+
+
+def test_requeue_expired(tmp_path):
+    """Test that an expired lease is requeued and can be claimed again."""
+    queue = FileJobQueue(tmp_path, lease_seconds=60, max_attempts=2)
+    job_id = queue.submit("test", {"value": 1})
+    job = queue.claim()
+    assert queue.requeue_expired() == []
+
+    _age(job["claim_fpath"], 120)
+    assert queue.requeue_expired() == [job_id]
+    # the worker that lost the lease can neither renew nor finish it
+    assert not queue.heartbeat(job)
+    with pytest.warns(RuntimeWarning, match="expired"):
+        assert queue.complete(job) is None
+
+    other = FileJobQueue(tmp_path, lease_seconds=60, max_attempts=2)
+    job = other.claim()
+    assert job["attempts"] == 1
+    _age(job["claim_fpath"], 120)
+    other.requeue_expired()
+    assert other.counts()["failed"] == 1
+
+
+def test_recover_finishing(tmp_path):
+    """Test that a job whose worker died while finishing it is requeued."""
+    queue = FileJobQueue(tmp_path, lease_seconds=60)
+    job_id = queue.submit("test", {"value": 1})
+    job = queue.claim()
+    claim_fpath = Path(job["claim_fpath"])
+    finishing_fpath = claim_fpath.with_name(f".{claim_fpath.name}.finishing")
+    os.rename(claim_fpath, finishing_fpath)
+    assert queue.requeue_expired() == []
+
+    _age(finishing_fpath, 120)
+    assert queue.requeue_expired() == [job_id]
+    assert not finishing_fpath.exists()
+    assert queue.counts()["pending"] == 1
+
+    # a finished job only loses its leftover finishing file
+    job = queue.claim()
+    assert queue.complete(job) == "done"
+    finishing_fpath.touch()
+    _age(finishing_fpath, 120)
+    assert queue.requeue_expired() == []
+    assert not finishing_fpath.exists()
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 1, "failed": 0}
+
+
+def test_run_worker_retries(tmp_path):
+    """Test that failed jobs are retried until ``max_attempts``."""
+    queue = FileJobQueue(tmp_path, max_attempts=2)
+    queue.submit("ok", {"value": 1})
+    queue.submit("fail", {"value": 2})
+
+    def _fail(value):
+        raise RuntimeError(f"failed {value}")
+
+    handlers = {"ok": lambda value: value, "fail": _fail}
+    n_jobs = run_worker(queue, handlers=handlers, poll_interval=0, exit_when_empty=True)
+    assert n_jobs == 3
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 1, "failed": 1}
+
+
+def test_break_stale_lock(tmp_path):
+    """Test that a stale lock is broken and a fresh one is waited for."""
+    queue = FileJobQueue(tmp_path, lease_seconds=60)
+    lock_fpath = tmp_path / "locks" / "test.lock"
+    lock_fpath.parent.mkdir()
+    lock_fpath.write_text("dead worker")
+    _age(lock_fpath, 120)
+
+    holders, max_holders = [], []
+
+    def _hold(idx):
+        with FileJobQueue(tmp_path, lease_seconds=60).lock("test", poll_interval=0.01):
+            holders.append(idx)
+            max_holders.append(len(holders))
+            time.sleep(0.01)
+            holders.remove(idx)
+
+    threads = [threading.Thread(target=_hold, args=(idx,)) for idx in range(4)]
+    with pytest.warns(RuntimeWarning, match="Breaking stale lock"):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert max_holders == [1] * 4
+    assert not lock_fpath.exists()
+    assert list(lock_fpath.parent.iterdir()) == []
+    with queue.lock("test"):
+        assert lock_fpath.exists()
+
+
+def test_submit_fragility_jobs_references(tmp_path):
+    """Test that a job cannot get both reference and references."""
+    queue = FileJobQueue(tmp_path / "queue")
+    bids_path = BIDSPath(subject="01", task="rest", datatype="ieeg", root=tmp_path)
+    with pytest.raises(ValueError, match="not both"):
+        submit_fragility_jobs(
+            queue,
+            [bids_path],
+            tmp_path,
+            tmp_path,
+            reference="monopolar",
+            references=["bipolar"],
+        )
+    job_ids = submit_fragility_jobs(
+        queue, [bids_path], tmp_path, tmp_path, references=["monopolar", "bipolar"]
+    )
+    assert job_ids == [f"fragility-{bids_path.basename}-monopolar-bipolar"]
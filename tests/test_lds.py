@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from spes.fragility.lds import (
+    TRUNCATION_TOLERANCE,
+    compute_perturbation_norms,
+    fit_state_matrices,
+)
+from spes.fragility.utils import normalize_fragility
+from spes.fragility.validate import simulate_lds_data
+
+
+def _simulate_windows(n_chs, n_sources, noise, winsize=250, n_windows=8):
+    data = simulate_lds_data(
+        n_chs=n_chs, n_times=n_windows * winsize, n_sources=n_sources, noise=noise
+    )
+    return data.reshape(n_chs, n_windows, winsize).transpose(1, 0, 2)
+
+
+def _fragility_deviation(A_exact, A_approx):
+    norms_exact = compute_perturbation_norms(A_exact, 1.5).T
+    norms_approx = compute_perturbation_norms(A_approx, 1.5).T
+    return np.abs(
+        normalize_fragility(norms_exact) - normalize_fragility(norms_approx)
+    ).max()
+
+
+@pytest.mark.parametrize("n_chs", [50, 100])
+@pytest.mark.parametrize("truncation", [dict(energy=0.999999), dict(max_rank=20)])
+def test_randomized_solver_tolerance(n_chs, truncation):
+    """Test the truncated fit on rank-deficient windows against pinv."""
+    windows = _simulate_windows(n_chs, n_sources=20, noise=0)
+    A_exact = fit_state_matrices(windows)
+    A_approx = fit_state_matrices(windows, solver="randomized", **truncation)
+    assert _fragility_deviation(A_exact, A_approx) <= TRUNCATION_TOLERANCE
+
+
+def test_randomized_solver_needs_truncation():
+    """Test that the randomized solver does not silently run the exact SVD."""
+    windows = _simulate_windows(20, n_sources=None, noise=0)
+    with pytest.raises(ValueError, match="energy < 1 or max_rank"):
+        fit_state_matrices(windows, solver="randomized")
+    with pytest.raises(ValueError, match="solver must be"):
+        fit_state_matrices(windows, solver="lstsq")
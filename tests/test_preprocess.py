@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from spes.preprocess import compare_blockwise_preprocessing
+
+
+@pytest.mark.parametrize("phase", ["zero", "causal"])
+@pytest.mark.parametrize("method", ["iir", "fir"])
+def test_blockwise_matches_in_memory(method, phase):
+    """Test block-wise filtering against MNE and scipy in memory."""
+    rng = np.random.default_rng(0)
+    data = 50e-6 * rng.standard_normal((2, 150_000))
+    result = compare_blockwise_preprocessing(
+        data, 500.0, line_freq=60.0, block_duration=1.0, method=method, phase=phase
+    )
+    assert result["n_samples_compared"] > 0
+    assert result["max_rel_error"] < 1e-5
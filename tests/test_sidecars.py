@@ -0,0 +1,64 @@
+import json
+
+import numpy as np
+import pytest
+from mne_bids import BIDSPath
+from mne_bids.tsv_handler import _from_tsv
+
+from spes.bids.sidecars import SidecarTransaction
+
+CHANNELS_TSV = "name\ttype\nA1\tSEEG\nA2\tSEEG\n"
+
+
+@pytest.fixture
+def bids_path(tmp_path):
+    bids_path = BIDSPath(
+        subject="01",
+        task="rest",
+        datatype="ieeg",
+        suffix="ieeg",
+        extension=".edf",
+        root=tmp_path,
+    )
+    bids_path.mkdir()
+    channels_fpath = bids_path.copy().update(suffix="channels", extension=".tsv")
+    channels_fpath.fpath.write_text(CHANNELS_TSV)
+    return bids_path
+
+
+def test_commit(bids_path):
+    """Test that the edits of a transaction are written at its end."""
+    with SidecarTransaction(bids_path) as sidecars:
+        sidecars.set_tsv_column("channels", "status", ["good", np.nan])
+        sidecars.set_tsv_column("channels", "group", "A")
+        sidecars.update_json("channels", {"status": {"Description": "status"}})
+        assert sidecars.fpath("channels", ".tsv").read_text() == CHANNELS_TSV
+        with pytest.raises(ValueError, match="1 values"):
+            sidecars.set_tsv_column("channels", "status", ["good"])
+
+    channels_tsv = _from_tsv(sidecars.fpath("channels", ".tsv"))
+    assert channels_tsv["status"] == ["good", "n/a"]
+    assert channels_tsv["group"] == ["A", "A"]
+    with open(sidecars.fpath("channels", ".json")) as fin:
+        assert json.load(fin) == {"status": {"Description": "status"}}
+
+
+def test_rollback(bids_path):
+    """Test that a failed transaction leaves the sidecars unchanged."""
+    with pytest.raises(RuntimeError):
+        with SidecarTransaction(bids_path) as sidecars:
+            sidecars.set_tsv_column("channels", "status", "bad")
+            raise RuntimeError("conversion failed")
+    assert sidecars.fpath("channels", ".tsv").read_text() == CHANNELS_TSV
+
+    # a sidecar that cannot be written fails the commit before any move
+    sidecars = SidecarTransaction(bids_path)
+    sidecars.set_tsv_column("channels", "status", "bad")
+    sidecars.update_json("channels", {"status": object()})
+    with pytest.raises(TypeError):
+        sidecars.commit()
+    ieeg_dir = sidecars.fpath("channels", ".tsv").parent
+    assert sorted(fpath.name for fpath in ieeg_dir.iterdir()) == [
+        "sub-01_task-rest_channels.tsv"
+    ]
+    assert sidecars.fpath("channels", ".tsv").read_text() == CHANNELS_TSV
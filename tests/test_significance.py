@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from spes.fragility.significance import fragility_pvalues, phase_randomize, time_shift
+from spes.fragility.validate import simulate_lds_data
+
+MODEL_PARAMS = dict(winsize=250, stepsize=125, radius=1.5, l2penalty=1e-9)
+
+
+def test_surrogates_keep_spectra():
+    """Test that surrogates keep the power spectrum of each channel."""
+    data = simulate_lds_data(n_chs=4, n_times=1000)
+    rng = np.random.default_rng(0)
+    power = np.abs(np.fft.rfft(data, axis=-1))
+    np.testing.assert_allclose(
+        np.abs(np.fft.rfft(phase_randomize(data, rng), axis=-1)), power, atol=1e-10
+    )
+    shifted = time_shift(data, rng)
+    np.testing.assert_allclose(np.sort(shifted, axis=-1), np.sort(data, axis=-1))
+
+
+def test_fragility_pvalues():
+    """Test that the p-values are seeded and independent of the jobs."""
+    data = simulate_lds_data(n_chs=4, n_times=1000)
+    n_surrogates = 9
+    pvalues, fragility = fragility_pvalues(
+        data, n_surrogates=n_surrogates, seed=42, **MODEL_PARAMS
+    )
+    assert pvalues.shape == fragility.shape == (4, 7)
+    # (count + 1) / (n_surrogates + 1) for counts of 0 to n_surrogates
+    counts = pvalues * (n_surrogates + 1) - 1
+    np.testing.assert_allclose(counts, np.round(counts), atol=1e-12)
+    assert counts.min() >= 0 and counts.max() <= n_surrogates
+
+    pvalues_jobs, _ = fragility_pvalues(
+        data, n_surrogates=n_surrogates, seed=42, n_jobs=2, **MODEL_PARAMS
+    )
+    np.testing.assert_array_equal(pvalues_jobs, pvalues)
+    pvalues_seed, _ = fragility_pvalues(
+        data, n_surrogates=n_surrogates, seed=43, **MODEL_PARAMS
+    )
+    assert not np.array_equal(pvalues_seed, pvalues)
+
+
+def test_fragility_pvalues_scalar_radius():
+    """Test that surrogate p-values need a scalar radius."""
+    data = simulate_lds_data(n_chs=4, n_times=1000)
+    with pytest.raises(ValueError, match="scalar radius"):
+        fragility_pvalues(data, n_surrogates=2, **{**MODEL_PARAMS, "radius": [1, 2]})
@@ -0,0 +1,67 @@
+import numpy as np
+from mne_bids import BIDSPath
+
+from spes.fragility.io import (
+    DELTAVECS_DESCRIPTION,
+    PERTURB_DESCRIPTION,
+    STATE_DESCRIPTION,
+    get_derivative_fpath,
+    get_output_profile,
+    get_state_fpath,
+)
+from spes.fragility.sweep import _config_deriv_path, _sweep_recording, recompute_radii
+from spes.fragility.validate import simulate_lds_data
+
+
+def test_sweep_shares_state_matrix(tmp_path):
+    """Test that the radii of a full sweep fit share one state matrix."""
+    bids_path = BIDSPath(subject="01", task="rest", datatype="ieeg", root=tmp_path)
+    data = simulate_lds_data(n_chs=5, n_times=1000)
+    fit_key = (250, 125, 1e-9)
+    radii = [1.5, 2.0]
+    _sweep_recording(
+        data,
+        [f"A{idx}" for idx in range(1, 6)],
+        1000.0,
+        bids_path,
+        tmp_path / "derivatives",
+        {fit_key: radii},
+        output_profile="full",
+    )
+
+    perturb_fpaths = []
+    for radius in radii:
+        config = dict(zip(("winsize", "stepsize", "l2penalty"), fit_key))
+        config["radius"] = radius
+        deriv_path = _config_deriv_path(
+            tmp_path / "derivatives", config, "monopolar", "01"
+        )
+        perturb_fpaths.append(
+            get_derivative_fpath(deriv_path, bids_path, PERTURB_DESCRIPTION)
+        )
+        assert perturb_fpaths[-1].exists()
+        assert get_derivative_fpath(
+            deriv_path, bids_path, DELTAVECS_DESCRIPTION
+        ).exists()
+
+    # the state matrix is only saved with the first radius
+    state_fpath = get_derivative_fpath(
+        perturb_fpaths[0].parent, bids_path, STATE_DESCRIPTION
+    )
+    assert state_fpath.exists()
+    assert not get_derivative_fpath(
+        perturb_fpaths[1].parent, bids_path, STATE_DESCRIPTION
+    ).exists()
+    for perturb_fpath in perturb_fpaths:
+        assert get_state_fpath(perturb_fpath).resolve() == state_fpath.resolve()
+        assert get_output_profile(perturb_fpath) == "full"
+
+    # the saved state matrix reproduces the perturbations of the other radius
+    out_fpath = recompute_radii(state_fpath, [radii[1]], tmp_path / "recomputed")
+    np.testing.assert_allclose(
+        np.load(out_fpath[radii[1]]), np.load(perturb_fpaths[1]), rtol=1e-6
+    )
+
+    # without the shared state matrix, the other radius is no longer full
+    state_fpath.unlink()
+    assert get_output_profile(perturb_fpaths[1]) == "minimal"
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from spes.fragility.validate import (
+    ENGINE_TOLERANCE,
+    compare_engines,
+    compare_precision,
+    simulate_lds_data,
+)
+
+
+def test_float32_precision():
+    """Test that float32 fragility is close to the float64 numpy engine."""
+    data = simulate_lds_data(n_chs=20, n_times=2000)
+    result = compare_precision(data, dtype=np.float32, winsize=250, stepsize=125)
+    assert result["max_abs_dev"] < 1e-4
+
+
+def test_numpy_engine_matches_eztrack():
+    """Test that the numpy engine reproduces eztrack's lds_raw_fragility."""
+    pytest.importorskip("eztrack")
+    mne = pytest.importorskip("mne")
+
+    data = simulate_lds_data(n_chs=20, n_times=2000)
+    info = mne.create_info(20, sfreq=1000.0, ch_types="seeg")
+    raw = mne.io.RawArray(data, info, verbose=False)
+    result = compare_engines(raw)
+    assert result["max_abs_dev"] <= ENGINE_TOLERANCE
@@ -0,0 +1,79 @@
+import numpy as np
+
+import spes.bids.verify as verify
+from spes.bids.verify import verify_bids_dataset
+
+VHDR = """Brain Vision Data Exchange Header File Version 1.0
+
+[Common Infos]
+DataFile={stem}.eeg
+MarkerFile={stem}.vmrk
+DataFormat=BINARY
+DataOrientation=MULTIPLEXED
+NumberOfChannels=2
+SamplingInterval=1000
+
+[Binary Infos]
+BinaryFormat=IEEE_FLOAT_32
+
+[Channel Infos]
+Ch1=A1,,0.1,µV
+Ch2=A2,,0.1,µV
+"""
+
+VMRK = """Brain Vision Data Exchange Marker File Version 1.0
+
+[Common Infos]
+DataFile={stem}.eeg
+
+[Marker Infos]
+Mk1=New Segment,,1,1,0
+"""
+
+
+def _write_recording(bids_root, subject):
+    """Write a consistent BrainVision recording of 2 channels."""
+    ieeg_dir = bids_root / f"sub-{subject}" / "ieeg"
+    ieeg_dir.mkdir(parents=True)
+    stem = f"sub-{subject}_task-rest_ieeg"
+    (ieeg_dir / f"{stem}.vhdr").write_text(VHDR.format(stem=stem))
+    (ieeg_dir / f"{stem}.vmrk").write_text(VMRK.format(stem=stem))
+    np.zeros((100, 2), dtype=np.float32).tofile(ieeg_dir / f"{stem}.eeg")
+    (ieeg_dir / f"sub-{subject}_task-rest_channels.tsv").write_text(
+        "name\ttype\nA1\tSEEG\nA2\tSEEG\n"
+    )
+    (ieeg_dir.parent / f"sub-{subject}_scans.tsv").write_text(
+        f"filename\nieeg/{stem}.vhdr\n"
+    )
+    return ieeg_dir / f"{stem}.vhdr"
+
+
+def test_verify_keeps_cache_of_other_subjects(tmp_path, monkeypatch):
+    """Test that a run over some subjects keeps the cache of the others."""
+    fpaths = [_write_recording(tmp_path, subject) for subject in ("01", "02")]
+    verified = []
+    verify_recording = verify.verify_recording
+
+    def _verify_recording(fpath):
+        verified.append(fpath)
+        return verify_recording(fpath)
+
+    monkeypatch.setattr(verify, "verify_recording", _verify_recording)
+
+    problems_df = verify_bids_dataset(tmp_path, n_jobs=1)
+    assert problems_df.empty
+    assert sorted(verified) == fpaths
+
+    # a subset, then a full run: nothing is verified again
+    verified.clear()
+    verify_bids_dataset(tmp_path, subjects=["01"], n_jobs=1)
+    verify_bids_dataset(tmp_path, n_jobs=1)
+    assert verified == []
+
+    # a removed recording is dropped from the cache
+    for fpath in fpaths[1].parent.iterdir():
+        fpath.unlink()
+    verify_bids_dataset(tmp_path, subjects=["01"], n_jobs=1)
+    cache_fpath = tmp_path / "derivatives" / "verify" / "verify_cache.json"
+    assert str(fpaths[1]) not in cache_fpath.read_text()
+    assert verified == []